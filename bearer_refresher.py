@@ -0,0 +1,266 @@
+"""
+Scheduler, which renews bearers before their timestampExpires,
+so that interactive searches almost never have to create bearer themselves.
+
+Bearers are indexed in a min-heap by the time, when they have to be renewed.
+The index is built from record store at start and periodically rebuilt, because bearers
+are also created by searches in other gunicorn workers. Only one process runs the scheduler,
+other processes don't index bearers. Bearers, which were not searched for a long time, are not renewed.
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import tempfile
+import time
+from threading import Thread, Lock, Event
+from typing import *
+
+from record_store import RecordStore
+
+
+BearerKey = Tuple[str, str, str]
+
+
+class BearerRefresher(object):
+
+    _rs: RecordStore = None
+    _refresh: Callable[[Dict], bool] = None
+    _window = 0
+    _min_interval = 0.0
+    _retry_delay = 0
+    _rescan_interval = 0
+    _idle = 0
+    _state_filename = ''
+    _log: Callable[[str], None] = None
+
+    def __init__(
+            self,
+            rs: RecordStore,
+            refresh: Callable[[Dict], bool],
+            window: int,
+            rate: float,
+            retry_delay: int,
+            rescan_interval: int,
+            idle: int = 0,
+            state_filename: str = '',
+            log: Callable[[str], None] = print
+    ):
+        """
+        :param rs: record store with bearers
+        :param refresh: renews bearer by its record, returns False if it should be retried later
+        :param window: seconds before timestampExpires, when bearer is renewed
+        :param rate: maximum number of renewals per second, limits load on NDSS
+        :param retry_delay: seconds before next attempt after failed renewal
+        :param rescan_interval: seconds between rebuilding of index from record store
+        :param idle: seconds after timestampSearched, when bearer is not renewed anymore, 0 to renew always
+        :param state_filename: file for progress of the scheduler, kept between restarts
+        :param log: logging function
+        """
+        self._rs = rs
+        self._refresh = refresh
+        self._window = window
+        self._min_interval = 1.0 / rate if rate > 0 else 0.0
+        self._retry_delay = retry_delay
+        self._rescan_interval = rescan_interval
+        self._idle = idle
+        self._state_filename = state_filename
+        self._log = log
+        self._heap: List[Tuple[float, BearerKey]] = []
+        self._due: Dict[BearerKey, float] = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._lock_fd: Optional[int] = None
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0
+        self._retries: Dict[str, float] = {}
+        self._load_state()
+
+    @staticmethod
+    def _get_key(record: Dict) -> BearerKey:
+        return record.get('tokenAlias'), record.get('accessRole'), record.get('userData')
+
+    @staticmethod
+    def _format_key(key: BearerKey) -> str:
+        return ';'.join(str(x) for x in key)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'scheduled': len(self),
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'skipped': self.skipped
+        }
+
+    def is_idle(self, record: Dict) -> bool:
+        """
+        Checks, if bearer was not searched for longer than idle period and should not be renewed
+        """
+        return self._idle > 0 and time.time() - int(record.get('timestampSearched') or 0) > self._idle
+
+    def needs_searched_update(self, record: Dict) -> bool:
+        """
+        Checks, if timestampSearched of bearer returned by search should be saved.
+        It is saved with precision of 1/10 of idle period, so that most searches don't write.
+        """
+        return self._idle > 0 and time.time() - int(record.get('timestampSearched') or 0) > self._idle / 10
+
+    def start(self, lock_filename: str = '') -> bool:
+        """
+        Starts scheduler thread, if there is no scheduler in other process
+
+        :param lock_filename: lock file shared by processes of this service
+        :return: True if scheduler is running in this process
+        """
+        if not lock_filename:
+            lock_filename = os.path.join(tempfile.gettempdir(), f'bearer-refresher-{self._rs.service_id}.lock')
+        fd = os.open(lock_filename, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        Thread(target=self._run, name='bearer-refresher', daemon=True).start()
+        return True
+
+    def track(self, record: Dict) -> None:
+        """
+        Schedules renewal of saved bearer record.
+        Call it for bearers, created outside of the scheduler. Does nothing in processes,
+        which don't run the scheduler.
+        """
+        if self._lock_fd is None or self.is_idle(record):
+            return
+        timestamp_expires = int(record.get('timestampExpires') or 0)
+        if timestamp_expires <= time.time():
+            # already expired bearers are left for searches
+            return
+        key = self._get_key(record)
+        due = self._retries.get(self._format_key(key), timestamp_expires - self._window)
+        with self._lock:
+            if self._due.get(key) == due:
+                return
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, key))
+        self._wakeup.set()
+
+    def _rescan(self) -> None:
+        count = 0
+        for record in self._rs.load_all_bearer_records():
+            self.track(record)
+            count += 1
+        self._log(f'Bearer refresher has scanned {count} bearers, {len(self)} are scheduled')
+
+    def _pop_due(self, now: float) -> Optional[BearerKey]:
+        """
+        Returns key of bearer, which has to be renewed now, or None
+        """
+        with self._lock:
+            while self._heap:
+                due, key = self._heap[0]
+                if self._due.get(key) != due:
+                    # outdated entry, bearer was rescheduled
+                    heapq.heappop(self._heap)
+                    continue
+                if due > now:
+                    return None
+                heapq.heappop(self._heap)
+                del self._due[key]
+                return key
+        return None
+
+    def _seconds_to_next(self, now: float) -> float:
+        with self._lock:
+            if not self._heap:
+                return float('inf')
+            return max(self._heap[0][0] - now, 0.0)
+
+    def _run(self) -> None:
+        next_rescan = 0.0
+        while True:
+            now = time.time()
+            if now >= next_rescan:
+                try:
+                    self._rescan()
+                except Exception as e:
+                    self._log(f'Bearer refresher failed to scan bearers: {e!r}')
+                next_rescan = now + self._rescan_interval
+
+            key = self._pop_due(now)
+            if key is None:
+                self._wakeup.clear()
+                self._wakeup.wait(min(self._seconds_to_next(now), max(next_rescan - now, 0.0)))
+                continue
+
+            self._refresh_one(key)
+            time.sleep(self._min_interval)
+
+    def _refresh_one(self, key: BearerKey) -> None:
+        record = self._rs.load_bearer_record(*key)
+        if not record:
+            return
+        formatted_key = self._format_key(key)
+        if self.is_idle(record):
+            self.skipped += 1
+            self._retries.pop(formatted_key, None)
+            return
+        if int(record.get('timestampExpires') or 0) - self._window > time.time():
+            # already renewed, e.g. by search
+            self._retries.pop(formatted_key, None)
+            self.track(record)
+            return
+
+        try:
+            is_refreshed = self._refresh(record)
+        except Exception as e:
+            self._log(f'Failed to refresh bearer for {key[0]}: {e!r}')
+            is_refreshed = False
+
+        if is_refreshed:
+            self.refreshed += 1
+            self._retries.pop(formatted_key, None)
+            renewed = self._rs.load_bearer_record(*key)
+            if renewed and int(renewed.get('timestampExpires') or 0) - self._window > time.time():
+                self.track(renewed)
+        else:
+            self.failed += 1
+            self._retries[formatted_key] = time.time() + self._retry_delay
+            self.track(record)
+        self._save_state()
+
+    def _load_state(self) -> None:
+        if not self._state_filename or not os.path.isfile(self._state_filename):
+            return
+        try:
+            with open(self._state_filename, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        self.refreshed = int(state.get('refreshed', 0))
+        self.failed = int(state.get('failed', 0))
+        # postponed retries survive restart, so failing bearers don't hammer NDSS after it
+        self._retries = {k: v for k, v in state.get('retries', {}).items() if v > now}
+
+    def _save_state(self) -> None:
+        if not self._state_filename:
+            return
+        state = {
+            'timestampSaved': int(time.time()),
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'retries': self._retries
+        }
+        temp_filename = f'{self._state_filename}.tmp'
+        try:
+            with open(temp_filename, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_filename, self._state_filename)
+        except OSError as e:
+            self._log(f'Failed to save bearer refresher state: {e!r}')
@@ -0,0 +1,386 @@
+"""
+Load test of /ndmp/linkService and /search with fake NDSS (see fake_ndss.py).
+
+For every record store backend the service is started in a separate process with a temporary config,
+which is based on instance/config.json (or instance/config_demo.json) and uses fake NDSS:
+
+    python benchmark.py --backends file,sqlite --devices 500 --concurrency 16
+
+Running service (e.g. gunicorn with DEBUG_FAKE_NDSS) may be loaded over HTTP instead:
+
+    python benchmark.py --url http://127.0.0.1:5000 --login <login> --password <password>
+
+Recorded requests are replayed with --trace: every JSON line with "path" (and optional "method")
+is sent in order, other lines are skipped.
+
+Throughput, p50 and p99 latency and error codes are reported for every scenario.
+
+Startup time of a new worker is measured with --startup: the app is imported by fresh interpreter
+the given number of times, time of import (when worker may accept requests) and time until /ready
+are compared with --startup-budget.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from typing import *
+
+
+Request = Tuple[str, str]  # method, path with query
+
+
+class InProcessTarget(object):
+    """
+    Sends requests to main.app of this process through Flask test client
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._local = local()
+
+    def send(self, method: str, path: str) -> Tuple[int, Dict]:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        response = client.open(path, method=method)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class HttpTarget(object):
+    """
+    Sends requests to running service
+    """
+
+    def __init__(self, url: str, login: str = '', password: str = ''):
+        self._url = url.rstrip('/')
+        self._headers = {}
+        if login:
+            self._headers['Authorization'] = 'Basic ' + base64.b64encode(f'{login}:{password}'.encode()).decode()
+
+    def send(self, method: str, path: str) -> Tuple[int, Dict]:
+        req = urllib.request.Request(self._url + path, method=method, headers=self._headers)
+        try:
+            with urllib.request.urlopen(req, timeout=60) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        try:
+            return status, json.loads(body)
+        except ValueError:
+            return status, {}
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def run_requests(target, requests: List[Request], concurrency: int) -> Dict:
+    """
+    Sends requests with given concurrency
+
+    :return: summary with throughput, latency percentiles in milliseconds and error codes
+    """
+    def send(request: Request) -> Tuple[float, str]:
+        started = time.perf_counter()
+        try:
+            status, body = target.send(*request)
+            code = body.get('code') or ('' if status == 200 else str(status))
+        except Exception as e:  # connection errors are counted too
+            code = type(e).__name__
+        return time.perf_counter() - started, code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        results = list(executor.map(send, requests))
+    elapsed = time.perf_counter() - started
+
+    latencies = [x[0] for x in results]
+    errors = Counter(x[1] for x in results if x[1])
+    return {
+        'requests': len(results),
+        'errors': dict(errors),
+        'rps': round(len(results) / elapsed, 1) if elapsed else 0.0,
+        'p50': round(percentile(latencies, 50) * 1000, 1),
+        'p99': round(percentile(latencies, 99) * 1000, 1)
+    }
+
+
+def make_service_tags(count: int) -> List[str]:
+    # 15 digits, never ending with '000', which fake NDSS doesn't know
+    return [str(10 ** 14 + i * 10 + 1) for i in range(count)]
+
+
+def make_link_requests(service_id: str, service_tags: List[str]) -> List[Request]:
+    from fake_ndss import FakeNDSS
+    timestamp = int(time.time())
+    requests = []
+    for i, service_tag in enumerate(service_tags):
+        token_alias = FakeNDSS.get_token_alias(service_tag)
+        requests.append((
+            'POST',
+            f'/ndmp/linkService?tokenAlias={token_alias}&serviceId={service_id}'
+            f'&deviceEcPublic=fake-{token_alias}&timestamp={timestamp}&ecSignature=fake-{i}'
+        ))
+    return requests
+
+
+def make_search_requests(service_tags: List[str], count: int) -> List[Request]:
+    return [('GET', f'/search?license={random.choice(service_tags)}') for _ in range(count)]
+
+
+def load_trace(filename: str) -> List[Request]:
+    requests = []
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and str(entry.get('path', '')).startswith('/'):
+                requests.append((entry.get('method', 'GET').upper(), entry['path']))
+    return requests
+
+
+def run_scenarios(target, args: argparse.Namespace, service_id: str, wait_for_links: Callable[[], None]) -> Dict:
+    service_tags = make_service_tags(args.devices)
+    results = {}
+    results['linkService'] = run_requests(target, make_link_requests(service_id, service_tags), args.concurrency)
+    wait_for_links()
+    # the first search of a device creates its bearer, next ones return saved bearer
+    results['search (cold)'] = run_requests(
+        target, [('GET', f'/search?license={x}') for x in service_tags], args.concurrency)
+    results['search (warm)'] = run_requests(target, make_search_requests(service_tags, args.searches), args.concurrency)
+    if args.trace:
+        trace = load_trace(args.trace)
+        if trace:
+            results['trace'] = run_requests(target, trace, args.concurrency)
+        else:
+            print(f'No requests to replay in {args.trace}', file=sys.stderr)
+    return results
+
+
+def run_in_process(args: argparse.Namespace) -> None:
+    """
+    Runs scenarios against main.app, which is configured by instance/config.json of current directory
+    """
+    import main
+
+    def wait_for_links():
+        while main.link_queue.qsize() or main.link_queue.busy():
+            time.sleep(0.05)
+
+    results = run_scenarios(InProcessTarget(main.app), args, main.ndss_service_id, wait_for_links)
+    with open(args.output, 'w') as f:
+        json.dump(results, f)
+
+
+def prepare_config(base_config: Dict, backend: str, directory: str, args: argparse.Namespace) -> Dict:
+    config = dict(base_config)
+    # all files of the service are kept in temporary directory
+    for key, value in base_config.items():
+        if value and isinstance(value, str) and key.endswith(('_FILENAME', '_DIRECTORY', '_DIRPREFIX', '_LOCKFILE')):
+            config[key] = os.path.join(directory, os.path.basename(value.rstrip('/')))
+    config.update({
+        'RECORDSTORE': backend,
+        'DEBUG_FAKE_NDSS': True,
+        'DEBUG_SKIP_CALLBACK_SIGNATURE': True,
+        'DEBUG_SKIP_CALLBACK_BASICAUTH': True,
+        'DEBUG_SKIP_CHECK_TIMESTAMP': True,
+        'FAKE_NDSS_LATENCY': args.latency,
+        'FAKE_NDSS_LATENCY_JITTER': args.jitter,
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILENAME': '',
+        'METRICS_DIRECTORY': '',
+        'BEARER_REFRESH_ENABLED': False
+    })
+    if not config.get('NDSS_SERVICE_ID') or str(config['NDSS_SERVICE_ID']).startswith('<'):
+        config['NDSS_SERVICE_ID'] = 'benchmark'
+    return config
+
+
+def run_child(directory: str, arguments: List[str]) -> None:
+    """
+    Runs this script in the directory, so that the service is configured by its instance/config.json
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] + [x for x in [env.get('PYTHONPATH')] if x])
+    subprocess.run([sys.executable, os.path.abspath(__file__)] + arguments, cwd=directory, env=env, check=True)
+
+
+def make_directory(backend: str, base_config: Dict, args: argparse.Namespace) -> str:
+    directory = tempfile.mkdtemp(prefix=f'benchmark-{backend}-')
+    os.makedirs(os.path.join(directory, 'instance'))
+    with open(os.path.join(directory, 'instance', 'config.json'), 'w') as f:
+        json.dump(prepare_config(base_config, backend, directory, args), f, indent=2)
+    return directory
+
+
+def run_backend(backend: str, base_config: Dict, args: argparse.Namespace) -> Dict:
+    directory = make_directory(backend, base_config, args)
+    try:
+        output = os.path.join(directory, 'results.json')
+        arguments = [
+            '--in-process', '--output', output,
+            '--devices', str(args.devices), '--searches', str(args.searches), '--concurrency', str(args.concurrency)
+        ]
+        if args.trace:
+            arguments += ['--trace', os.path.abspath(args.trace)]
+        run_child(directory, arguments)
+        with open(output, 'r') as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def measure_startup_in_process(args: argparse.Namespace) -> None:
+    """
+    Imports main and waits for its startup, the result is appended to output file
+    """
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    is_ready = main.startup.wait(60)
+    result = {
+        'import': round((imported - started) * 1000, 1),
+        'ready': round((time.perf_counter() - started) * 1000, 1) if is_ready else None
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    # crypto processes are still starting, they fail if the worker exits before them
+    main.crypto_executor.shutdown()
+
+
+def run_startup(backend: str, base_config: Dict, args: argparse.Namespace) -> Dict:
+    """
+    Measures startup of new workers, which find record store with linked devices
+    """
+    directory = make_directory(backend, base_config, args)
+    try:
+        output = os.path.join(directory, 'startup.json')
+        # the first start creates record store, like the first deployment does
+        for _ in range(max(args.startup, 1) + 1):
+            run_child(directory, ['--startup-in-process', '--output', output])
+        with open(output, 'r') as f:
+            results = [json.loads(line) for line in f][1:]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    imports = [x['import'] for x in results]
+    readies = [x['ready'] for x in results if x['ready'] is not None]
+    return {
+        'starts': len(results),
+        'import p50': percentile(imports, 50),
+        'import max': max(imports),
+        'ready p50': percentile(readies, 50) if readies else None,
+        'ready max': max(readies) if readies else None,
+        'not ready': len(results) - len(readies)
+    }
+
+
+def print_startup_report(results: Dict[str, Dict], budget: float) -> bool:
+    """
+    :return: False if p50 of import time exceeds budget
+    """
+    print(f'{"backend":<12} {"starts":>7} {"import p50":>11} {"import max":>11} {"ready p50":>10} {"ready max":>10}')
+    is_within_budget = True
+    for backend, summary in results.items():
+        print(
+            f'{backend:<12} {summary["starts"]:>7} {summary["import p50"]:>11} {summary["import max"]:>11} '
+            f'{str(summary["ready p50"]):>10} {str(summary["ready max"]):>10}'
+        )
+        is_within_budget = is_within_budget and summary['import p50'] <= budget and not summary['not ready']
+    print(f'Budget of import: {budget} ms, {"met" if is_within_budget else "EXCEEDED"}')
+    return is_within_budget
+
+
+def print_report(results: Dict[str, Dict[str, Dict]]) -> None:
+    print(f'{"backend":<12} {"scenario":<16} {"requests":>9} {"errors":>7} {"rps":>9} {"p50 ms":>9} {"p99 ms":>9}')
+    for backend, scenarios in results.items():
+        for scenario, summary in scenarios.items():
+            print(
+                f'{backend:<12} {scenario:<16} {summary["requests"]:>9} {sum(summary["errors"].values()):>7} '
+                f'{summary["rps"]:>9} {summary["p50"]:>9} {summary["p99"]:>9}'
+            )
+            for code, count in sorted(summary['errors'].items()):
+                print(f'{"":<12} {"":<16} {code:>9} {count:>7}')
+
+
+def load_base_config(args: argparse.Namespace) -> Dict:
+    config_filename = args.config or next(
+        x for x in ['instance/config.json', 'instance/config_demo.json'] if os.path.isfile(x))
+    with open(config_filename, 'r') as f:
+        return json.load(f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark of the service with fake NDSS')
+    parser.add_argument('--backends', default='file,sqlite', help='comma-separated RECORDSTORE values')
+    parser.add_argument('--config', default='', help='base config, instance/config.json by default')
+    parser.add_argument('--url', default='', help='load running service instead of starting it')
+    parser.add_argument('--login', default='', help='basic auth login of running service')
+    parser.add_argument('--password', default='', help='basic auth password of running service')
+    parser.add_argument('--service-id', default='benchmark', help='serviceId of linkService for running service')
+    parser.add_argument('--link-wait', type=float, default=5, help='seconds to wait for linking by running service')
+    parser.add_argument('--devices', type=int, default=200, help='number of linked devices')
+    parser.add_argument('--searches', type=int, default=2000, help='number of warm searches')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of fake NDSS in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='random latency added by fake NDSS')
+    parser.add_argument('--trace', default='', help='JSON lines with recorded requests to replay')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--startup', type=int, default=0, help='measure startup of the service this number of times')
+    parser.add_argument('--startup-budget', type=float, default=1000, help='milliseconds allowed for import')
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--startup-in-process', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.in_process:
+        run_in_process(args)
+        return
+    if args.startup_in_process:
+        measure_startup_in_process(args)
+        return
+
+    results = {}
+    if args.startup:
+        base_config = load_base_config(args)
+        for backend in [x.strip() for x in args.backends.split(',') if x.strip()]:
+            results[backend] = run_startup(backend, base_config, args)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        if not print_startup_report(results, args.startup_budget):
+            sys.exit(1)
+        return
+
+    if args.url:
+        target = HttpTarget(args.url, args.login, args.password)
+        results[args.url] = run_scenarios(target, args, args.service_id, lambda: time.sleep(args.link_wait))
+    else:
+        base_config = load_base_config(args)
+        for backend in [x.strip() for x in args.backends.split(',') if x.strip()]:
+            results[backend] = run_backend(backend, base_config, args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Deadlines for calls of blocking client (NDSS).
+
+Calls are run in a bounded pool of threads, and the caller waits for the result no longer than the deadline.
+A call can not be interrupted, so a timed out call keeps its thread until the client's own timeout,
+and it still counts in the pool: when all threads are taken by stuck calls, new calls fail immediately
+instead of piling up.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextvars import copy_context
+from functools import partial, wraps
+from threading import BoundedSemaphore
+from typing import *
+
+
+class DeadlineProxy(object):
+    """
+    Proxy, which runs calls of object's methods in a bounded pool of threads with deadline
+    """
+
+    _timeout = 0.0
+    _timeouts: Dict[str, float] = {}
+
+    def __init__(
+            self,
+            target: object,
+            methods: Iterable[str],
+            pool_size: int,
+            timeout: float,
+            timeouts: Optional[Dict[str, float]],
+            make_error: Callable[[str], Exception]
+    ):
+        """
+        :param target: object with blocking methods
+        :param methods: names of methods to run with deadline
+        :param pool_size: maximum number of calls in progress, including timed out ones
+        :param timeout: default deadline of a call in seconds, 0 for no deadline
+        :param timeouts: deadlines for some of methods by method name, e.g. {'get_info': 10}, negative for default
+        :param make_error: creates exception, which is raised, when call times out or the pool is full
+        """
+        self._target = target
+        self._methods = set(methods)
+        self._timeout = timeout
+        self._timeouts = dict(timeouts or {})
+        self._make_error = make_error
+        self._slots = BoundedSemaphore(max(pool_size, 1))
+        self._executor = ThreadPoolExecutor(max_workers=max(pool_size, 1), thread_name_prefix='ndss-call')
+        self.timed_out = 0
+        self.rejected = 0
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name not in self._methods or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def with_deadline(*args, **kwargs):
+            timeout = self._timeouts.get(name, -1)
+            timeout = timeout if timeout >= 0 else self._timeout
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise self._make_error(f'too many calls of {name} in progress')
+            # slot is freed when the call returns, not when the caller stops waiting
+            future = self._executor.submit(partial(copy_context().run, attr, *args, **kwargs))
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                return future.result(timeout if timeout > 0 else None)
+            except TimeoutError:
+                self.timed_out += 1
+                raise self._make_error(f'{name} timed out after {timeout}s')
+        return with_deadline
@@ -0,0 +1,268 @@
+"""
+Circuit breaker and adaptive concurrency limit for calls of remote service (NDSS).
+
+Circuit breaker opens after consecutive failures, so that calls fail immediately instead of waiting for timeout.
+After a pause it lets a few probe calls through (half-open), doubling their number after every success,
+and closes when enough probes have succeeded.
+
+Concurrency limiter keeps the number of calls in progress below a limit, which grows while latency stays
+close to the best observed one, and shrinks in proportion to growth of smoothed latency or when calls fail.
+Calls above the limit wait for a short time and fail, if no call has finished meanwhile.
+"""
+
+import time
+from functools import wraps
+from threading import Lock, Condition
+from typing import *
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    _failure_threshold = 5
+    _open_seconds = 30.0
+    _half_open_successes = 5
+
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30, half_open_successes: int = 5):
+        """
+        :param failure_threshold: number of consecutive failures, which opens circuit
+        :param open_seconds: seconds before the first probe call
+        :param half_open_successes: number of successful probes, which closes circuit
+        """
+        self._failure_threshold = max(failure_threshold, 1)
+        self._open_seconds = open_seconds
+        self._half_open_successes = max(half_open_successes, 1)
+        self._lock = Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._successes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def acquire(self) -> bool:
+        """
+        Checks, if the call may be made now. Every allowed call must be followed by record()
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self._open_seconds:
+                    self.rejected += 1
+                    return False
+                self._state = HALF_OPEN
+                self._probes = 0
+                self._successes = 0
+            # half-open: 1 probe at once, then 2, 4 and so on
+            if self._probes >= 2 ** self._successes:
+                self.rejected += 1
+                return False
+            self._probes += 1
+            return True
+
+    def record(self, is_success: Optional[bool]) -> None:
+        """
+        Records result of allowed call
+
+        :param is_success: None if the call has neither failed nor proved that the service works
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+            if is_success is None:
+                return
+            if is_success:
+                self._failures = 0
+                if self._state == HALF_OPEN:
+                    self._successes += 1
+                    if self._successes >= self._half_open_successes:
+                        self._state = CLOSED
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self._failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {'state': self.state, 'opened': self.opened, 'rejected': self.rejected}
+
+
+class ConcurrencyLimiter(object):
+
+    _min_limit = 1
+    _max_limit = 100
+    _tolerance = 2.0
+    _backoff = 0.9
+    _wait = 1.0
+    _window = 100
+
+    def __init__(
+            self,
+            initial_limit: int = 20,
+            min_limit: int = 2,
+            max_limit: int = 100,
+            tolerance: float = 2.0,
+            backoff: float = 0.9,
+            wait: float = 1.0
+    ):
+        """
+        :param initial_limit: initial number of calls in progress
+        :param min_limit: the limit never goes below
+        :param max_limit: the limit never goes above
+        :param tolerance: latency, which is this times higher than the best one, decreases the limit
+        :param backoff: multiplier of the limit on failure
+        :param wait: seconds to wait for a free slot, before call is rejected
+        """
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit, self._min_limit)
+        self._limit = float(min(max(initial_limit, self._min_limit), self._max_limit))
+        self._tolerance = tolerance
+        self._backoff = backoff
+        self._wait = wait
+        self._lock = Lock()
+        self._released = Condition(self._lock)
+        self._in_flight = 0
+        # the best latency of every operation, it follows the best one of every window of samples
+        self._min_latency: Dict[str, float] = {}
+        # smoothed latency of every operation, so that single slow calls don't decrease the limit
+        self._avg_latency: Dict[str, float] = {}
+        self._window_min_latency: Dict[str, float] = {}
+        self._samples = 0
+        self.rejected = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self) -> bool:
+        deadline = time.monotonic() + self._wait
+        with self._released:
+            while self._in_flight >= int(self._limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return False
+                self._released.wait(remaining)
+            self._in_flight += 1
+            return True
+
+    def release(self, op: str, latency: Optional[float], is_success: bool) -> None:
+        """
+        :param op: operation, latency is compared with the best latency of the same operation
+        :param latency: seconds, None if the call says nothing about the service
+        :param is_success: False if the call has failed
+        """
+        with self._released:
+            self._in_flight -= 1
+            self._released.notify()
+            if not is_success:
+                self._limit = max(self._limit * self._backoff, self._min_limit)
+                return
+            if latency is None:
+                return
+
+            self._window_min_latency[op] = min(latency, self._window_min_latency.get(op, latency))
+            min_latency = self._min_latency.setdefault(op, latency)
+            if latency < min_latency:
+                self._min_latency[op] = min_latency = latency
+            self._samples += 1
+            if self._samples % self._window == 0:
+                # the best latency rises slowly, so that sustained overload is not taken for the norm
+                self._min_latency = {
+                    k: min(v, self._min_latency.get(k, v) * 1.05) for k, v in self._window_min_latency.items()
+                }
+                self._window_min_latency = {}
+
+            avg_latency = self._avg_latency.get(op, latency) * 0.9 + latency * 0.1
+            self._avg_latency[op] = avg_latency
+            # the limit follows the gradient of latency, with headroom for growth while latency is tolerable
+            gradient = min(max(min_latency * self._tolerance / avg_latency, 0.5), 1.0) if avg_latency else 1.0
+            new_limit = self._limit * gradient + self._limit ** 0.5
+            self._limit = min(max(self._limit * 0.9 + new_limit * 0.1, self._min_limit), self._max_limit)
+
+    def stats(self) -> Dict[str, int]:
+        return {'limit': self.limit, 'inFlight': self.in_flight, 'rejected': self.rejected}
+
+
+class GuardedProxy(object):
+    """
+    Proxy, which passes calls of object's methods through circuit breaker and concurrency limiter
+    """
+
+    def __init__(
+            self,
+            target: object,
+            methods: Iterable[str],
+            breaker: CircuitBreaker,
+            limiter: Optional[ConcurrencyLimiter],
+            failures: Tuple[Type[Exception], ...],
+            answers: Tuple[Type[Exception], ...],
+            make_error: Callable[[str], Exception]
+    ):
+        """
+        :param target: object to guard
+        :param methods: names of methods to guard
+        :param breaker: circuit breaker
+        :param limiter: concurrency limiter or None
+        :param failures: exceptions, which mean that the service has failed
+        :param answers: exceptions, which are answers of working service, e.g. errors of devices
+        :param make_error: creates exception, which is raised instead of call
+        """
+        self._target = target
+        self._methods = set(methods)
+        self._breaker = breaker
+        self._limiter = limiter
+        self._failures = failures
+        self._answers = answers
+        self._make_error = make_error
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name not in self._methods or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def guarded(*args, **kwargs):
+            if self._limiter is not None and not self._limiter.acquire():
+                raise self._make_error(f'too many calls of {name} in progress')
+            if not self._breaker.acquire():
+                if self._limiter is not None:
+                    self._limiter.release(name, None, True)
+                raise self._make_error(f'circuit is open, {name} is not called')
+
+            started = time.perf_counter()
+            is_success, latency = None, None
+            try:
+                result = attr(*args, **kwargs)
+                is_success, latency = True, time.perf_counter() - started
+                return result
+            except self._failures:
+                is_success = False
+                raise
+            except self._answers:
+                # latency of such answers depends on devices, not on the service
+                is_success = True
+                raise
+            finally:
+                self._breaker.record(is_success)
+                if self._limiter is not None:
+                    self._limiter.release(name, latency, is_success is not False)
+        return guarded
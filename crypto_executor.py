@@ -0,0 +1,147 @@
+"""
+Executor for CPU-bound ECDSA operations.
+
+Operations run in a process pool, so they don't block other requests of the same gunicorn worker
+and scale across cores. By default cores are divided among pools of gunicorn workers of the host.
+If the pool is disabled or broken, operations run in the calling thread.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import *
+
+from ndcloudclient.ec import *
+
+
+def run_task(f: Callable, *args) -> Tuple[bool, object]:
+    """
+    Runs f(*args) in the process pool
+
+    :return: True and result, or False and exception raised by f, so that it is told from failures of the pool
+    """
+    try:
+        return True, f(*args)
+    except Exception as e:
+        return False, e
+
+
+class CryptoExecutor(object):
+
+    _processes = 0
+    _log: Callable[[str], None] = None
+
+    def __init__(self, processes: int, workers: int = 1, log: Callable[[str], None] = print):
+        """
+        :param processes: number of processes, 0 to run operations in calling thread,
+                          -1 for number of cores divided by number of workers
+        :param workers: number of web workers on the host, each of them has its own pool
+        :param log: logging function
+        """
+        if processes < 0:
+            processes = max((os.cpu_count() or 1) // max(workers, 1), 1)
+        self._processes = processes
+        self._log = log
+        # the pool is started on first use, not at import of the web app
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = Lock()
+
+    @property
+    def is_enabled(self) -> bool:
+        return self._processes > 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                if not self._processes:
+                    raise RuntimeError('process pool is disabled')
+                # spawned, not forked, because the web worker already runs threads
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self._processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _disable(self, e: BaseException) -> None:
+        self._log(f'Crypto executor falls back to in-process execution: {e!r}')
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+            self._processes = 0
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        """
+        Stops the process pool, if it is started, cancelling pending tasks
+        """
+        with self._pool_lock:
+            pool = self._pool
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, f: Callable, *args) -> Future:
+        """
+        Submits f(*args) to the process pool, e.g. ECKeyPool refill, like Executor.submit
+        """
+        return self._get_pool().submit(f, *args)
+
+    def run(self, op: str, f: Callable, *args):
+        """
+        Runs f(*args) in the process pool and records timing of op.
+        f must be a module-level function, args and result must be picklable.
+        If the pool fails (broken pool, something can't be transferred between processes),
+        f runs in calling thread. Exceptions raised by f are re-raised.
+        """
+        started = time.perf_counter()
+        is_inline = not self._processes
+        try:
+            if not is_inline:
+                try:
+                    is_succeeded, result = self.submit(run_task, f, *args).result()
+                except BrokenProcessPool as e:
+                    self._disable(e)
+                    is_inline = True
+                except Exception as e:  # e.g. PicklingError or TypeError of arguments, pool remains usable
+                    self._log(f'Crypto executor runs {op} in-process: {e!r}')
+                    is_inline = True
+                else:
+                    if not is_succeeded:
+                        raise result
+                    return result
+            return f(*args)
+        finally:
+            self._record(op, time.perf_counter() - started, is_inline)
+
+    def _record(self, op: str, duration: float, is_inline: bool) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(op, {'count': 0, 'inline': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['inline'] += int(is_inline)
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns timing by operation: number of calls (and calls executed in-process), total and max seconds
+        """
+        with self._stats_lock:
+            return {op: dict(stats) for op, stats in self._stats.items()}
+
+    def verify_signature_from_dict(self, params: Dict[str, str], options: 'VerifySignatureOptions') -> bool:
+        return self.run('verify_signature', verify_signature_from_dict, params, options)
+
+    def sign_ec_signature_for_validate(
+            self,
+            signing_key: 'SigningKey',
+            service_id: str,
+            device_ec_public: str,
+            service_ec_public: str
+    ):
+        return self.run(
+            'sign_for_validate',
+            sign_ec_signature_for_validate,
+            signing_key, service_id, device_ec_public, service_ec_public
+        )
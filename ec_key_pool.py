@@ -0,0 +1,118 @@
+"""
+Pool of pre-generated EC signing keys for linking.
+
+Keys are generated in background by a process pool, so ECDSA work doesn't compete for GIL
+with request handling. Refill starts with start(), not at import of the web app.
+Every key is removed from the pool, when it is taken, so it is never reused.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import Executor
+from threading import Thread, Lock, Event
+from typing import *
+
+from ndcloudclient.ec import generate_ec_keys
+
+
+def generate_ec_keys_batch(count: int) -> List['SigningKey']:
+    """
+    Generates count signing keys, runs in the process pool
+    """
+    return [generate_ec_keys() for _ in range(count)]
+
+
+class ECKeyPool(object):
+
+    _size = 0
+    _refill_batch = 0
+    _refill_interval = 0.0
+    _log: Callable[[str], None] = None
+
+    def __init__(
+            self,
+            size: int,
+            refill_batch: int,
+            refill_interval: float,
+            executor: Optional[Executor] = None,
+            log: Callable[[str], None] = print
+    ):
+        """
+        :param size: number of keys to keep ready
+        :param refill_batch: number of keys generated by one task of executor
+        :param refill_interval: pause between batches in seconds, limits CPU used for refilling
+        :param executor: executor for generate_ec_keys_batch, keys are generated in refill thread, if None
+        :param log: logging function
+        """
+        self._size = max(size, 0)
+        self._refill_batch = max(refill_batch, 1)
+        self._refill_interval = max(refill_interval, 0.0)
+        self._executor = executor
+        self._log = log
+        self._keys: Deque['SigningKey'] = deque()
+        self._lock = Lock()
+        self._need_refill = Event()
+        self.taken = 0
+        self.generated_inline = 0
+        self._is_started = False
+
+    def start(self) -> None:
+        """
+        Starts refill thread
+        """
+        with self._lock:
+            if self._is_started or not self._size:
+                return
+            self._is_started = True
+        self._need_refill.set()
+        Thread(target=self._refill, name='ec-key-pool', daemon=True).start()
+
+    def take(self) -> 'SigningKey':
+        """
+        Takes key out of the pool. If the pool is empty, key is generated right here
+        """
+        with self._lock:
+            key = self._keys.popleft() if self._keys else None
+            self.taken += 1
+        self._need_refill.set()
+        if key is None:
+            with self._lock:
+                self.generated_inline += 1
+            key = generate_ec_keys()
+        return key
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self),
+            'taken': self.taken,
+            'generated_inline': self.generated_inline
+        }
+
+    def _generate(self, count: int) -> List['SigningKey']:
+        if self._executor is not None:
+            try:
+                return self._executor.submit(generate_ec_keys_batch, count).result()
+            except Exception as e:  # e.g. broken pool or keys can't be transferred between processes
+                self._log(f'EC key pool falls back to generating keys in thread: {e!r}')
+                self._executor = None
+        return generate_ec_keys_batch(count)
+
+    def _refill(self) -> None:
+        while True:
+            self._need_refill.wait()
+            self._need_refill.clear()
+            while len(self._keys) < self._size:
+                count = min(self._refill_batch, self._size - len(self._keys))
+                try:
+                    keys = self._generate(count)
+                except Exception as e:
+                    self._log(f'Failed to generate EC keys: {e!r}')
+                    time.sleep(max(self._refill_interval, 1.0))
+                    continue
+                with self._lock:
+                    self._keys.extend(keys)
+                if self._refill_interval:
+                    time.sleep(self._refill_interval)
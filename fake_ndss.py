@@ -0,0 +1,174 @@
+"""
+In-process stand-in for NDSS client, used by benchmark.py and for local runs without access to NDSS.
+
+Any valid service tag is resolved to a generated device, except tags ending with '000', which are unknown.
+Latency of every method and errors of NDSS and devices are injected according to config:
+
+    DEBUG_FAKE_NDSS = True
+    FAKE_NDSS_LATENCY = 0.05  # seconds, FAKE_NDSS_LATENCY_<METHOD> overrides it for a method
+    FAKE_NDSS_LATENCY_JITTER = 0.02  # seconds, uniformly added to latency
+    FAKE_NDSS_ERROR_RATE_NDSS = 0.001  # part of calls failing with NDSSException
+    FAKE_NDSS_ERROR_RATE_0x0300 = 0.01  # part of device calls failing with device error 0x0300, 0x0400 or 0x0143
+"""
+
+import base64
+import hashlib
+import random
+import secrets
+import time
+from threading import Lock
+from typing import *
+
+from ndcloudclient.ndss import NDSSException, KeeneticDeviceException
+
+
+DEVICE_ERRORS = {
+    '0x0300': 'No acknowledge after info request',
+    '0x0400': 'Unable to get from or to send information to device',
+    '0x0143': 'Authorization was declined by Keenetic Device'
+}
+
+
+class FakeNDSSException(NDSSException):
+
+    def __init__(self, text: str):
+        Exception.__init__(self, text)
+
+
+class FakeKeeneticDeviceException(KeeneticDeviceException):
+
+    def __init__(self, code: str):
+        Exception.__init__(self, code)
+        self.code = code
+        self.description = DEVICE_ERRORS.get(code, '')
+
+
+class FakeNDSS(object):
+
+    _callback_login = ''
+    _callback_password = ''
+    _latency = 0.0
+    _latency_jitter = 0.0
+    _ndss_error_rate = 0.0
+
+    def __init__(
+            self,
+            callback_login: str = '',
+            callback_password: str = '',
+            latency: float = 0.0,
+            latency_jitter: float = 0.0,
+            latencies: Optional[Dict[str, float]] = None,
+            ndss_error_rate: float = 0.0,
+            device_error_rates: Optional[Dict[str, float]] = None
+    ):
+        """
+        :param callback_login: expected login of linkService callbacks
+        :param callback_password: expected password of linkService callbacks
+        :param latency: delay of every call in seconds
+        :param latency_jitter: maximum random delay added to latency
+        :param latencies: delay by method name, overrides latency
+        :param ndss_error_rate: part of calls, which raise NDSSException
+        :param device_error_rates: part of device calls, which raise KeeneticDeviceException, by error code
+        """
+        self._callback_login = callback_login
+        self._callback_password = callback_password
+        self._latency = latency
+        self._latency_jitter = latency_jitter
+        self._latencies = latencies or {}
+        self._ndss_error_rate = ndss_error_rate
+        self._device_error_rates = device_error_rates or {}
+        self._bearers: Dict[str, float] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def get_token_alias(service_tag: str) -> str:
+        """
+        Returns token alias, to which service tag is resolved
+        """
+        return 'fake' + hashlib.sha256(service_tag.encode()).hexdigest()[:16]
+
+    def _call(self, method: str, is_device_call: bool) -> None:
+        time.sleep(self._latencies.get(method, self._latency) + random.uniform(0, self._latency_jitter))
+        if random.random() < self._ndss_error_rate:
+            raise FakeNDSSException(f'injected failure of {method}')
+        if is_device_call:
+            for code, rate in self._device_error_rates.items():
+                if random.random() < rate:
+                    raise FakeKeeneticDeviceException(code)
+
+    def check_callback_auth(self, authorization: Optional[str]) -> bool:
+        expected = base64.b64encode(f'{self._callback_login}:{self._callback_password}'.encode()).decode()
+        return authorization == f'Basic {expected}'
+
+    def resolve_license(self, service_tag: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        self._call('resolve_license', False)
+        if service_tag.endswith('000'):
+            return None, None, None
+        token_alias = self.get_token_alias(service_tag)
+        return token_alias, f'{token_alias}.keenetic.io', f'KN-{service_tag[:4]}'
+
+    def validate_link(
+            self,
+            device_ec_public: str,
+            service_ec_public: str,
+            token_alias: str,
+            signed_timestamp,
+            ec_signature
+    ) -> None:
+        self._call('validate_link', True)
+
+    def trust_token(
+            self,
+            token_alias: str,
+            service_ec_private: str,
+            service_ec_public: str,
+            ttl: int,
+            access_role: str,
+            user_data: str
+    ) -> Tuple[str, int]:
+        self._call('trust_token', True)
+        bearer_value = secrets.token_urlsafe(32)
+        expired_at = int(time.time()) + ttl
+        with self._lock:
+            self._bearers[bearer_value] = expired_at
+        return bearer_value, expired_at
+
+    def get_info(self, token_alias: str, bearer_value: str, explained: bool = False) -> Dict[str, str]:
+        self._call('get_info', True)
+        with self._lock:
+            # bearers created before restart of the fake are considered valid
+            is_valid = self._bearers.get(bearer_value, time.time() + 1) > time.time()
+        return {
+            'rrst_version': '2',
+            'bearer_is_valid': 'true' if is_valid else 'false',
+            'model_name': 'Keenetic Fake'
+        }
+
+
+def create_fake_ndss_from_config(config: Dict) -> FakeNDSS:
+    """
+    Creates FakeNDSS with parameters from config
+    """
+    def get_float(name: str, default: float = 0.0) -> float:
+        try:
+            return float(config.get(name, default))
+        except (TypeError, ValueError):
+            return default
+
+    return FakeNDSS(
+        callback_login=config.get('NDSS_CALLBACK_BASIC_LOGIN', ''),
+        callback_password=config.get('NDSS_CALLBACK_BASIC_PASSWORD', ''),
+        latency=get_float('FAKE_NDSS_LATENCY'),
+        latency_jitter=get_float('FAKE_NDSS_LATENCY_JITTER'),
+        latencies={
+            method: get_float(f'FAKE_NDSS_LATENCY_{method.upper()}')
+            for method in ['resolve_license', 'get_info', 'trust_token', 'validate_link']
+            if f'FAKE_NDSS_LATENCY_{method.upper()}' in config
+        },
+        ndss_error_rate=get_float('FAKE_NDSS_ERROR_RATE_NDSS'),
+        device_error_rates={
+            code: get_float(f'FAKE_NDSS_ERROR_RATE_{code}')
+            for code in DEVICE_ERRORS.keys()
+            if f'FAKE_NDSS_ERROR_RATE_{code}' in config
+        }
+    )
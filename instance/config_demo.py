@@ -1,15 +1,148 @@
 DEBUG_SKIP_CHECK_TIMESTAMP = False
 DEBUG_SKIP_CALLBACK_BASICAUTH = False
+DEBUG_SKIP_CALLBACK_SIGNATURE = False  # accept linkService callbacks without device signature, for benchmarks
+DEBUG_FAKE_NDSS = False  # use fake_ndss.py instead of NDSS, for benchmarks
+FAKE_NDSS_LATENCY = 0.05  # seconds, FAKE_NDSS_LATENCY_<METHOD> overrides it for a method
+FAKE_NDSS_LATENCY_JITTER = 0.02  # seconds, random delay added to latency
+FAKE_NDSS_ERROR_RATE_NDSS = 0  # part of calls failing with NDSSException
+FAKE_NDSS_ERROR_RATE_0x0300 = 0  # part of device calls failing with device error (0x0300, 0x0400 or 0x0143)
 
-RECORDSTORE = 'file'  # 'firestore' or 'file'
+LOG_LEVEL = 'INFO'  # 'DEBUG' to log every request
+LOG_FILENAME = ''  # JSON lines are written to stdout, if empty
+LOG_DEBUG_SAMPLE_RATE = 1.0  # part of debug records to write, from 0 to 1
+LOG_DEBUG_DATA_LIMIT = 1024  # characters of request body in debug records
+LOG_QUEUE_SIZE = 10000  # records waiting for writer thread, newer records are dropped
+
+RECORDSTORE = 'file'  # 'firestore', 'redis', 'sqlite' or 'file'
 RECORDSTORE_DIRPREFIX = '/srv/cloud-link-service-python-example/data'
+RECORDSTORE_SQLITE_FILENAME = '/srv/cloud-link-service-python-example/data/records.sqlite'
+RECORDSTORE_REDIS_URL = 'redis://localhost:6379/0'  # redis://[[user]:password@]host[:port][/db], rediss:// for TLS
+RECORDSTORE_REDIS_POOL_SIZE = 10  # connections of each gunicorn worker
+STARTUP_WAIT = 10  # seconds, requests wait for startup of new worker, then get 503
+STARTUP_RETRY_INTERVAL = 5  # seconds, failed startup steps (e.g. record store check) are retried
+RECORDSTORE_CACHE = False  # cache records of any RECORDSTORE in memory of each gunicorn worker
+RECORDSTORE_CACHE_SIZE = 10000  # records of each type
+RECORDSTORE_CACHE_EC_TTL = 300  # seconds, EC record may be replaced by re-linking in other worker
+RECORDSTORE_CACHE_BEARER_TTL = 30  # seconds, bearers may be changed by other workers
+RECORDSTORE_CACHE_NEGATIVE_TTL = 5  # seconds, for records which were not found
+RECORDSTORE_WRITE_BEHIND = False  # save records to RECORDSTORE in background, through local journal
+# Note, with write-behind other gunicorn workers don't see saved records until they are written,
+# so concurrent searches of one device in different workers may create bearers twice
+RECORDSTORE_JOURNAL_DIRECTORY = '/srv/cloud-link-service-python-example/data/journal'  # shared by gunicorn workers
+RECORDSTORE_JOURNAL_FSYNC = True  # False is faster, but records of the last seconds may be lost on power failure
+RECORDSTORE_JOURNAL_SEGMENT_SIZE = 10000  # lines in journal file, flushed files are deleted
+RECORDSTORE_WRITE_BEHIND_INTERVAL = 0.05  # seconds between writes, other workers see saved records after it
+RECORDSTORE_WRITE_BEHIND_BATCH = 500  # records in one write
+RECORDSTORE_WRITE_BEHIND_MAXSIZE = 10000  # saves wait, if so many records are not written yet
 
 FIRESTORE_PROJECT = 'your-gcp-project...'
 
+LINKQUEUE_WORKERS = 4  # threads validating links in each gunicorn worker
+LINKQUEUE_SIZE = 100  # linkService answers 503, if there are more jobs waiting
+LINKQUEUE_RETRIES = 3  # retries after NDSSException
+LINKQUEUE_RETRY_BACKOFF = 2  # seconds before first retry, doubled for every next one
+LINKQUEUE_RETRY_AFTER = 10  # Retry-After for 503 answer
+LINKQUEUE_RESUME_PENDING = True  # validate pending records left after restart
+LINKQUEUE_CLAIM_TTL = 3600  # seconds, after which job queued by a live process on other host is resumed
+LINKQUEUE_FAILED_TTL = 604800  # seconds, after which pending records of failed jobs are deleted
+
+LINKSERVICE_REPLAY_TTL = 600  # seconds, retries of linkService callback are answered from cache
+LINKSERVICE_REPLAY_CACHE_SIZE = 10000
+LINKSERVICE_REPLAY_CACHE_BACKEND = 'memory'  # 'memory' or 'sqlite' (shared by gunicorn workers)
+LINKSERVICE_REPLAY_CACHE_FILENAME = '/srv/cloud-link-service-python-example/data/replay_cache.sqlite'
+
+ECKEYPOOL_SIZE = 20  # pre-generated signing keys in each gunicorn worker, 0 to generate keys while linking
+ECKEYPOOL_REFILL_BATCH = 5  # keys generated by one task of process pool
+ECKEYPOOL_REFILL_INTERVAL = 0.1  # seconds between refill batches
+
+CRYPTO_PROCESSES = -1  # processes for ECDSA operations, -1 for cores / WORKERS, 0 to run them in request threads
+WORKERS = 2  # gunicorn workers of the host, $WEB_CONCURRENCY by default
+
+BEARER_TRUST_WINDOW = 300  # seconds, verified bearer is returned from store without asking device
+BEARER_STALE_WINDOW = 3600  # seconds after trust window, bearer is returned and verified in background
+BEARER_REVALIDATE_WORKERS = 2
+
+BEARER_REFRESH_ENABLED = False  # renew bearers in background before they expire
+BEARER_REFRESH_WINDOW = 86400  # seconds before timestampExpires
+BEARER_REFRESH_RATE = 1  # renewals per second
+BEARER_REFRESH_RETRY_DELAY = 600  # seconds after failed renewal
+BEARER_REFRESH_RESCAN_INTERVAL = 3600  # seconds between scans of record store for new bearers
+BEARER_REFRESH_IDLE = 604800  # seconds without searches, after which bearer is not renewed, 0 to renew always
+BEARER_REFRESH_STATE_FILENAME = '/srv/cloud-link-service-python-example/data/bearer_refresher.json'
+
+SEARCH_PIPELINED = False  # load records in parallel and save new bearer while device is asked, for remote stores
+SEARCH_PIPELINE_WORKERS = 8  # threads for pipelined record store calls in each gunicorn worker
+# answer 0x300 for not linked devices without record store lookup, list them in /admin/devices
+LINKED_INDEX_ENABLED = False
+LINKED_INDEX_DIRECTORY = '/srv/cloud-link-service-python-example/data/index'  # shared by gunicorn workers
+# only one worker builds index, '' for file in LINKED_INDEX_DIRECTORY
+LINKED_INDEX_LOCKFILE = '/srv/cloud-link-service-python-example/data/index.lock'
+LINKED_INDEX_REBUILD_INTERVAL = 3600  # seconds, devices linked by other hosts become known after rebuild or search
+# Note, with 'firestore' or 'redis' RECORDSTORE shared by hosts, index doesn't answer 0x300 by itself
+BULK_SEARCH_WORKERS = 8  # threads for /admin/search in each gunicorn worker, shared by all bulk requests
+BULK_SEARCH_CONCURRENCY = 4  # licenses of one bulk request searched at once
+BULK_SEARCH_MAX_LICENSES = 10000  # licenses of one bulk request, the rest is skipped
+SEARCH_RATE_LIMIT_ENABLED = False  # /search answers 0x429 with Retry-After above the limits
+SEARCH_RATE_LIMIT_BACKEND = 'sqlite'  # 'memory' (limits of each gunicorn worker) or 'sqlite' (shared by workers)
+SEARCH_RATE_LIMIT_FILENAME = '/srv/cloud-link-service-python-example/data/rate_limit.sqlite'
+SEARCH_RATE_LIMIT_SIZE = 100000  # clients or devices, whose buckets are kept
+SEARCH_RATE_LIMIT_CLIENT_RATE = 10  # searches per second of each caller address
+SEARCH_RATE_LIMIT_CLIENT_BURST = 20  # searches of caller at once
+SEARCH_RATE_LIMIT_PROXY_COUNT = 0  # trusted proxies before the service, caller address is taken from X-Forwarded-For
+SEARCH_RATE_LIMIT_DEVICE_RATE = 0.2  # searches per second of each device, including bulk search
+SEARCH_RATE_LIMIT_DEVICE_BURST = 5  # searches of device at once
+
+SINGLEFLIGHT_LOCK_DIRECTORY = '/srv/cloud-link-service-python-example/data/locks'  # '' to coalesce within process
+SINGLEFLIGHT_LOCK_STRIPES = 1024  # number of lock files
+SINGLEFLIGHT_LOCK_TIMEOUT = 60  # seconds to wait for other gunicorn worker
+
+# shared by gunicorn workers, '' for per-process metrics
+METRICS_DIRECTORY = '/srv/cloud-link-service-python-example/data/metrics'
+METRICS_FLUSH_INTERVAL = 5  # seconds between writing metrics of a worker
+
+ADMIN_BASIC_LOGIN = ''  # admin endpoints (/admin/...) are disabled, if empty
+ADMIN_BASIC_PASSWORD = ''
+
+PROFILING_ENABLED = False  # may be changed at runtime with POST /admin/profiling
+PROFILING_SAMPLE_RATE = 0.01  # part of requests to trace
+PROFILING_SLOW_THRESHOLD = 1.0  # seconds, traces of slower requests are kept
+PROFILING_SAMPLE_INTERVAL = 0.005  # seconds between stack samples of traced requests
+PROFILING_SLOW_TRACES = 50  # slow traces kept by each gunicorn worker
+PROFILING_DIRECTORY = '/srv/cloud-link-service-python-example/data/profiling'  # shared by gunicorn workers
+
 NDSS_SERVICE_ID = '<service-id received from Keenetic>'
 NDSS_SERVER = '<NDSS API URL received from Keenetic>'
 NDSS_CRT = '4096-KNT-root-ca'
 NDSS_TIMEOUT = 30
+NDSS_HTTP_POOL = True  # keep connections to NDSS alive and share them between threads
+NDSS_HTTP_POOL_SIZE = 10  # connections in each gunicorn worker, at least LINKQUEUE_WORKERS + 1
+NDSS_HTTP_POOL_BLOCK = True  # wait for free connection instead of opening extra one
+NDSS_CALL_POOL_SIZE = 100  # threads for NDSS calls in each gunicorn worker, stuck calls included, 0 for no deadlines
+NDSS_CALL_TIMEOUT = 30  # seconds, deadline of NDSS call, after which it fails with 0x100
+NDSS_CALL_TIMEOUT_GET_INFO = 10  # deadline of a single method, also _RESOLVE_LICENSE, _TRUST_TOKEN, _VALIDATE_LINK
+
+NDSS_CIRCUIT_ENABLED = True  # fail NDSS calls immediately with 0x100 while NDSS is failing
+NDSS_CIRCUIT_FAILURES = 5  # consecutive failures, which open circuit
+NDSS_CIRCUIT_OPEN_SECONDS = 30  # seconds before probe calls
+NDSS_CIRCUIT_HALF_OPEN_SUCCESSES = 5  # successful probes, which close circuit
+NDSS_LIMIT_ENABLED = True  # adapt number of NDSS calls in progress to NDSS latency
+NDSS_LIMIT_INITIAL = 20  # calls in progress in each gunicorn worker
+NDSS_LIMIT_MIN = 2
+NDSS_LIMIT_MAX = 100
+NDSS_LIMIT_LATENCY_TOLERANCE = 2.0  # latency this times higher than the best one decreases the limit
+NDSS_LIMIT_WAIT = 1.0  # seconds, call above the limit waits for free slot before it fails with 0x100
+BEARER_SERVE_ON_NDSS_FAILURE = True  # return verified, not expired bearer without verification while NDSS fails
+
+# main_async.py only
+# threads for searches, record store and EC operations, i.e. maximum searches in progress
+ASYNC_BLOCKING_POOL_SIZE = 100
+
+NDSS_RESOLVE_CACHE_BACKEND = 'memory'  # 'memory' or 'sqlite' (shared by gunicorn workers)
+NDSS_RESOLVE_CACHE_FILENAME = '/srv/cloud-link-service-python-example/data/resolve_cache.sqlite'
+NDSS_RESOLVE_CACHE_SIZE = 10000
+NDSS_RESOLVE_CACHE_TTL = 3600  # seconds
+NDSS_RESOLVE_CACHE_NEGATIVE_TTL = 60  # seconds, for service tags which were not found
+NDSS_RESOLVE_CACHE_STALE_TTL = 86400  # seconds after expiration, while result is returned if NDSS fails
 
 NDSS_CALLBACK_BASIC_LOGIN = '<login>'
 NDSS_CALLBACK_BASIC_PASSWORD = '<password>'
@@ -0,0 +1,259 @@
+"""
+Bounded worker pool for linkService validation.
+
+Jobs are persisted as pending EC records in RecordStore before they are queued,
+so validation which was in progress during restart can be resumed from storage.
+Pending records are claimed by the process, which has queued the job (claimOwner is host and PID),
+so only records of dead processes, unclaimed records and records with expired claims are resumed.
+Jobs, which have failed for good (declined by NDSS, or out of retries), are marked in their pending records
+with timestampFailed, so they are not resumed again, and such records are deleted after a while.
+Jobs run in context variables of the submitting request, e.g. with its request ID for logging.
+"""
+
+import contextvars
+import fcntl
+import os
+import socket
+import tempfile
+import time
+from datetime import datetime
+from queue import Queue, Full
+from threading import Thread, Lock
+from typing import *
+
+from record_store import RecordStore
+
+
+class LinkJob(object):
+
+    __slots__ = ('service_id', 'device_ec_public', 'token_alias', 'context')
+
+    def __init__(self, service_id: str, device_ec_public: str, token_alias: str):
+        self.service_id = service_id
+        self.device_ec_public = device_ec_public
+        self.token_alias = token_alias
+        self.context = contextvars.copy_context()
+
+
+class LinkQueue(object):
+
+    _rs: RecordStore = None
+    _handler: Callable[..., None] = None
+    _retry_on: Tuple[Type[Exception], ...] = ()
+    _retries = 0
+    _backoff = 0.0
+    _claim_ttl = 0.0
+    _failed_ttl = 0.0
+    _owner = ''
+    _log: Callable[[str], None] = None
+    _resume_lock_fd: Optional[int] = None
+
+    def __init__(
+            self,
+            rs: RecordStore,
+            handler: Callable[..., None],
+            workers: int,
+            size: int,
+            retries: int,
+            backoff: float,
+            retry_on: Tuple[Type[Exception], ...],
+            claim_ttl: float = 3600,
+            failed_ttl: float = 7 * 86400,
+            log: Callable[[str], None] = print
+    ):
+        """
+        :param rs: record store, used to persist queued jobs as pending records
+        :param handler: called by workers as handler(service_id, device_ec_public, token_alias)
+        :param workers: number of worker threads
+        :param size: maximum number of jobs waiting in queue
+        :param retries: how many times job is repeated after exception from retry_on
+        :param backoff: delay before first retry in seconds, doubled for every next one
+        :param retry_on: exceptions which are considered temporary
+        :param claim_ttl: seconds, after which job of a live process may be resumed by other process
+        :param failed_ttl: seconds, after which pending record of failed job is deleted by resume_pending
+        :param log: logging function
+        """
+        self._rs = rs
+        self._handler = handler
+        self._retries = max(retries, 0)
+        self._backoff = max(backoff, 0.0)
+        self._retry_on = retry_on
+        self._claim_ttl = claim_ttl
+        self._failed_ttl = failed_ttl
+        self._owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._log = log
+        self._queue = Queue(maxsize=max(size, 1))
+        self._submit_lock = Lock()
+        self._reserved = 0
+        self._busy = 0
+        self._busy_lock = Lock()
+        for i in range(max(workers, 1)):
+            Thread(target=self._work, name=f'link-worker-{i}', daemon=True).start()
+
+    def qsize(self) -> int:
+        """
+        Returns number of jobs waiting in queue
+        """
+        return self._queue.qsize()
+
+    def busy(self) -> int:
+        """
+        Returns number of jobs being processed by workers right now
+        """
+        return self._busy
+
+    def submit(self, service_id: str, device_ec_public: str, token_alias: str) -> bool:
+        """
+        Persists job as pending record and puts it to queue
+
+        :return: False if queue is full, caller should ask to repeat the request later
+        """
+        # only a slot is reserved under the lock, the record is saved outside of it
+        with self._submit_lock:
+            if self._queue.qsize() + self._reserved >= self._queue.maxsize:
+                return False
+            self._reserved += 1
+        try:
+            # keys are not generated yet, pending record only keeps the job for resume_pending
+            record = RecordStore.prepare_ec_record(token_alias, '', '', device_ec_public)
+            self._rs.save_pending_ec_record(token_alias, self._claim(record))
+            # resumed jobs are put without reservation, so the queue may be filled meanwhile
+            self._queue.put_nowait(LinkJob(service_id, device_ec_public, token_alias))
+        except Full:
+            return False  # the pending record is resumed after restart, if NDSS doesn't repeat the callback
+        finally:
+            with self._submit_lock:
+                self._reserved -= 1
+        return True
+
+    def resume_pending(self, lock_filename: str = '') -> bool:
+        """
+        Puts pending records of dead processes back to queue, deletes old records of failed jobs.
+
+        Only one process (e.g. one of gunicorn workers) resumes jobs: it holds the lock file
+        until exit, others skip resuming.
+
+        :param lock_filename: lock file shared by processes of this service
+        :return: True if this process has taken care of pending records
+        """
+        if self._resume_lock_fd is None:
+            if not lock_filename:
+                lock_filename = os.path.join(tempfile.gettempdir(), f'link-queue-{self._rs.service_id}.lock')
+            fd = os.open(lock_filename, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            # the lock is kept, also when loading of records below fails and resuming is retried
+            self._resume_lock_fd = fd
+
+        now = int(time.time())
+        records = []
+        for record in self._rs.load_pending_ec_records():
+            if record.get('timestampFailed'):
+                if now - int(record['timestampFailed']) >= self._failed_ttl:
+                    self._delete_failed(record)
+            elif self._is_claim_expired(record, now):
+                records.append(record)
+        if records:
+            self._log(f'Resuming {len(records)} pending link jobs')
+            # queue may be smaller than number of pending records, so waiting for free slots in background
+            Thread(target=self._put_all, args=(records,), name='link-resume', daemon=True).start()
+        return True
+
+    def _claim(self, record: Dict) -> Dict:
+        record['claimOwner'] = self._owner
+        record['timestampClaimed'] = int(time.time())
+        return record
+
+    def _is_claim_expired(self, record: Dict, now: int) -> bool:
+        """
+        Checks, that job of pending record is not queued or running in a live process
+        """
+        owner = record.get('claimOwner')
+        if not owner or now - int(record.get('timestampClaimed') or 0) >= self._claim_ttl:
+            return True
+        if owner == self._owner:
+            return False
+        host, _, pid = owner.rpartition(':')
+        if host != socket.gethostname():
+            return False  # liveness of other hosts is unknown, so waiting for claim_ttl
+        try:
+            os.kill(int(pid), 0)
+        except (ProcessLookupError, ValueError):
+            return True
+        except PermissionError:
+            return False  # process of other user
+        return False
+
+    def _delete_failed(self, record: Dict) -> None:
+        token_alias = record.get('tokenAlias')
+        if not token_alias:
+            return
+        try:
+            self._rs.delete_pending_ec_record(token_alias)
+        except Exception as e:  # deleted by the next resume then
+            self._log(f'Failed to delete pending record of failed link job for {token_alias}: {e!r}')
+
+    def _put_all(self, records: List[Dict]) -> None:
+        for record in records:
+            token_alias = record.get('tokenAlias')
+            device_ec_public = record.get('deviceEcPublic')
+            if not token_alias or not device_ec_public:
+                continue
+            try:
+                self._rs.save_pending_ec_record(token_alias, self._claim(record))
+            except Exception as e:  # not claimed, so it is resumed by the next resume instead
+                self._log(f'Failed to claim pending link job for {token_alias}: {e!r}')
+                continue
+            self._queue.put(LinkJob(self._rs.service_id, device_ec_public, token_alias))
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            with self._busy_lock:
+                self._busy += 1
+            try:
+                self._run(job)
+            finally:
+                with self._busy_lock:
+                    self._busy -= 1
+                self._queue.task_done()
+
+    def _run(self, job: LinkJob) -> None:
+        attempt = 0
+        while True:
+            try:
+                job.context.run(
+                    self._handler,
+                    service_id=job.service_id,
+                    device_ec_public=job.device_ec_public,
+                    token_alias=job.token_alias
+                )
+                return
+            except self._retry_on as e:
+                if attempt >= self._retries:
+                    self._log(f'Giving up link job for {job.token_alias} after {attempt + 1} attempts: {e!r}')
+                    self._mark_failed(job)
+                    return
+                delay = self._backoff * (2 ** attempt)
+                attempt += 1
+                self._log(f'Retrying link job for {job.token_alias} in {delay}s ({attempt}/{self._retries})')
+                time.sleep(delay)
+            except Exception as e:  # worker thread must survive any job
+                self._log(f'Link job for {job.token_alias} failed: {e!r}')
+                self._mark_failed(job)
+                return
+
+    def _mark_failed(self, job: LinkJob) -> None:
+        """
+        Replaces pending record of the job with failed one, which is not resumed.
+        Keys are dropped, device has to start linking again
+        """
+        record = RecordStore.prepare_ec_record(job.token_alias, '', '', job.device_ec_public)
+        record['timestampFailed'] = int(datetime.now().timestamp())
+        try:
+            self._rs.save_pending_ec_record(job.token_alias, record)
+        except Exception as e:  # the job is resumed after restart then
+            self._log(f'Failed to mark link job for {job.token_alias} as failed: {e!r}')
@@ -0,0 +1,331 @@
+"""
+Index of token aliases of linked devices, shared by gunicorn workers through memory-mapped file.
+
+The index lets search answer 0x300 (device is not linked) without record store lookup,
+and lets admin count and list linked devices without reading every record.
+
+Base file keeps sorted token aliases: header with generation and count, offsets of aliases and their bytes.
+It is built from record store by one process (the one holding lock file) at start and periodically,
+and is mapped into memory of every process. Devices linked after the build are appended
+to delta file of the same generation, which every process reads incrementally.
+
+Devices linked before the first build is finished are appended to delta of generation 0,
+which is merged by the build.
+
+Note, devices linked by other hosts sharing record store are known after the next build only,
+or after they are found in record store by search. So for shared record store the index is not complete,
+and it never tells that device is not linked.
+"""
+
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import time
+from threading import Thread, Lock
+from typing import *
+
+
+_MAGIC = b'LNKIDX01'
+_HEADER = struct.Struct('<8sQQ')  # magic, generation, count
+_OFFSET = struct.Struct('<Q')
+
+
+class _Base(object):
+    """
+    Memory-mapped base file
+    """
+
+    __slots__ = ('generation', 'count', 'inode', '_map', '_offsets', '_data_start')
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self.count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(f'{filename} is not an index file')
+        self._offsets = memoryview(self._map)[_HEADER.size:_HEADER.size + (self.count + 1) * _OFFSET.size].cast('Q')
+        self._data_start = _HEADER.size + (self.count + 1) * _OFFSET.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        return self._map[self._data_start + self._offsets[i]:self._data_start + self._offsets[i + 1]]
+
+    def contains(self, token_alias: bytes) -> bool:
+        i = bisect.bisect_left(self, token_alias)
+        return i < self.count and self[i] == token_alias
+
+
+class LinkedIndex(object):
+
+    _directory = ''
+    _rebuild_interval = 0.0
+    _is_complete = True
+    _log: Callable[[str], None] = None
+
+    def __init__(
+            self,
+            directory: str,
+            rebuild_interval: float = 3600,
+            is_complete: bool = True,
+            log: Callable[[str], None] = print
+    ):
+        """
+        :param directory: directory for index files shared by processes of this service
+        :param rebuild_interval: seconds between builds of index from record store
+        :param is_complete: False if record store is shared with other hosts, which link devices too
+        :param log: logging function
+        """
+        self._directory = directory
+        self._rebuild_interval = rebuild_interval
+        self._is_complete = is_complete
+        self._log = log
+        self._lock = Lock()
+        self._base: Optional[_Base] = None
+        # aliases from delta file, which are missing in base, sorted
+        self._delta: List[bytes] = []
+        self._delta_offset = 0
+        self._lock_fd: Optional[int] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _base_filename(self) -> str:
+        return os.path.join(self._directory, 'linked.idx')
+
+    def _delta_filename(self, generation: int) -> str:
+        return os.path.join(self._directory, f'linked-{generation}.delta')
+
+    def _refresh(self) -> None:
+        """
+        Maps new base file, if it has been rebuilt, and reads new part of delta file
+        """
+        with self._lock:
+            try:
+                inode = os.stat(self._base_filename()).st_ino
+            except OSError:
+                return
+            if self._base is None or self._base.inode != inode:
+                try:
+                    self._base = _Base(self._base_filename())
+                except (OSError, ValueError) as e:
+                    self._log(f'Failed to load index of linked devices: {e!r}')
+                    return
+                self._delta = []
+                self._delta_offset = 0
+            try:
+                with open(self._delta_filename(self._base.generation), 'rb') as f:
+                    f.seek(self._delta_offset)
+                    data = f.read()
+            except OSError:
+                return
+            # the last line may be still written by other process
+            data = data[:data.rfind(b'\n') + 1]
+            self._delta_offset += len(data)
+            for token_alias in data.split(b'\n'):
+                if not token_alias or self._base.contains(token_alias):
+                    continue
+                i = bisect.bisect_left(self._delta, token_alias)
+                if i == len(self._delta) or self._delta[i] != token_alias:
+                    self._delta.insert(i, token_alias)
+
+    def is_ready(self) -> bool:
+        if self._base is None:
+            self._refresh()
+        return self._base is not None
+
+    def may_be_linked(self, token_alias: str) -> bool:
+        """
+        Checks, if device may be linked. False means, that it is surely not linked.
+        True is returned, while index is not built yet, and always for index, which is not complete
+        """
+        return self.contains(token_alias) or self._base is None or not self._is_complete
+
+    def contains(self, token_alias: str) -> bool:
+        """
+        Checks, if device is in the index
+        """
+        key = token_alias.encode()
+        for attempt in range(2):
+            with self._lock:
+                base, delta = self._base, self._delta
+                if base is not None:
+                    if base.contains(key):
+                        return True
+                    i = bisect.bisect_left(delta, key)
+                    if i < len(delta) and delta[i] == key:
+                        return True
+            if attempt == 0:
+                # the device might have been linked by other process since the last refresh
+                self._refresh()
+        return False
+
+    def add_if_missing(self, token_alias: str) -> None:
+        """
+        Adds device, which has been found linked in record store, e.g. linked by other host
+        """
+        # before the first build the device is found by the build itself
+        if not self.contains(token_alias) and self._base is not None:
+            self.add(token_alias)
+
+    def count(self) -> Optional[int]:
+        """
+        Returns number of linked devices, None if index is not built yet
+        """
+        self._refresh()
+        with self._lock:
+            if self._base is None:
+                return None
+            return len(self._base) + len(self._delta)
+
+    def page(self, after: str = '', limit: int = 100) -> Optional[List[str]]:
+        """
+        Returns token aliases of linked devices in sorted order, None if index is not built yet
+
+        :param after: token alias of the last item of previous page, '' for the first page
+        :param limit: maximum number of items
+        """
+        self._refresh()
+        with self._lock:
+            base, delta = self._base, self._delta
+            if base is None:
+                return None
+            key = after.encode()
+            i = bisect.bisect_right(base, key) if after else 0
+            j = bisect.bisect_right(delta, key) if after else 0
+            result = []
+            while len(result) < limit and (i < len(base) or j < len(delta)):
+                if j >= len(delta) or (i < len(base) and base[i] < delta[j]):
+                    result.append(base[i])
+                    i += 1
+                else:
+                    result.append(delta[j])
+                    j += 1
+        return [x.decode() for x in result]
+
+    def _append(self, generation: int, token_alias: str) -> None:
+        fd = os.open(self._delta_filename(generation), os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, token_alias.encode() + b'\n')
+        finally:
+            os.close(fd)
+
+    def add(self, token_alias: str) -> None:
+        """
+        Adds linked device to index of all processes
+        """
+        if '\n' in token_alias:
+            return
+        self._refresh()
+        base = self._base
+        # before the first build the device is kept in delta of generation 0, the build merges it
+        generation = base.generation if base is not None else 0
+        self._append(generation, token_alias)
+        # if base has been rebuilt meanwhile, the device might have been missed by it
+        self._refresh()
+        if self._base is not None and self._base.generation != generation:
+            self._append(self._base.generation, token_alias)
+            self._refresh()
+
+    def start(self, load_token_aliases: Callable[[], Iterable[str]], lock_filename: str = '') -> bool:
+        """
+        Builds index and rebuilds it periodically in background thread.
+
+        Only one process builds index: it holds the lock file until exit, others use its index.
+
+        :param load_token_aliases: returns token aliases of all linked devices from record store
+        :param lock_filename: lock file shared by processes of this service, next to base file by default
+        :return: True if this process builds index
+        """
+        if not lock_filename:
+            lock_filename = f'{self._base_filename()}.lock'
+        fd = os.open(lock_filename, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        Thread(target=self._build_loop, args=(load_token_aliases,), name='linked-index', daemon=True).start()
+        return True
+
+    def _build_loop(self, load_token_aliases: Callable[[], Iterable[str]]) -> None:
+        while True:
+            try:
+                self.build(load_token_aliases)
+            except Exception as e:  # the thread must survive failures of record store
+                self._log(f'Failed to build index of linked devices: {e!r}')
+            time.sleep(self._rebuild_interval)
+
+    def build(self, load_token_aliases: Callable[[], Iterable[str]]) -> None:
+        """
+        Writes new base file with token aliases from record store and from current delta file
+        """
+        started = time.monotonic()
+        self._refresh()
+        old = self._base
+        old_generation = old.generation if old is not None else 0
+        generation = old_generation + 1
+        # new delta is created before aliases are read, so that no device is missed by both
+        open(self._delta_filename(generation), 'ab').close()
+
+        token_aliases = set(x.encode() for x in load_token_aliases() if x and '\n' not in x)
+        self._refresh()
+        with self._lock:
+            if old is not None:
+                token_aliases.update(self._delta)
+                delta_offset = self._delta_offset
+            else:
+                delta_offset = 0  # the whole delta of generation 0 is copied below
+        token_aliases = sorted(token_aliases)
+
+        offsets = [0]
+        for token_alias in token_aliases:
+            offsets.append(offsets[-1] + len(token_alias))
+        filename = self._base_filename()
+        with open(f'{filename}.tmp', 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, generation, len(token_aliases)))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            f.write(b''.join(token_aliases))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{filename}.tmp', filename)
+
+        # devices appended to old delta after it was read, by processes which haven't seen new base yet
+        try:
+            with open(self._delta_filename(old_generation), 'rb') as f:
+                f.seek(delta_offset)
+                late = [x for x in f.read().split(b'\n') if x]
+        except OSError:
+            late = []
+        for token_alias in late:
+            self._append(generation, token_alias.decode())
+        for name in os.listdir(self._directory):
+            if name.startswith('linked-') and name.endswith('.delta') and name != f'linked-{generation}.delta':
+                os.remove(os.path.join(self._directory, name))
+        self._refresh()
+        self._log(f'Built index of {len(token_aliases)} linked devices in {time.monotonic() - started:.2f}s')
+
+
+class IndexingProxy(object):
+    """
+    Proxy of RecordStore, which adds devices to index, when their active records are saved
+    """
+
+    def __init__(self, target: object, index: LinkedIndex):
+        self._target = target
+        self._index = index
+
+    def save_active_ec_record(self, token_alias: str, content: Union[str, Dict]) -> None:
+        self._target.save_active_ec_record(token_alias, content)
+        self._index.add(token_alias)
+
+    def save_active_ec_records(self, contents: Dict[str, Union[str, Dict]]) -> None:
+        self._target.save_active_ec_records(contents)
+        for token_alias in contents.keys():
+            self._index.add(token_alias)
+
+    def __getattr__(self, name: str):
+        return getattr(self._target, name)
@@ -1,11 +1,33 @@
+import contextvars
+import hashlib
+import hmac
 import json
-from threading import Thread
-from flask import Flask, request, jsonify, Response
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from datetime import datetime
+from threading import Lock
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from functools import wraps
 
 from ndcloudclient.ec import *
 from ndcloudclient.ndss import NDSS, NDSSException, KeeneticDeviceException
 from record_store import RecordStore
+from link_queue import LinkQueue
+from ttl_cache import create_cache, MISSING
+from single_flight import SingleFlight
+from ec_key_pool import ECKeyPool
+from crypto_executor import CryptoExecutor
+from bearer_refresher import BearerRefresher
+from metrics import Registry, InstrumentedProxy
+from circuit_breaker import CircuitBreaker, ConcurrencyLimiter, GuardedProxy
+from call_deadline import DeadlineProxy
+from structured_log import setup_logging, request_id_var
+from profiling import Profiler
+from rate_limit import create_rate_limiter, format_retry_after
+from startup import Startup, Lazy
 
 
 app = Flask(__name__, instance_relative_config=True)
@@ -35,14 +57,189 @@ def get_params_from_config_by_prefix(prefix: str) -> Dict[str, str]:
     return {str(k): str(v) for k, v in config.items() if str(k).startswith(prefix)}
 
 
-def log(message: str) -> None:
+def get_int_from_config(name: str, default: int) -> int:
     """
-    Logs message
+    Returns integer parameter from config, or default if it is missing or malformed
     """
-    print(message)
+    try:
+        return int(config.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_float_from_config(name: str, default: float) -> float:
+    """
+    Returns float parameter from config, or default if it is missing or malformed
+    """
+    try:
+        return float(config.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+logger, log_handler = setup_logging(
+    'cloud-link-service',
+    level=config.get('LOG_LEVEL', 'INFO'),
+    filename=config.get('LOG_FILENAME', ''),
+    debug_sample_rate=get_float_from_config('LOG_DEBUG_SAMPLE_RATE', 1.0),
+    queue_size=get_int_from_config('LOG_QUEUE_SIZE', 10000)
+)
+log_debug_data_limit = get_int_from_config('LOG_DEBUG_DATA_LIMIT', 1024)
+
+
+def log(message: str, level: int = logging.INFO, **fields) -> None:
+    """
+    Logs message with optional structured fields
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields} if fields else None)
+
+
+# metrics of gunicorn workers are merged through snapshot files in METRICS_DIRECTORY
+metrics_registry = Registry(
+    config.get('METRICS_DIRECTORY', ''),
+    flush_interval=get_float_from_config('METRICS_FLUSH_INTERVAL', 5)
+)
+ndss_latency = metrics_registry.histogram('ndss_request_duration_seconds', 'Duration of NDSS API calls')
+recordstore_latency = metrics_registry.histogram(
+    'recordstore_request_duration_seconds', 'Duration of record store calls'
+)
+http_latency = metrics_registry.histogram('http_request_duration_seconds', 'Duration of HTTP requests')
+http_errors = metrics_registry.counter('http_errors_total', 'Error answers by code')
+
+# connections to NDSS are kept alive and shared by all threads of the worker
+ndss_session: Optional['PooledSession'] = None
+
+
+def create_ndss_client() -> object:
+    """
+    Creates NDSS client, it is called by startup thread or by the first NDSS call
+    """
+    global ndss_session
+    if config.get('DEBUG_FAKE_NDSS'):
+        # local runs and benchmarks without access to NDSS
+        from fake_ndss import create_fake_ndss_from_config
+        return create_fake_ndss_from_config(config)
+
+    if not config.get('NDSS_HTTP_POOL', True):
+        return NDSS(get_params_from_config_by_prefix('NDSS_'))
+
+    from ndss_session import PooledSession, create_client_with_session
+    session = PooledSession(
+        pool_size=get_int_from_config('NDSS_HTTP_POOL_SIZE', 10),
+        pool_block=bool(config.get('NDSS_HTTP_POOL_BLOCK', True))
+    )
+    client, is_pooled = create_client_with_session(NDSS, get_params_from_config_by_prefix('NDSS_'), session)
+    if is_pooled:
+        ndss_session = session
+    else:
+        session.close()
+        log('NDSS client has no session hook, stock client is used without connection pool', logging.WARNING)
+    return client
+
+
+class NDSSUnavailableException(NDSSException):
+    """
+    Raised instead of NDSS call, when NDSS is failing, too many calls are in progress or the call has timed out
+    """
+
+    def __init__(self, text: str):
+        Exception.__init__(self, text)
+
+
+ndss_client_lazy = Lazy(create_ndss_client)
+ndss_client = InstrumentedProxy(
+    ndss_client_lazy,
+    ndss_latency,
+    ['resolve_license', 'get_info', 'trust_token', 'validate_link']
+)
+
+# a stuck NDSS call fails after its deadline, so it doesn't hold a request thread or coroutine for long
+ndss_deadline: Optional[DeadlineProxy] = None
+if get_int_from_config('NDSS_CALL_POOL_SIZE', 100) > 0:
+    ndss_deadline = DeadlineProxy(
+        ndss_client,
+        ['resolve_license', 'get_info', 'trust_token', 'validate_link'],
+        pool_size=get_int_from_config('NDSS_CALL_POOL_SIZE', 100),
+        timeout=get_float_from_config('NDSS_CALL_TIMEOUT', get_float_from_config('NDSS_TIMEOUT', 30)),
+        timeouts={
+            method: get_float_from_config(f'NDSS_CALL_TIMEOUT_{method.upper()}', -1)
+            for method in ['resolve_license', 'get_info', 'trust_token', 'validate_link']
+        },
+        make_error=NDSSUnavailableException
+    )
+    ndss_client = ndss_deadline
+
+# when NDSS degrades, calls fail immediately instead of waiting for NDSS_TIMEOUT
+ndss_breaker: Optional[CircuitBreaker] = None
+ndss_limiter: Optional[ConcurrencyLimiter] = None
+if config.get('NDSS_CIRCUIT_ENABLED', True):
+    ndss_breaker = CircuitBreaker(
+        failure_threshold=get_int_from_config('NDSS_CIRCUIT_FAILURES', 5),
+        open_seconds=get_float_from_config('NDSS_CIRCUIT_OPEN_SECONDS', 30),
+        half_open_successes=get_int_from_config('NDSS_CIRCUIT_HALF_OPEN_SUCCESSES', 5)
+    )
+    if config.get('NDSS_LIMIT_ENABLED', True):
+        ndss_limiter = ConcurrencyLimiter(
+            initial_limit=get_int_from_config('NDSS_LIMIT_INITIAL', 20),
+            min_limit=get_int_from_config('NDSS_LIMIT_MIN', 2),
+            max_limit=get_int_from_config('NDSS_LIMIT_MAX', 100),
+            tolerance=get_float_from_config('NDSS_LIMIT_LATENCY_TOLERANCE', 2.0),
+            wait=get_float_from_config('NDSS_LIMIT_WAIT', 1.0)
+        )
+    ndss_client = GuardedProxy(
+        ndss_client,
+        ['resolve_license', 'get_info', 'trust_token', 'validate_link'],
+        ndss_breaker,
+        ndss_limiter,
+        failures=(NDSSException, OSError),
+        answers=(KeeneticDeviceException,),
+        make_error=NDSSUnavailableException
+    )
+
+# service tag -> (token_alias, system_name, hw_id) is almost never changed, so it is cached
+resolve_cache = create_cache(
+    config.get('NDSS_RESOLVE_CACHE_BACKEND', 'memory'),
+    get_int_from_config('NDSS_RESOLVE_CACHE_SIZE', 10000),
+    get_float_from_config('NDSS_RESOLVE_CACHE_TTL', 3600),
+    config.get('NDSS_RESOLVE_CACHE_FILENAME', ''),
+    stale=get_float_from_config('NDSS_RESOLVE_CACHE_STALE_TTL', 86400)
+)
+resolve_cache_negative_ttl = get_float_from_config('NDSS_RESOLVE_CACHE_NEGATIVE_TTL', 60)
+resolve_cache_stale_ttl = get_float_from_config('NDSS_RESOLVE_CACHE_STALE_TTL', 86400)
+
+
+def resolve_license(service_tag: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Calls ndss_client.resolve_license through resolve_cache.
+    Results for unknown service tags are cached for shorter time.
+    NDSSException is never cached, expired result is returned instead of it, if there is one.
+
+    :return: token_alias, system_name, hw_id
+    """
+    result = resolve_cache.get(service_tag)
+    if result is MISSING:
+        try:
+            result = ndss_client.resolve_license(service_tag)
+        except NDSSException:
+            result = resolve_cache.get(service_tag, stale=resolve_cache_stale_ttl)
+            if result is MISSING:
+                raise
+        else:
+            cache_resolve_result(service_tag, result)
+    token_alias, system_name, hw_id = result
+    return token_alias, system_name, hw_id
+
+
+def cache_resolve_result(service_tag: str, result: Tuple[Optional[str], Optional[str], Optional[str]]) -> None:
+    """
+    Puts result of ndss_client.resolve_license to resolve_cache
+    """
+    token_alias, system_name, _ = result
+    is_found = token_alias and system_name
+    resolve_cache.set(service_tag, tuple(result), None if is_found else resolve_cache_negative_ttl)
 
 
-ndss_client = NDSS(get_params_from_config_by_prefix('NDSS_'))
 recordstore_type = config.get('RECORDSTORE')
 
 rs: Optional[RecordStore] = None
@@ -50,19 +247,90 @@ if recordstore_type == 'file':
     from record_store_files import RecordStoreFiles
     filestore_prefix = config.get('RECORDSTORE_DIRPREFIX')
     rs = RecordStoreFiles(ndss_service_id, filestore_prefix)
+if recordstore_type == 'sqlite':
+    from record_store_sqlite import RecordStoreSqlite
+    sqlite_filename = config.get('RECORDSTORE_SQLITE_FILENAME')
+    rs = RecordStoreSqlite(ndss_service_id, sqlite_filename)
 if recordstore_type == 'firestore':
     from record_store_firestore import RecordFirestore
     firestore_project = config.get('FIRESTORE_PROJECT')
     rs = RecordFirestore(ndss_service_id, firestore_project)
+if recordstore_type == 'redis':
+    from record_store_redis import RecordStoreRedis
+    rs = RecordStoreRedis(
+        ndss_service_id,
+        config.get('RECORDSTORE_REDIS_URL', 'redis://localhost:6379/0'),
+        pool_size=get_int_from_config('RECORDSTORE_REDIS_POOL_SIZE', 10)
+    )
+
+rs_write_behind = None
+if rs and config.get('RECORDSTORE_WRITE_BEHIND'):
+    from record_store_write_behind import WriteBehindRecordStore
+    rs = rs_write_behind = WriteBehindRecordStore(
+        rs,
+        directory=config.get('RECORDSTORE_JOURNAL_DIRECTORY'),
+        flush_interval=get_float_from_config('RECORDSTORE_WRITE_BEHIND_INTERVAL', 0.05),
+        batch_size=get_int_from_config('RECORDSTORE_WRITE_BEHIND_BATCH', 500),
+        maxsize=get_int_from_config('RECORDSTORE_WRITE_BEHIND_MAXSIZE', 10000),
+        fsync=config.get('RECORDSTORE_JOURNAL_FSYNC', True),
+        segment_size=get_int_from_config('RECORDSTORE_JOURNAL_SEGMENT_SIZE', 10000),
+        log=lambda message: log(message, logging.WARNING)
+    )
+
+rs_caching = None
+if rs and config.get('RECORDSTORE_CACHE'):
+    from record_store_caching import CachingRecordStore
+    rs = rs_caching = CachingRecordStore(
+        rs,
+        maxsize=get_int_from_config('RECORDSTORE_CACHE_SIZE', 10000),
+        ec_ttl=get_float_from_config('RECORDSTORE_CACHE_EC_TTL', 300),
+        bearer_ttl=get_float_from_config('RECORDSTORE_CACHE_BEARER_TTL', 30),
+        negative_ttl=get_float_from_config('RECORDSTORE_CACHE_NEGATIVE_TTL', 5)
+    )
+
+# token aliases of linked devices, so that search of not linked device doesn't go to record store
+linked_index = None
+if rs and config.get('LINKED_INDEX_ENABLED'):
+    from linked_index import LinkedIndex, IndexingProxy
+    linked_index = LinkedIndex(
+        config.get('LINKED_INDEX_DIRECTORY'),
+        rebuild_interval=get_float_from_config('LINKED_INDEX_REBUILD_INTERVAL', 3600),
+        # other hosts link devices to shared record store, so missing device may be linked
+        is_complete=recordstore_type in ['file', 'sqlite'],
+        log=log
+    )
+    rs = IndexingProxy(rs, linked_index)
 
-is_rs_setup = False
 if rs:
-    is_rs_setup = rs.ensure_infra()
-if is_rs_setup:
+    rs = InstrumentedProxy(rs, recordstore_latency, [
+        'save_pending_ec_record', 'load_pending_ec_records', 'save_active_ec_record', 'load_ec_record',
+        'load_active_token_aliases', 'save_bearer_record', 'load_bearer_record', 'load_all_bearer_records',
+        'save_pending_ec_records', 'save_active_ec_records', 'load_ec_records',
+        'save_bearer_records', 'load_bearer_records'
+    ])
+
+# slow initialization runs in background, so that new workers start quickly, see the end of the module
+startup = Startup(
+    retry_interval=get_float_from_config('STARTUP_RETRY_INTERVAL', 5),
+    log=lambda message: log(message, logging.WARNING)
+)
+startup_wait = get_float_from_config('STARTUP_WAIT', 10)
+
+
+def setup_record_store() -> None:
+    if not rs or not rs.ensure_infra():
+        raise RuntimeError('failed to setup environment')
     log(f'Starting web app with service_id={rs.service_id} using {rs.name()} storage')
-else:
-    log("Failed to setup environment")
-    exit()
+
+
+startup.add('recordstore', setup_record_store)
+startup.add('ndss_client', ndss_client_lazy.get, required=False)
+if linked_index is not None:
+    startup.add(
+        'linked_index',
+        lambda: linked_index.start(rs.load_active_token_aliases, config.get('LINKED_INDEX_LOCKFILE', '')),
+        required=False
+    )
 
 
 def log_request_debug() -> None:
@@ -70,9 +338,26 @@ def log_request_debug() -> None:
     Outputs some debug information.
     Add call of this method to necessary request handlers
     """
-    log("URL=" + request.url)
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    fields = {'method': request.method, 'url': request.url}
     if request.data:
-        log("DATA=" + str(request.data))
+        fields['data'] = request.get_data(as_text=True)[:log_debug_data_limit]
+    log('Request', logging.DEBUG, **fields)
+
+
+@app.before_request
+def assign_request_id():
+    """
+    Takes request ID from X-Request-Id header or generates new one, it is added to all log records of the request
+    """
+    request_id_var.set(request.headers.get('X-Request-Id', '')[:64] or uuid.uuid4().hex)
+
+
+@app.after_request
+def return_request_id(response: 'Response') -> 'Response':
+    response.headers['X-Request-Id'] = request_id_var.get()
+    return response
 
 
 def extract_parameters_from(req: 'request') -> Dict[str, str]:
@@ -107,6 +392,7 @@ def format_error(code: str, text: str) -> 'Response':
     """
     Formats error
     """
+    http_errors.inc(code=code)
     return jsonify(
         {
             'code': code,
@@ -115,6 +401,14 @@ def format_error(code: str, text: str) -> 'Response':
     )
 
 
+# all ECDSA verify/sign operations of the service are run by crypto_executor
+crypto_executor = CryptoExecutor(
+    get_int_from_config('CRYPTO_PROCESSES', -1),
+    workers=get_int_from_config('WORKERS', int(os.environ.get('WEB_CONCURRENCY') or 1)),
+    log=log
+)
+
+
 def check_basic_auth(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -126,6 +420,24 @@ def check_basic_auth(f):
     return decorated_function
 
 
+# NDSS retries linkService callbacks, results of signature verification are remembered
+# for the time, while callback timestamp is acceptable
+callback_replay_cache = create_cache(
+    config.get('LINKSERVICE_REPLAY_CACHE_BACKEND', 'memory'),
+    get_int_from_config('LINKSERVICE_REPLAY_CACHE_SIZE', 10000),
+    get_float_from_config('LINKSERVICE_REPLAY_TTL', 600),
+    config.get('LINKSERVICE_REPLAY_CACHE_FILENAME', '')
+)
+
+
+def get_callback_replay_key(params: Dict[str, str]) -> str:
+    """
+    Returns digest of linkService callback, which is the same for all retries of the callback
+    """
+    parts = [params.get(x) for x in ['tokenAlias', 'timestamp', 'ecSignature']]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
 @app.route('/ndmp/linkService', methods=['POST'])
 @check_basic_auth
 def link_service():
@@ -147,51 +459,77 @@ def link_service():
         return format_error('', 'missing some mandatory params'), 422
     # So, from here, we are safe to call params.get()
 
+    # Retry of callback, which was already accepted or rejected, is answered without any crypto work
+    replay_key = get_callback_replay_key(params)
+    is_replay_accepted = callback_replay_cache.get(replay_key)
+    if is_replay_accepted is True:
+        return format_success('started validation'), 200
+    if is_replay_accepted is False:
+        return format_error('', 'signature is not verified'), 422
+
     try:
-        is_signature_verified = verify_signature_from_dict(params, options)
+        is_signature_verified = config.get('DEBUG_SKIP_CALLBACK_SIGNATURE') or \
+            crypto_executor.verify_signature_from_dict(params, options)
     except VerifySignatureError:
         is_signature_verified = False
 
     if is_signature_verified:
-        thread = Thread(
-            target=do_generate_and_validate,
-            kwargs={
-                'service_id': params.get('serviceId'),
-                'device_ec_public': params.get('deviceEcPublic'),
-                'token_alias': params.get('tokenAlias')
-            }
+        is_queued = link_queue.submit(
+            service_id=params.get('serviceId'),
+            device_ec_public=params.get('deviceEcPublic'),
+            token_alias=params.get('tokenAlias')
         )
-        thread.start()
-
-        # Important: This is not the end, our process is being continued in the other thread,
+        if not is_queued:
+            # NDSS repeats callback later, if it gets an error
+            response = format_error('', 'too many link requests, try later')
+            response.headers['Retry-After'] = str(link_queue_retry_after)
+            return response, 503
+        callback_replay_cache.set(replay_key, True)
+
+        # Important: This is not the end, our process is being continued in the link queue worker,
         # see do_generate_and_validate
 
         # NDSS doesn't care about body content, only status code is important
         return format_success('started validation'), 200  # the signature is verified, but device is not linked yet
+    callback_replay_cache.set(replay_key, False)
     return format_error('', 'signature is not verified'), 422
 
 
+ec_key_pool = ECKeyPool(
+    size=get_int_from_config('ECKEYPOOL_SIZE', 20),
+    refill_batch=get_int_from_config('ECKEYPOOL_REFILL_BATCH', 5),
+    refill_interval=get_float_from_config('ECKEYPOOL_REFILL_INTERVAL', 0.1),
+    executor=crypto_executor if crypto_executor.is_enabled else None,
+    log=log
+)
+startup.add('ec_key_pool', ec_key_pool.start, required=False)
+
+
 def do_generate_and_validate(
         service_id: str,
         device_ec_public: str,
         token_alias: str
 ) -> None:
     """
-    This method starts from link_service method in own thread,
+    This method is called by link queue worker for jobs, submitted by link_service method,
     generates EC keys, creates signature and sends it to NDSS.
 
     And saves data somehow.
 
+    NDSSException is raised to link queue, so that the job is retried with backoff,
+    KeeneticDeviceException is raised, so that the job is marked as failed and not resumed.
+
     :param service_id:
     :param device_ec_public:
     :param token_alias:
     :return:
     """
 
-    signing_key: 'SigningKey' = generate_ec_keys()
+    # pre-generated keys are used, so that key generation is not done while linking storms
+    signing_key: 'SigningKey' = ec_key_pool.take()
     service_ec_public = get_ec_public_key(signing_key.verifying_key)
     ec_signature, signed_timestamp = \
-        sign_ec_signature_for_validate(signing_key, service_id, device_ec_public, service_ec_public)
+        crypto_executor.sign_ec_signature_for_validate(signing_key, service_id, device_ec_public, service_ec_public)
 
     # You need to develop your own data structure instead of this primitive
     record = \
@@ -199,7 +537,7 @@ def do_generate_and_validate(
     rs.save_pending_ec_record(token_alias, record)
 
     try:
-        log(f'Starting validate_link for {token_alias} with {signed_timestamp}')
+        log(f'Starting validate_link for {token_alias} with {signed_timestamp}', tokenAlias=token_alias)
         ndss_client.validate_link(
             device_ec_public,
             service_ec_public,
@@ -208,138 +546,926 @@ def do_generate_and_validate(
             ec_signature
         )
     except NDSSException:
-        log(f'NDSS Exception during validate_link process for {token_alias}')
-        return
+        log(f'NDSS Exception during validate_link process for {token_alias}', logging.WARNING, tokenAlias=token_alias)
+        raise
     except KeeneticDeviceException as kde:
-        log(f'Got {kde.code} while validate_link {token_alias}')
-        return
+        log(f'Got {kde.code} while validate_link {token_alias}', logging.WARNING, tokenAlias=token_alias, code=kde.code)
+        raise
 
     # if there was no exception during validate_link, save token alias and record data to local storage
     rs.save_active_ec_record(token_alias, record)
-    log(f'Successfully linked {token_alias}')
+    log(f'Successfully linked {token_alias}', tokenAlias=token_alias)
+
+
+link_queue = LinkQueue(
+    rs,
+    do_generate_and_validate,
+    workers=get_int_from_config('LINKQUEUE_WORKERS', 4),
+    size=get_int_from_config('LINKQUEUE_SIZE', 100),
+    retries=get_int_from_config('LINKQUEUE_RETRIES', 3),
+    backoff=get_float_from_config('LINKQUEUE_RETRY_BACKOFF', 2.0),
+    retry_on=(NDSSException,),
+    claim_ttl=get_float_from_config('LINKQUEUE_CLAIM_TTL', 3600),
+    failed_ttl=get_float_from_config('LINKQUEUE_FAILED_TTL', 7 * 86400),
+    log=log
+)
+link_queue_retry_after = get_int_from_config('LINKQUEUE_RETRY_AFTER', 10)
+if config.get('LINKQUEUE_RESUME_PENDING', True):
+    startup.add(
+        'linkqueue_resume',
+        lambda: link_queue.resume_pending(config.get('LINKQUEUE_RESUME_LOCKFILE', '')),
+        required=False
+    )
 
 
-@app.route('/search', methods=['GET'])
-@check_basic_auth
-def search_and_connect():
+bearer_trust_window = get_int_from_config('BEARER_TRUST_WINDOW', 300)
+bearer_stale_window = get_int_from_config('BEARER_STALE_WINDOW', 3600)
+bearer_revalidate_executor = ThreadPoolExecutor(
+    max_workers=max(get_int_from_config('BEARER_REVALIDATE_WORKERS', 2), 1),
+    thread_name_prefix='bearer-revalidate'
+)
+bearer_revalidate_in_progress: Set[Tuple[str, str, str]] = set()
+bearer_revalidate_lock = Lock()
+
+
+def get_bearer_trust(data: Dict) -> str:
     """
-    Handles search by service tag, returns device information with authenticated link
+    Checks, if stored bearer may be returned without remote info request to Keenetic device
+
+    :param data: bearer record
+    :return: 'fresh' if bearer was verified within trust window,
+        'stale' if bearer may be returned, but has to be verified again in background,
+        'untrusted' if bearer has to be verified before returning
     """
-    log_request_debug()
+    now = int(datetime.now().timestamp())
+    timestamp_verified = int(data.get('timestampVerified') or 0)
+    timestamp_expires = int(data.get('timestampExpires') or 0)
+    if not timestamp_verified or int(data.get('rrstVersion') or 0) < 2:
+        return 'untrusted'
+    if timestamp_expires <= now + bearer_trust_window:
+        return 'untrusted'
+    age = now - timestamp_verified
+    if age <= bearer_trust_window:
+        return 'fresh'
+    if age <= bearer_trust_window + bearer_stale_window:
+        return 'stale'
+    return 'untrusted'
+
+
+def is_bearer_usable_without_ndss(data: Dict) -> bool:
+    """
+    Checks, if stored bearer may be returned without verification, while NDSS is failing:
+    it has been verified at least once and is not expired
+    """
+    if not config.get('BEARER_SERVE_ON_NDSS_FAILURE', True):
+        return False
+    now = int(datetime.now().timestamp())
+    return int(data.get('timestampVerified') or 0) > 0 and int(data.get('timestampExpires') or 0) > now
+
+
+def save_verified_bearer_record(data: Dict, info_from_device: Optional[Dict]) -> Dict:
+    """
+    Saves bearer record with results of remote info request.
+    If info_from_device is None, bearer is saved as not verified.
+
+    :param data: bearer record
+    :param info_from_device: result of ndss_client.get_info
+    :return: saved record
+    """
+    record = prepare_verified_bearer_record(data, info_from_device)
+    rs.save_bearer_record(record)
+    return record
+
+
+def prepare_verified_bearer_record(data: Dict, info_from_device: Optional[Dict]) -> Dict:
+    """
+    Formats bearer record with results of remote info request, see save_verified_bearer_record
+    """
+    if info_from_device:
+        timestamp_verified = int(datetime.now().timestamp())
+        rrst_version = int(info_from_device.get('rrst_version') or 0)
+        model_name = info_from_device.get('model_name')
+    else:
+        timestamp_verified, rrst_version, model_name = 0, 0, ''
+    record = RecordStore.prepare_bearer_record(
+        data.get('tokenAlias'),
+        data.get('accessRole'),
+        data.get('userData'),
+        data.get('bearerValue'),
+        data.get('timestampExpires'),
+        timestamp_verified,
+        rrst_version,
+        model_name,
+        int(data.get('timestampSearched') or 0)
+    )
+    return record
+
+
+def mark_bearer_searched(data: Dict) -> Dict:
+    """
+    Returns copy of bearer record with the time of this search, bearer_refresher doesn't renew idle bearers
+    """
+    return dict(data, timestampSearched=int(datetime.now().timestamp()))
+
+
+def save_bearer_record_if_unchanged(data: Dict) -> bool:
+    """
+    Saves bearer record, unless stored bearer was replaced since data was loaded,
+    e.g. by search or bearer_refresher in other process
+
+    :return: False, if the record is not saved
+    """
+    stored = rs.load_bearer_record(data.get('tokenAlias'), data.get('accessRole'), data.get('userData'))
+    if not stored or stored.get('bearerValue') != data.get('bearerValue'):
+        return False
+    rs.save_bearer_record(data)
+    return True
+
+
+def revalidate_bearer(data: Dict) -> None:
+    """
+    Checks stored bearer with remote info request, runs in bearer_revalidate_executor.
+    The result is not saved, if the bearer was replaced meanwhile, e.g. by search in other worker.
+    """
+    key = (data.get('tokenAlias'), data.get('accessRole'), data.get('userData'))
+    try:
+        try:
+            info_from_device = ndss_client.get_info(data.get('tokenAlias'), data.get('bearerValue'), explained=True)
+        except NDSSException:
+            log(f'NDSS Exception during bearer revalidation for {key[0]}', logging.WARNING)
+            return
+        except KeeneticDeviceException as kde:
+            log(f'Got {kde.code} while bearer revalidation for {key[0]}', logging.WARNING, code=kde.code)
+            info_from_device = None
+
+        if not info_from_device or info_from_device.get('bearer_is_valid') != 'true':
+            # next search will check the bearer itself and create new one, if necessary
+            info_from_device = None
+        if not save_bearer_record_if_unchanged(prepare_verified_bearer_record(data, info_from_device)):
+            log(f'Bearer for {key[0]} was replaced during revalidation', logging.DEBUG)
+    finally:
+        with bearer_revalidate_lock:
+            bearer_revalidate_in_progress.discard(key)
+
+
+def revalidate_bearer_in_background(data: Dict) -> None:
+    """
+    Schedules revalidate_bearer, if the bearer is not being revalidated already
+    """
+    key = (data.get('tokenAlias'), data.get('accessRole'), data.get('userData'))
+    with bearer_revalidate_lock:
+        if key in bearer_revalidate_in_progress:
+            return
+        bearer_revalidate_in_progress.add(key)
+    # background revalidation is logged with request ID of the search, which has started it
+    bearer_revalidate_executor.submit(contextvars.copy_context().run, revalidate_bearer, data)
+
+
+# sampled requests are traced, state may be changed at runtime through /admin/profiling
+profiler = Profiler(
+    enabled=bool(config.get('PROFILING_ENABLED', False)),
+    sample_rate=get_float_from_config('PROFILING_SAMPLE_RATE', 0.01),
+    slow_threshold=get_float_from_config('PROFILING_SLOW_THRESHOLD', 1.0),
+    sample_interval=get_float_from_config('PROFILING_SAMPLE_INTERVAL', 0.005),
+    slow_traces=get_int_from_config('PROFILING_SLOW_TRACES', 50),
+    directory=config.get('PROFILING_DIRECTORY', '')
+)
+
+
+@app.before_request
+def start_profiling():
+    profiler.start_trace(f'{request.method} {request.path}', request_id_var.get())
+
+
+@app.after_request
+def finish_profiling(response: 'Response') -> 'Response':
+    profiler.finish_trace(response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_profiling_on_error(e):
+    # after_request is skipped, if handler has failed
+    profiler.finish_trace(500)
+
+
+def is_admin_authorized(auth) -> bool:
+    """
+    Checks basic auth credentials of request to admin endpoint
+
+    :param auth: authorization of request, None if it is missing
+    """
+    login = config.get('ADMIN_BASIC_LOGIN')
+    password = config.get('ADMIN_BASIC_PASSWORD')
+    return bool(login and password and auth) and \
+        hmac.compare_digest(str(auth.username or ''), str(login)) and \
+        hmac.compare_digest(str(auth.password or ''), str(password))
+
+
+def check_admin_auth(f):
+    """
+    Allows requests with ADMIN_BASIC_LOGIN and ADMIN_BASIC_PASSWORD only, admin endpoints are disabled without them
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not is_admin_authorized(request.authorization):
+            return format_error('0x401', 'authorization failed'), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+class AdminError(Exception):
+    """
+    Error of admin endpoint, reported with HTTP status
+    """
+
+    def __init__(self, text: str, status: int):
+        super().__init__(text, status)
+        self.text = text
+        self.status = status
+
+
+def get_profiling(params: Optional[Dict[str, str]] = None) -> Dict:
+    """
+    Returns profiling state and recent slow traces, changes state first, if params are given
+
+    :param params: enabled=0|1, sample_rate, slow_threshold
+    :raises AdminError:
+    """
+    if params is not None:
+        try:
+            profiler.set_state(
+                enabled=params['enabled'] in ['1', 'true'] if 'enabled' in params else None,
+                sampleRate=float(params['sample_rate']) if 'sample_rate' in params else None,
+                slowThreshold=float(params['slow_threshold']) if 'slow_threshold' in params else None
+            )
+        except ValueError:
+            raise AdminError('malformed parameters', 422)
+    return {'state': profiler.get_state(), 'traces': profiler.recent_traces()}
+
 
-    def format_result(
-            ndm_hw_id: str,
-            token_alias: str,
-            system_name: str,
-            model_name: str,
-            bearer_value: str
-    ) -> 'Response':
+def get_linked_devices(params: Dict[str, str]) -> Dict:
+    """
+    Returns number of linked devices and a page of their token aliases from linked_index
+
+    :param params: after (the last token alias of previous page) and limit
+    :raises AdminError:
+    """
+    try:
+        limit = min(max(int(params.get('limit', 100)), 1), 1000)
+    except ValueError:
+        raise AdminError('malformed parameters', 422)
+    if linked_index is None:
+        raise AdminError('index of linked devices is disabled', 503)
+    count = linked_index.count()
+    token_aliases = linked_index.page(params.get('after', ''), limit)
+    if count is None or token_aliases is None:
+        raise AdminError('index of linked devices is not built yet', 503)
+    return {
+        'count': count,
+        'tokenAliases': token_aliases,
+        'next': token_aliases[-1] if len(token_aliases) == limit else ''
+    }
+
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@check_admin_auth
+def admin_profiling():
+    """
+    Returns profiling state and recent slow traces.
+    POST changes state in all gunicorn workers: enabled=0|1, sample_rate, slow_threshold
+    """
+    try:
+        return jsonify(get_profiling(extract_parameters_from(request) if request.method == 'POST' else None))
+    except AdminError as e:
+        return format_error('', e.text), e.status
+
+
+@app.route('/admin/devices', methods=['GET'])
+@check_admin_auth
+def admin_devices():
+    """
+    Returns number of linked devices and a page of their token aliases from linked_index.
+    Parameters: after (the last token alias of previous page) and limit
+    """
+    try:
+        return jsonify(get_linked_devices(extract_parameters_from(request)))
+    except AdminError as e:
+        return format_error('', e.text), e.status
+
+
+class SearchError(Exception):
+    """
+    Error of search, reported to client with code from readme.MD
+    """
+
+    def __init__(self, code: str, text: str, retry_after: float = 0):
         """
-        Formats result of search_and_connect
+        :param retry_after: seconds, after which the search may be retried, for 0x429
         """
-        return jsonify(
-            {
-                'ndmHwId': ndm_hw_id,
-                'tokenAlias': token_alias,
-                'systemName': system_name,
-                'modelName': model_name,
-                'bearerValue': bearer_value,
-                'redirectUrl': f'https://{system_name}/auth?x-ndma-tkn={bearer_value}&url=/'
-            }
-        )
+        super().__init__(code, text)
+        self.code = code
+        self.text = text
+        self.retry_after = retry_after
+
+
+def create_search_rate_limiter(name: str, rate: float, burst: int):
+    return create_rate_limiter(
+        config.get('SEARCH_RATE_LIMIT_BACKEND', 'memory'),
+        rate if config.get('SEARCH_RATE_LIMIT_ENABLED') else 0,
+        burst,
+        get_int_from_config('SEARCH_RATE_LIMIT_SIZE', 100000),
+        config.get('SEARCH_RATE_LIMIT_FILENAME', ''),
+        table=f'{name}_buckets'
+    )
 
-    params = extract_parameters_from(request)
-    service_tag = params.get('license')
-    user_data = params.get('user_data')
-    email = params.get('email')
 
-    if not service_tag:
-        return format_error('0x200', 'missing license parameter')
+# searches of each caller, so one portal can't take NDSS quota of others
+search_client_limiter = create_search_rate_limiter(
+    'client',
+    get_float_from_config('SEARCH_RATE_LIMIT_CLIENT_RATE', 10),
+    get_int_from_config('SEARCH_RATE_LIMIT_CLIENT_BURST', 20)
+)
+# searches of each device, every search may push new bearer to device through NDSS
+search_device_limiter = create_search_rate_limiter(
+    'device',
+    get_float_from_config('SEARCH_RATE_LIMIT_DEVICE_RATE', 0.2),
+    get_int_from_config('SEARCH_RATE_LIMIT_DEVICE_BURST', 5)
+)
 
-    service_tag = ''.join([x for x in service_tag if x.isdigit()])
-    if len(service_tag) != 15:  # service tag always contains 15 digits, but sometimes is written with dashes
-        return format_error('0x201', 'service tag (license) is not valid')
 
-    try:
-        token_alias, system_name, hw_id = ndss_client.resolve_license(service_tag)
-    except NDSSException:
-        return format_error('0x100', 'failed to get information from NDSS, try later')
+# /search is called with the only NDSS callback credential, so callers differ by address only
+search_rate_limit_proxy_count = get_int_from_config('SEARCH_RATE_LIMIT_PROXY_COUNT', 0)
 
-    if not token_alias or not system_name:
-        return format_error('0x201', 'could not find device by service tag')
 
-    device_data = rs.load_ec_record(token_alias)
-    if not device_data:
-        # Important: occurs, if device is not linked yet.
-        # Later, we need to add method how to call device for registration and linking.
-        return format_error('0x300', 'missing keys. is device linked?')
+def get_search_client_key(remote_addr: Optional[str], forwarded_for: Optional[str]) -> str:
+    """
+    Returns address of the caller of /search for rate limiting.
+    Behind SEARCH_RATE_LIMIT_PROXY_COUNT trusted proxies, it is taken from X-Forwarded-For,
+    which they append to, so addresses set by the caller itself are ignored
 
-    service_ec_private = device_data.get('serviceEcPrivate')
-    service_ec_public = device_data.get('serviceEcPublic')
-    if not service_ec_public or not service_ec_private:
-        return format_error('0x301', 'failed to load device keys from internal store')
+    :param remote_addr: address of TCP peer
+    :param forwarded_for: value of X-Forwarded-For header
+    """
+    if search_rate_limit_proxy_count > 0 and forwarded_for:
+        hops = [x.strip() for x in forwarded_for.split(',') if x.strip()]
+        if len(hops) >= search_rate_limit_proxy_count:
+            return hops[-search_rate_limit_proxy_count]
+    return remote_addr or ''
+
+
+def check_device_rate_limit(token_alias: str) -> None:
+    """
+    :raises SearchError: 0x429, if device is searched too often
+    """
+    retry_after = search_device_limiter.acquire(token_alias)
+    if retry_after:
+        raise SearchError('0x429', 'too many searches of the device, try later', retry_after)
 
-    access_role = 'owner-admin'
-    user_data = 'temp;test'
 
-    data = rs.load_bearer_record(token_alias, access_role, user_data)
+def format_rate_limited(text: str, retry_after: float) -> Tuple['Response', int]:
+    """
+    Formats 0x429 error with Retry-After header
+    """
+    response = format_error('0x429', text)
+    response.headers['Retry-After'] = format_retry_after(retry_after)
+    return response, 429
+
+
+search_flight = SingleFlight(
+    config.get('SINGLEFLIGHT_LOCK_DIRECTORY', ''),
+    get_int_from_config('SINGLEFLIGHT_LOCK_STRIPES', 1024),
+    get_float_from_config('SINGLEFLIGHT_LOCK_TIMEOUT', 60)
+)
+
+# in pipelined mode independent record store calls of search run in parallel with other stages
+search_executor: Optional[ThreadPoolExecutor] = None
+if config.get('SEARCH_PIPELINED'):
+    search_executor = ThreadPoolExecutor(
+        max_workers=max(get_int_from_config('SEARCH_PIPELINE_WORKERS', 8), 1),
+        thread_name_prefix='search-pipeline'
+    )
+
+
+def run_in_search_pipeline(name: str, f: Callable, *args) -> Future:
+    """
+    Runs f(*args) in search_executor with context of the request, as profiler span with the name
+    """
+    def run():
+        with profiler.span(name):
+            return f(*args)
+    return search_executor.submit(contextvars.copy_context().run, run)
+
+
+def use_trusted_bearer(data: Optional[Dict]) -> Optional[Tuple[str, str]]:
+    """
+    Returns stored bearer, if it may be returned without asking Keenetic device.
+    Stale bearer is returned and verified in background.
+
+    :return: bearer_value, model_name or None
+    """
+    if not data:
+        return None
+    bearer_trust = get_bearer_trust(data)
+    if bearer_trust == 'untrusted':
+        return None
+    if bearer_trust == 'stale':
+        revalidate_bearer_in_background(mark_bearer_searched(data))
+    elif bearer_refresher and bearer_refresher.needs_searched_update(data):
+        with profiler.span('save_bearer_record'):
+            save_bearer_record_if_unchanged(mark_bearer_searched(data))
+    return data.get('bearerValue'), data.get('modelName')
+
+
+def find_or_create_bearer(
+        token_alias: str,
+        service_ec_private: str,
+        service_ec_public: str,
+        access_role: str,
+        user_data: str
+) -> Tuple[str, str]:
+    """
+    Returns working bearer for device: stored one, if it is still valid, or new one, sent to the device.
+
+    Concurrent searches for the same device are coalesced by search_flight,
+    so only one of them may create and save new bearer.
+
+    :return: bearer_value, model_name
+    :raises SearchError:
+    """
+    with profiler.span('load_bearer_record'):
+        data = rs.load_bearer_record(token_alias, access_role, user_data)
     if data:
+        bearer_value = data.get('bearerValue')
+
+        # Bearer, which was verified recently, is returned without asking Keenetic device
+        trusted_bearer = use_trusted_bearer(data)
+        if trusted_bearer:
+            return trusted_bearer
+
         # If we already have bearer internal record, we need to check if it works
         # by sending remote info request to Keenetic device
-        bearer_value = data.get('bearerValue')
         try:
-            info_from_device = ndss_client.get_info(token_alias, bearer_value, explained=True)
+            with profiler.span('get_info'):
+                info_from_device = ndss_client.get_info(token_alias, bearer_value, explained=True)
         except NDSSException:
-            return format_error('0x100', 'failed to get information from NDSS, try later')
+            if is_bearer_usable_without_ndss(data):
+                return bearer_value, data.get('modelName')
+            raise SearchError('0x100', 'failed to get information from NDSS, try later')
         except KeeneticDeviceException as kde:
-            return format_error(kde.code, kde.description)
+            raise SearchError(kde.code, kde.description)
 
         if info_from_device is None:
             # actually, this is not an error, but special case
-            return format_error('0x101', 'unexpected answer from NDSS')
+            raise SearchError('0x101', 'unexpected answer from NDSS')
 
         rrst_version = int(info_from_device.get('rrst_version'))
         if rrst_version >= 2 and info_from_device.get('bearer_is_valid') == 'true':
-            return format_result(
-                hw_id, token_alias, system_name, info_from_device.get('model_name'), bearer_value
-            )
+            save_verified_bearer_record(mark_bearer_searched(data), info_from_device)
+            return bearer_value, info_from_device.get('model_name')
 
     # If we don't have stored bearer record, or bearer value is not valid now,
     # we create new access token, signing and sending it to the device
+    return create_bearer(token_alias, service_ec_private, service_ec_public, access_role, user_data)
+
+
+def create_bearer(
+        token_alias: str,
+        service_ec_private: str,
+        service_ec_public: str,
+        access_role: str,
+        user_data: str,
+        timestamp_searched: Optional[int] = None
+) -> Tuple[str, str]:
+    """
+    Creates new bearer, sends it to the device and saves it to record store
+
+    :param timestamp_searched: last search of the device's bearer, None if it is created by search
+    :return: bearer_value, model_name
+    :raises SearchError:
+    """
     try:
-        bearer_value, expired_at = ndss_client.trust_token(
-            token_alias,
-            service_ec_private,
-            service_ec_public,
-            86400 * 7,
-            access_role,
-            user_data
-        )
+        with profiler.span('trust_token'):
+            bearer_value, expired_at = ndss_client.trust_token(
+                token_alias,
+                service_ec_private,
+                service_ec_public,
+                86400 * 7,
+                access_role,
+                user_data
+            )
     except NDSSException:
-        return format_error('0x100', 'failed to get information from NDSS, try later')
+        raise SearchError('0x100', 'failed to get information from NDSS, try later')
     except ECException:
-        return format_error('0x302', 'failed to load EC keys')
+        raise SearchError('0x302', 'failed to load EC keys')
     except KeeneticDeviceException as kde:
-        return format_error(kde.code, kde.description)
+        raise SearchError(kde.code, kde.description)
 
     # Preparing and saving bearer record to internal store for future use
     data = rs.prepare_bearer_record(token_alias, access_role, user_data, bearer_value, expired_at)
-    rs.save_bearer_record(data)
+    if timestamp_searched is None:
+        data = mark_bearer_searched(data)
+    else:
+        data['timestampSearched'] = timestamp_searched
+    saving: Optional[Future] = None
+    if search_executor is not None:
+        # the record is saved while the device is asked, search waits for both
+        saving = run_in_search_pipeline('save_bearer_record', rs.save_bearer_record, data)
+    else:
+        with profiler.span('save_bearer_record'):
+            rs.save_bearer_record(data)
 
     try:
-        info_from_device = ndss_client.get_info(token_alias, bearer_value, explained=True)
+        with profiler.span('get_info'):
+            info_from_device = ndss_client.get_info(token_alias, bearer_value, explained=True)
     except NDSSException:
-        return format_error('0x100', 'failed to get information from NDSS, try later')
+        raise SearchError('0x100', 'failed to get information from NDSS, try later')
     except KeeneticDeviceException as kde:
         # almost impossible (and not tested)
-        return format_error(kde.code, kde.description)
+        raise SearchError(kde.code, kde.description)
+    finally:
+        if saving is not None:
+            # re-raises error of saving, bearer is never returned before it is saved
+            saving.result()
+        if bearer_refresher:
+            bearer_refresher.track(data)
 
     if info_from_device and info_from_device.get('bearer_is_valid') == 'true':
-        return format_result(
-            hw_id, token_alias, system_name, info_from_device.get('model_name'), bearer_value
-        )
+        with profiler.span('save_bearer_record'):
+            save_verified_bearer_record(data, info_from_device)
+        return bearer_value, info_from_device.get('model_name')
     # just impossible (not tested)
-    return format_error('0x404', 'failed to get remote info from Keenetic after sending access token')
+    raise SearchError('0x404', 'failed to get remote info from Keenetic after sending access token')
+
+
+def refresh_bearer(data: Dict) -> bool:
+    """
+    Replaces bearer, which is going to expire, with new one. Called by bearer_refresher
+
+    :param data: bearer record
+    :return: False, if it should be retried later
+    """
+    token_alias, access_role, user_data = [data.get(x) for x in ['tokenAlias', 'accessRole', 'userData']]
+    device_data = rs.load_ec_record(token_alias)
+    if not device_data:
+        # device is not linked anymore
+        return True
+    try:
+        search_flight.do(
+            (token_alias, access_role, user_data),
+            create_bearer,
+            token_alias,
+            device_data.get('serviceEcPrivate'),
+            device_data.get('serviceEcPublic'),
+            access_role,
+            user_data,
+            int(data.get('timestampSearched') or 0)
+        )
+    except SearchError as e:
+        log(f'Got {e.code} while refreshing bearer for {token_alias}', logging.WARNING, code=e.code)
+        return False
+    return True
+
+
+bearer_refresher: Optional[BearerRefresher] = None
+if config.get('BEARER_REFRESH_ENABLED'):
+    bearer_refresher = BearerRefresher(
+        rs,
+        refresh_bearer,
+        window=get_int_from_config('BEARER_REFRESH_WINDOW', 86400),
+        rate=get_float_from_config('BEARER_REFRESH_RATE', 1),
+        retry_delay=get_int_from_config('BEARER_REFRESH_RETRY_DELAY', 600),
+        rescan_interval=get_int_from_config('BEARER_REFRESH_RESCAN_INTERVAL', 3600),
+        idle=get_int_from_config('BEARER_REFRESH_IDLE', 604800),
+        state_filename=config.get('BEARER_REFRESH_STATE_FILENAME', ''),
+        log=log
+    )
+    startup.add(
+        'bearer_refresher',
+        lambda: bearer_refresher.start(config.get('BEARER_REFRESH_LOCKFILE', '')),
+        required=False
+    )
+
+
+def normalize_service_tag(service_tag: str) -> str:
+    """
+    Removes dashes and other separators from service tag
+
+    :return: 15 digits of service tag, or empty string if service tag is not valid
+    """
+    service_tag = ''.join([x for x in service_tag if x.isdigit()])
+    if len(service_tag) != 15:  # service tag always contains 15 digits, but sometimes is written with dashes
+        return ''
+    return service_tag
+
+
+def prepare_search_result(
+        ndm_hw_id: str,
+        token_alias: str,
+        system_name: str,
+        model_name: str,
+        bearer_value: str
+) -> Dict[str, str]:
+    """
+    Formats result of search as dict
+    """
+    return {
+        'ndmHwId': ndm_hw_id,
+        'tokenAlias': token_alias,
+        'systemName': system_name,
+        'modelName': model_name,
+        'bearerValue': bearer_value,
+        'redirectUrl': f'https://{system_name}/auth?x-ndma-tkn={bearer_value}&url=/'
+    }
+
+
+def search_device(service_tag: str) -> Dict[str, str]:
+    """
+    Finds device by normalized service tag and returns result of search with authenticated link
+
+    :raises SearchError: with code from readme.MD
+    """
+    try:
+        with profiler.span('resolve'):
+            token_alias, system_name, hw_id = resolve_license(service_tag)
+    except NDSSException:
+        raise SearchError('0x100', 'failed to get information from NDSS, try later')
+
+    if not token_alias or not system_name:
+        raise SearchError('0x201', 'could not find device by service tag')
+
+    if linked_index is not None and not linked_index.may_be_linked(token_alias):
+        raise SearchError('0x300', 'missing keys. is device linked?')
+
+    check_device_rate_limit(token_alias)
+
+    access_role = 'owner-admin'
+    user_data = 'temp;test'
+
+    # both records depend only on token alias, so in pipelined mode they are loaded in parallel
+    bearer_loading: Optional[Future] = None
+    if search_executor is not None:
+        bearer_loading = run_in_search_pipeline(
+            'load_bearer_record', rs.load_bearer_record, token_alias, access_role, user_data)
+
+    with profiler.span('load_ec_record'):
+        device_data = rs.load_ec_record(token_alias)
+    if not device_data:
+        # Important: occurs, if device is not linked yet.
+        # Later, we need to add method how to call device for registration and linking.
+        raise SearchError('0x300', 'missing keys. is device linked?')
+    if linked_index is not None:
+        linked_index.add_if_missing(token_alias)
+
+    service_ec_private = device_data.get('serviceEcPrivate')
+    service_ec_public = device_data.get('serviceEcPublic')
+    if not service_ec_public or not service_ec_private:
+        raise SearchError('0x301', 'failed to load device keys from internal store')
+
+    if bearer_loading is not None:
+        # untrusted bearer is loaded again by find_or_create_bearer, when concurrent searches are coalesced
+        trusted_bearer = use_trusted_bearer(bearer_loading.result())
+        if trusted_bearer:
+            bearer_value, model_name = trusted_bearer
+            return prepare_search_result(hw_id, token_alias, system_name, model_name, bearer_value)
+
+    bearer_value, model_name = search_flight.do(
+        (token_alias, access_role, user_data),
+        find_or_create_bearer,
+        token_alias,
+        service_ec_private,
+        service_ec_public,
+        access_role,
+        user_data
+    )
+    return prepare_search_result(hw_id, token_alias, system_name, model_name, bearer_value)
+
+
+@app.route('/search', methods=['GET'])
+@check_basic_auth
+def search_and_connect():
+    """
+    Handles search by service tag, returns device information with authenticated link
+    """
+    log_request_debug()
+
+    retry_after = search_client_limiter.acquire(
+        get_search_client_key(request.remote_addr, request.headers.get('X-Forwarded-For')))
+    if retry_after:
+        return format_rate_limited('too many searches, try later', retry_after)
+
+    with profiler.span('parse'):
+        params = extract_parameters_from(request)
+        service_tag = params.get('license')
+        user_data = params.get('user_data')
+        email = params.get('email')
+
+    if not service_tag:
+        return format_error('0x200', 'missing license parameter')
+
+    service_tag = normalize_service_tag(service_tag)
+    if not service_tag:
+        return format_error('0x201', 'service tag (license) is not valid')
+
+    try:
+        return jsonify(search_device(service_tag))
+    except SearchError as e:
+        if e.code == '0x429':
+            return format_rate_limited(e.text, e.retry_after)
+        return format_error(e.code, e.text)
+
+
+# searches of all bulk requests of the process share these workers, so bulk load doesn't starve /search
+bulk_search_executor = ThreadPoolExecutor(
+    max_workers=max(get_int_from_config('BULK_SEARCH_WORKERS', 8), 1),
+    thread_name_prefix='bulk-search'
+)
+bulk_search_max_licenses = get_int_from_config('BULK_SEARCH_MAX_LICENSES', 10000)
+
+
+def search_for_bulk(license_value: str) -> Dict[str, str]:
+    """
+    Searches device for one license of bulk request
+
+    :return: result of search or error, with the license as it was given
+    """
+    service_tag = normalize_service_tag(license_value)
+    if not service_tag:
+        http_errors.inc(code='0x201')
+        return {'license': license_value, 'code': '0x201', 'error': 'service tag (license) is not valid'}
+    try:
+        result = search_device(service_tag)
+    except SearchError as e:
+        http_errors.inc(code=e.code)
+        return {'license': license_value, 'code': e.code, 'error': e.text}
+    except Exception as e:  # one license must not break the whole stream
+        log(f'Bulk search of {service_tag} failed: {e!r}', logging.ERROR)
+        http_errors.inc(code='0x500')
+        return {'license': license_value, 'code': '0x500', 'error': 'internal error'}
+    return dict(license=license_value, **result)
+
+
+@app.route('/admin/search', methods=['POST'])
+@check_admin_auth
+def admin_search():
+    """
+    Handles search by many service tags, e.g. for onboarding of customers, one license per line of request body.
+    Results are streamed as JSON lines in order of completion, every line has license field,
+    and either the same fields as result of /search, or code and error
+    """
+    log_request_debug()
+    # licenses are read from request stream while results are sent, so neither is kept in memory whole
+    return Response(stream_with_context(generate_bulk_search(request.stream)), mimetype='application/x-ndjson')
+
+
+def generate_bulk_search(lines: Iterable[bytes]) -> Iterator[str]:
+    """
+    Searches devices by licenses, one per line, BULK_SEARCH_CONCURRENCY at once
+
+    :return: results as JSON lines in order of completion
+    """
+    concurrency = max(get_int_from_config('BULK_SEARCH_CONCURRENCY', 4), 1)
+    skipped = []
+
+    def read_licenses() -> Iterator[str]:
+        count = 0
+        for line in lines:
+            line = line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            if count >= bulk_search_max_licenses:
+                skipped.append(line)
+                return
+            count += 1
+            yield line
+
+    in_progress: Set[Future] = set()
+    licenses = read_licenses()
+    while True:
+        for license_value in licenses:
+            context = contextvars.copy_context()
+            in_progress.add(bulk_search_executor.submit(context.run, search_for_bulk, license_value))
+            if len(in_progress) >= concurrency:
+                break
+        if not in_progress:
+            break
+        done, in_progress = wait(in_progress, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield json.dumps(future.result()) + '\n'
+    if skipped:
+        error = f'more than {bulk_search_max_licenses} licenses, the rest is skipped'
+        yield json.dumps({'code': '0x200', 'error': error}) + '\n'
+
+
+# collectors are separate, so that failure of one doesn't hide metrics of others
+
+def collect_cache_metrics() -> Iterator[Tuple[str, str, str, Dict[str, str], float]]:
+    """
+    Collects state of caches and write-behind queue of this process for metrics_registry
+    """
+    caches = {'resolve': resolve_cache.stats(), 'linkservice_replay': callback_replay_cache.stats()}
+    if rs_caching is not None:
+        caches.update({f'recordstore_{name}': stats for name, stats in rs_caching.stats().items()})
+    for name, stats in caches.items():
+        yield 'cache_hits_total', 'counter', 'Cache hits', {'cache': name}, stats['hits']
+        yield 'cache_misses_total', 'counter', 'Cache misses', {'cache': name}, stats['misses']
+        yield 'cache_evictions_total', 'counter', 'Cache evictions', {'cache': name}, stats['evictions']
+        yield 'cache_size', 'gauge', 'Number of cached items', {'cache': name}, stats['size']
+
+    if rs_write_behind is not None:
+        for name, value in rs_write_behind.stats().items():
+            if name == 'waiting':
+                yield 'recordstore_writebehind_waiting', 'gauge', 'Records waiting for write to record store', {}, value
+            else:
+                yield f'recordstore_writebehind_{name}_total', 'counter', f'Write-behind records {name}', {}, value
+
+
+def collect_ndss_metrics() -> Iterator[Tuple[str, str, str, Dict[str, str], float]]:
+    """
+    Collects state of NDSS circuit breaker, concurrency limit and HTTP session of this process for metrics_registry
+    """
+    if ndss_breaker is not None:
+        state = ndss_breaker.state
+        for name in ['closed', 'open', 'half-open']:
+            yield 'ndss_circuit_state', 'gauge', 'State of NDSS circuit breaker', {'state': name}, int(state == name)
+        yield 'ndss_circuit_opened_total', 'counter', 'Openings of NDSS circuit', {}, ndss_breaker.opened
+        yield 'ndss_circuit_rejected_total', 'counter', 'NDSS calls rejected by open circuit', {}, ndss_breaker.rejected
+    if ndss_deadline is not None:
+        yield 'ndss_timed_out_total', 'counter', 'NDSS calls failed by deadline', {}, ndss_deadline.timed_out
+        yield 'ndss_pool_rejected_total', 'counter', 'NDSS calls rejected by full pool', {}, ndss_deadline.rejected
+    if ndss_limiter is not None:
+        yield 'ndss_concurrency_limit', 'gauge', 'Limit of NDSS calls in progress', {}, ndss_limiter.limit
+        yield 'ndss_in_flight', 'gauge', 'NDSS calls in progress', {}, ndss_limiter.in_flight
+        yield 'ndss_limit_rejected_total', 'counter', 'NDSS calls rejected by limit', {}, ndss_limiter.rejected
+
+    if ndss_session is not None:
+        stats = ndss_session.stats()
+        yield 'ndss_http_requests_total', 'counter', 'HTTP requests to NDSS', {}, stats['requests']
+        yield 'ndss_http_failures_total', 'counter', 'NDSS requests failed without answer', {}, stats['failures']
+        yield 'ndss_http_connections_total', 'counter', 'Connections opened to NDSS', {}, stats['connections']
+        yield 'ndss_http_idle_connections', 'gauge', 'Idle connections to NDSS in pool', {}, stats['idle']
+
+
+def collect_metrics() -> Iterator[Tuple[str, str, str, Dict[str, str], float]]:
+    """
+    Collects state of queues, pools and limiters of this process for metrics_registry
+    """
+    yield 'log_records_dropped_total', 'counter', 'Log records dropped by full queue', {}, log_handler.dropped
+
+    for name, limiter in [('client', search_client_limiter), ('device', search_device_limiter)]:
+        if limiter.enabled:
+            yield 'search_ratelimit_allowed_total', 'counter', 'Searches allowed by rate limit', {'key': name}, \
+                limiter.allowed
+            yield 'search_ratelimit_limited_total', 'counter', 'Searches rejected by rate limit', {'key': name}, \
+                limiter.limited
+
+    yield 'linkqueue_waiting', 'gauge', 'Link jobs waiting in queue', {}, link_queue.qsize()
+    yield 'linkqueue_busy', 'gauge', 'Link jobs being processed', {}, link_queue.busy()
+
+    for name, value in ec_key_pool.stats().items():
+        if name == 'size':
+            yield 'eckeypool_size', 'gauge', 'Pre-generated keys in EC key pool', {}, value
+        else:
+            yield f'eckeypool_{name}_total', 'counter', f'EC key pool {name}', {}, value
+
+    for op, stats in crypto_executor.stats().items():
+        yield 'crypto_operations_total', 'counter', 'ECDSA operations', {'op': op}, stats['count']
+        yield 'crypto_operations_inline_total', 'counter', 'ECDSA operations in-process', {'op': op}, stats['inline']
+        yield 'crypto_operations_seconds_total', 'counter', 'Duration of ECDSA operations', {'op': op}, stats['total']
+
+    if bearer_refresher is not None:
+        for name, value in bearer_refresher.stats().items():
+            if name == 'scheduled':
+                yield 'bearer_refresher_scheduled', 'gauge', 'Bearers scheduled for renewal', {}, value
+            else:
+                yield f'bearer_refresher_{name}_total', 'counter', f'Bearer refresher {name}', {}, value
+
+
+metrics_registry.add_collector(collect_cache_metrics)
+metrics_registry.add_collector(collect_ndss_metrics)
+metrics_registry.add_collector(collect_metrics)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request_duration(response: 'Response') -> 'Response':
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_latency.observe(time.perf_counter() - started, route=route, status=str(response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exposes metrics of all gunicorn workers in Prometheus text format
+    """
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/', methods=['GET'])
@@ -347,6 +1473,28 @@ def hello():
     return ''
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness of the worker for load balancer: 200 when startup is finished, 503 before it
+    """
+    return jsonify(startup.state()), 200 if startup.is_ready else 503
+
+
+@app.before_request
+def wait_for_startup():
+    """
+    Requests, which need record store, wait for startup for STARTUP_WAIT seconds and get 503 after it
+    """
+    if request.endpoint in [None, 'hello', 'ready', 'get_metrics'] or startup.is_ready:
+        return None
+    if not startup.wait(startup_wait):
+        response = format_error('', 'service is starting, try later')
+        response.headers['Retry-After'] = str(max(int(startup_wait), 1))
+        return response, 503
+    return None
+
+
 @app.errorhandler(404)
 def not_found(e):
     log_request_debug()
@@ -359,5 +1507,7 @@ def server_error(e):
     return '<h1>An internal error occurred</h1>', 500
 
 
+startup.start()
+
 if __name__ == '__main__':
     app.run()
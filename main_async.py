@@ -0,0 +1,348 @@
+"""
+ASGI variant of the service with the same routes and error codes as main.py.
+
+Handlers reuse the logic of main.py (search_device, bulk search, admin functions),
+which runs in a pool of threads, so NDSS and record store calls don't block event loop,
+and a single process serves many simultaneous searches while they are waiting for NDSS:
+
+    uvicorn main_async:app --host 0.0.0.0 --port 5000
+
+Config, record store, caches, single-flight of searches and link queue are shared with main.py.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import *
+from quart import Quart, request, jsonify, Response, g
+
+import main
+from main import config, log, logger, get_int_from_config
+from ndcloudclient.ec import *
+from structured_log import request_id_var
+from rate_limit import format_retry_after
+
+
+app = Quart(__name__)
+
+# searches with their NDSS calls, record store, caches and EC operations are blocking,
+# so the pool size limits the number of searches in progress
+blocking_executor = ThreadPoolExecutor(
+    max_workers=max(get_int_from_config('ASYNC_BLOCKING_POOL_SIZE', 100), 1),
+    thread_name_prefix='async-blocking'
+)
+
+
+async def run_blocking(f: Callable, *args, **kwargs):
+    """
+    Runs blocking function in blocking_executor with context variables of the calling task
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, partial(context.run, f, *args, **kwargs))
+
+
+async def read_lines(body: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Splits request body into lines as its chunks arrive
+    """
+    rest = b''
+    async for chunk in body:
+        *lines, rest = (rest + chunk).split(b'\n')
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def iterate_from_thread(items: AsyncIterator, loop: asyncio.AbstractEventLoop) -> Iterator:
+    """
+    Lets blocking thread iterate async iterator, each item is awaited in the event loop
+    """
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(items.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def log_request_debug() -> None:
+    """
+    Outputs some debug information.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        log('Request', logging.DEBUG, method=request.method, url=request.url)
+
+
+def format_success(text: str) -> 'Response':
+    """
+    Formats success
+    """
+    return jsonify({'success': text})
+
+
+def format_error(code: str, text: str) -> 'Response':
+    """
+    Formats error
+    """
+    main.http_errors.inc(code=code)
+    return jsonify(
+        {
+            'code': code,
+            'error': text
+        }
+    )
+
+
+def format_rate_limited(text: str, retry_after: float) -> Tuple['Response', int]:
+    """
+    Formats 0x429 error with Retry-After header
+    """
+    response = format_error('0x429', text)
+    response.headers['Retry-After'] = format_retry_after(retry_after)
+    return response, 429
+
+
+def check_basic_auth(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not config.get('DEBUG_SKIP_CALLBACK_BASICAUTH'):
+            # NDSS client may be still created by startup
+            is_callback_authorized = await run_blocking(
+                main.ndss_client.check_callback_auth, request.headers.get('Authorization'))
+            if not is_callback_authorized:
+                return format_error('0x401', 'authorization failed'), 401
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+def check_admin_auth(f):
+    """
+    See main.check_admin_auth
+    """
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not main.is_admin_authorized(request.authorization):
+            return format_error('0x401', 'authorization failed'), 401
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+def run_traced(name: str, f: Callable, *args):
+    """
+    Runs handler logic in blocking thread, traced by main.profiler, if the request is sampled
+    """
+    main.profiler.start_trace(name, request_id_var.get())
+    status = 500
+    try:
+        result = f(*args)
+        status = 200
+        return result
+    except main.SearchError as e:
+        status = 429 if e.code == '0x429' else 200
+        raise
+    finally:
+        main.profiler.finish_trace(status)
+
+
+@app.route('/ndmp/linkService', methods=['POST'])
+@check_basic_auth
+async def link_service():
+    """
+    Handles linkService requests from NDSS, see main.link_service
+    """
+    log_request_debug()
+
+    options = VerifySignatureOptions()
+    options.skip_check_timestamp = config.get('DEBUG_SKIP_CHECK_TIMESTAMP')
+
+    params = dict(request.args.items())
+
+    are_all_params = main.contains_all_mandatory(
+        params, ['tokenAlias', 'serviceId', 'deviceEcPublic', 'timestamp', 'ecSignature'])
+    if not are_all_params:
+        return format_error('', 'missing some mandatory params'), 422
+
+    replay_key = main.get_callback_replay_key(params)
+    is_replay_accepted = await run_blocking(main.callback_replay_cache.get, replay_key)
+    if is_replay_accepted is True:
+        return format_success('started validation'), 200
+    if is_replay_accepted is False:
+        return format_error('', 'signature is not verified'), 422
+
+    try:
+        is_signature_verified = config.get('DEBUG_SKIP_CALLBACK_SIGNATURE') or \
+            await run_blocking(main.crypto_executor.verify_signature_from_dict, params, options)
+    except VerifySignatureError:
+        is_signature_verified = False
+
+    if is_signature_verified:
+        is_queued = await run_blocking(
+            main.link_queue.submit,
+            service_id=params.get('serviceId'),
+            device_ec_public=params.get('deviceEcPublic'),
+            token_alias=params.get('tokenAlias')
+        )
+        if not is_queued:
+            response = format_error('', 'too many link requests, try later')
+            response.headers['Retry-After'] = str(main.link_queue_retry_after)
+            return response, 503
+        await run_blocking(main.callback_replay_cache.set, replay_key, True)
+        return format_success('started validation'), 200
+    await run_blocking(main.callback_replay_cache.set, replay_key, False)
+    return format_error('', 'signature is not verified'), 422
+
+
+@app.route('/search', methods=['GET'])
+@check_basic_auth
+async def search_and_connect():
+    """
+    Handles search by service tag, see main.search_and_connect
+    """
+    log_request_debug()
+
+    client_key = main.get_search_client_key(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    retry_after = await run_blocking(main.search_client_limiter.acquire, client_key)
+    if retry_after:
+        return format_rate_limited('too many searches, try later', retry_after)
+
+    service_tag = request.args.get('license')
+    if not service_tag:
+        return format_error('0x200', 'missing license parameter')
+
+    service_tag = main.normalize_service_tag(service_tag)
+    if not service_tag:
+        return format_error('0x201', 'service tag (license) is not valid')
+
+    try:
+        return jsonify(await run_blocking(run_traced, 'GET /search', main.search_device, service_tag))
+    except main.SearchError as e:
+        if e.code == '0x429':
+            return format_rate_limited(e.text, e.retry_after)
+        return format_error(e.code, e.text)
+
+
+@app.route('/admin/search', methods=['POST'])
+@check_admin_auth
+async def admin_search():
+    """
+    Handles search by many service tags, see main.admin_search
+    """
+    log_request_debug()
+    # licenses are searched as lines of body arrive, body is not kept in memory
+    lines = iterate_from_thread(read_lines(request.body), asyncio.get_running_loop())
+    results = main.generate_bulk_search(lines)
+
+    async def generate() -> AsyncIterator[str]:
+        while True:
+            line = await run_blocking(next, results, None)
+            if line is None:
+                return
+            yield line
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@check_admin_auth
+async def admin_profiling():
+    """
+    Returns profiling state and recent slow traces, see main.admin_profiling
+    """
+    params = dict(request.args.items()) if request.method == 'POST' else None
+    try:
+        return jsonify(await run_blocking(main.get_profiling, params))
+    except main.AdminError as e:
+        return format_error('', e.text), e.status
+
+
+@app.route('/admin/devices', methods=['GET'])
+@check_admin_auth
+async def admin_devices():
+    """
+    Returns number of linked devices and a page of their token aliases, see main.admin_devices
+    """
+    try:
+        return jsonify(await run_blocking(main.get_linked_devices, dict(request.args.items())))
+    except main.AdminError as e:
+        return format_error('', e.text), e.status
+
+
+@app.before_request
+async def assign_request_id():
+    """
+    See main.assign_request_id
+    """
+    request_id_var.set(request.headers.get('X-Request-Id', '')[:64] or uuid.uuid4().hex)
+
+
+@app.after_request
+async def return_request_id(response: 'Response') -> 'Response':
+    response.headers['X-Request-Id'] = request_id_var.get()
+    return response
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+async def observe_request_duration(response: 'Response') -> 'Response':
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        main.http_latency.observe(time.perf_counter() - started, route=route, status=str(response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    """
+    Exposes metrics, see main.get_metrics
+    """
+    text = await run_blocking(main.metrics_registry.render)
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/', methods=['GET'])
+async def hello():
+    return ''
+
+
+@app.route('/ready', methods=['GET'])
+async def ready():
+    """
+    Readiness of the worker, see main.ready
+    """
+    return jsonify(main.startup.state()), 200 if main.startup.is_ready else 503
+
+
+@app.before_request
+async def wait_for_startup():
+    """
+    See main.wait_for_startup
+    """
+    if request.endpoint in [None, 'hello', 'ready', 'get_metrics'] or main.startup.is_ready:
+        return None
+    if not await run_blocking(main.startup.wait, main.startup_wait):
+        response = format_error('', 'service is starting, try later')
+        response.headers['Retry-After'] = str(max(int(main.startup_wait), 1))
+        return response, 503
+    return None
+
+
+@app.errorhandler(404)
+async def not_found(e):
+    log_request_debug()
+    return '<h1>Not found</h1>', 404
+
+
+@app.errorhandler(500)
+async def server_error(e):
+    log_request_debug()
+    return '<h1>An internal error occurred</h1>', 500
@@ -0,0 +1,366 @@
+"""
+Prometheus-style metrics: counters, histograms and gauges in text exposition format.
+
+Every process (e.g. gunicorn worker) periodically writes snapshot of its metrics to a shared directory,
+and /metrics merges snapshots of all processes by summing them. Counters and histograms of processes, which have
+exited, are folded into the archive snapshot, so merged counters never decrease, and their gauges are dropped.
+Gauges of processes, which haven't written snapshot for several flush intervals, are ignored too.
+"""
+
+import fcntl
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Thread, Lock
+from typing import *
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Labels, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'samples': [[list(k), v] for k, v in self._values.items()]}
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        # per labels: counts of buckets (the last one is +Inf), sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def time(self, **labels) -> '_Timer':
+        """
+        Context manager, which observes duration of its block
+        """
+        return _Timer(self, labels)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'buckets': self.buckets,
+                'samples': [[list(k), [list(counts), total[0]]] for k, (counts, total) in self._values.items()]
+            }
+
+
+class _Timer(object):
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+        self._started = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class InstrumentedProxy(object):
+    """
+    Proxy, which observes duration of calls of object's methods in histogram, labeled by method name
+    """
+
+    def __init__(self, target: object, histogram: Histogram, methods: Iterable[str], **labels):
+        self._target = target
+        self._histogram = histogram
+        self._methods = set(methods)
+        self._labels = labels
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name not in self._methods or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def timed(*args, **kwargs):
+            with self._histogram.time(method=name, **self._labels):
+                return attr(*args, **kwargs)
+        return timed
+
+
+class Registry(object):
+
+    _directory = ''
+    _stale_after = 0.0
+    _started = 0.0
+
+    ARCHIVE_FILENAME = 'archive.snapshot'
+    LOCK_FILENAME = 'archive.lock'
+
+    def __init__(self, directory: str = '', flush_interval: float = 5):
+        """
+        :param directory: directory for snapshots of processes, '' to expose metrics of this process only
+        :param flush_interval: seconds between writing snapshots of this process
+        """
+        self._directory = directory
+        self._stale_after = max(flush_interval * 5, 30.0)
+        self._started = time.time()
+        self._metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]] = []
+        self._lock = Lock()
+        self.collector_errors = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            with self._archive_lock():
+                # snapshot left by previous process with the same PID
+                self._archive_snapshot_file(self._snapshot_filename(os.getpid()), self._load_archive())
+            Thread(target=self._flush_periodically, args=(flush_interval,), name='metrics', daemon=True).start()
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]) -> None:
+        """
+        Adds function, called at snapshot time, which yields (name, type, documentation, labels, value).
+        Type is 'gauge' or 'counter', e.g. hit counters of caches are collected as counters.
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self) -> Dict:
+        """
+        Returns metrics of this process as JSON-serializable dict
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            result[metric.name] = dict(metric.snapshot(), type=metric.type, help=metric.documentation)
+        for collector in self._collectors:
+            collected = []
+            try:
+                for sample in collector():
+                    collected.append(sample)
+            except Exception:  # metrics must not break anything, samples collected before failure are kept
+                self.collector_errors += 1
+            for name, metric_type, documentation, labels, value in collected:
+                entry = result.setdefault(name, {'type': metric_type, 'help': documentation, 'samples': []})
+                entry['samples'].append([list(_labels_key(labels)), value])
+        if self._collectors:
+            result['metrics_collector_errors_total'] = {
+                'type': 'counter', 'help': 'Failures of metric collectors', 'samples': [[[], self.collector_errors]]
+            }
+        return {'pid': os.getpid(), 'started': self._started, 'metrics': result}
+
+    def _snapshot_filename(self, pid: int) -> str:
+        return os.path.join(self._directory, f'{pid}.json')
+
+    def flush(self) -> None:
+        """
+        Writes snapshot of this process to the directory
+        """
+        if not self._directory:
+            return
+        filename = self._snapshot_filename(os.getpid())
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self.snapshot(), f, separators=(',', ':'))
+        os.replace(temp_filename, filename)
+
+    def _flush_periodically(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def _load_snapshots(self) -> List[Dict]:
+        if not self._directory:
+            return [self.snapshot()]
+        self.flush()
+        with self._archive_lock():
+            archive = self._load_archive()
+            snapshots = []
+            now = time.time()
+            for filename in os.listdir(self._directory):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(self._directory, filename)
+                try:
+                    if not self._is_alive(int(filename[:-len('.json')])):
+                        self._archive_snapshot_file(path, archive)
+                        continue
+                    stale = os.path.getmtime(path) < now - self._stale_after
+                    with open(path, 'r') as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if stale:  # hung process or PID reused by another program, its counters are still valid
+                    snapshot['metrics'] = _without_gauges(snapshot.get('metrics', {}))
+                snapshots.append(snapshot)
+        snapshots.append(archive)
+        return snapshots
+
+    @contextmanager
+    def _archive_lock(self) -> Iterator[None]:
+        with open(os.path.join(self._directory, self.LOCK_FILENAME), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load_archive(self) -> Dict:
+        try:
+            with open(os.path.join(self._directory, self.ARCHIVE_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'archived': [], 'metrics': {}}
+
+    def _archive_snapshot_file(self, path: str, archive: Dict) -> None:
+        """
+        Folds counters and histograms of snapshot of exited process into archive, then deletes the snapshot.
+        Archive remembers folded snapshots, until they are deleted, so a crash in between doesn't count them twice.
+        Must be called under archive lock.
+        """
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            snapshot = {}
+        identity = [snapshot.get('pid'), snapshot.get('started')]
+        if snapshot and identity not in archive['archived']:
+            metrics = _merge_snapshots([archive, {'metrics': _without_gauges(snapshot.get('metrics', {}))}])
+            archive['metrics'] = _to_snapshot_metrics(metrics)
+            archive['archived'] = [x for x in archive['archived'] if os.path.exists(self._snapshot_filename(x[0]))]
+            archive['archived'].append(identity)
+            filename = os.path.join(self._directory, self.ARCHIVE_FILENAME)
+            with open(f'{filename}.tmp', 'w') as f:
+                json.dump(archive, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f'{filename}.tmp', filename)
+        os.remove(path)
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def render(self) -> str:
+        """
+        Returns metrics of all processes in Prometheus text exposition format
+        """
+        merged = _merge_snapshots(self._load_snapshots())
+        lines = []
+        for name in sorted(merged.keys()):
+            entry = merged[name]
+            lines.append(f'# HELP {name} {entry["help"]}')
+            lines.append(f'# TYPE {name} {entry["type"]}')
+            for labels, value in sorted(entry['samples'].items()):
+                if entry['type'] == 'histogram':
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(list(entry['buckets']) + ['+Inf'], counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(labels, ("le", str(bound)))} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _without_gauges(metrics: Dict[str, Dict]) -> Dict[str, Dict]:
+    return {name: metric for name, metric in metrics.items() if metric['type'] != 'gauge'}
+
+
+def _merge_snapshots(snapshots: Iterable[Dict]) -> Dict[str, Dict]:
+    """
+    Sums samples of snapshots, returns metrics with samples as dict by labels
+    """
+    merged: Dict[str, Dict] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.get('metrics', {}).items():
+            entry = merged.setdefault(name, {
+                'type': metric['type'], 'help': metric['help'], 'buckets': metric.get('buckets'), 'samples': {}
+            })
+            for labels, value in metric['samples']:
+                key = tuple(tuple(x) for x in labels)
+                if metric['type'] == 'histogram':
+                    counts, total = value
+                    old_counts, old_total = entry['samples'].get(key, ([0] * len(counts), 0.0))
+                    entry['samples'][key] = ([a + b for a, b in zip(old_counts, counts)], old_total + total)
+                else:
+                    entry['samples'][key] = entry['samples'].get(key, 0) + value
+    return merged
+
+
+def _to_snapshot_metrics(merged: Dict[str, Dict]) -> Dict[str, Dict]:
+    result = {}
+    for name, entry in merged.items():
+        metric = {'type': entry['type'], 'help': entry['help'], 'samples': []}
+        if entry['buckets'] is not None:
+            metric['buckets'] = entry['buckets']
+        for labels, value in entry['samples'].items():
+            value = list(value) if entry['type'] == 'histogram' else value
+            metric['samples'].append([[list(x) for x in labels], value])
+        result[name] = metric
+    return result
@@ -0,0 +1,102 @@
+"""
+Copies device records from RecordStoreFiles directory layout to another record store.
+
+Usage:
+    python migrate_record_store.py --service-id <service-id> --from-dir <RECORDSTORE_DIRPREFIX> \
+        --to-sqlite <RECORDSTORE_SQLITE_FILENAME>
+    python migrate_record_store.py --service-id <service-id> --from-dir <RECORDSTORE_DIRPREFIX> \
+        --to-redis <RECORDSTORE_REDIS_URL>
+
+Existing layout is not changed, so the migration may be repeated.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import *
+from record_store import RecordStore
+
+
+def iterate_json_files(dirname: str) -> Iterator[Dict]:
+    """
+    Yields contents of *.json files from directory
+    """
+    if not os.path.isdir(dirname):
+        return
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.json'):
+                with open(entry.path, 'r') as f:
+                    try:
+                        yield json.load(f)
+                    except ValueError:
+                        print(f'Skipping malformed {entry.path}', file=sys.stderr)
+
+
+def iterate_chunks(records: Iterator[Dict], size: int = 500) -> Iterator[List[Dict]]:
+    """
+    Groups records for bulk saving
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def migrate_from_files(service_id: str, directory_prefix: str, target: RecordStore) -> Dict[str, int]:
+    """
+    Copies pending, active EC records and bearers of service to target record store
+
+    :return: number of copied records by type
+    """
+    devices_dir = os.path.join(directory_prefix, 'devices', service_id)
+    counts = {'pending': 0, 'active': 0, 'bearers': 0}
+
+    for chunk in iterate_chunks(iterate_json_files(os.path.join(devices_dir, 'active'))):
+        target.save_active_ec_records({record.get('tokenAlias'): record for record in chunk})
+        counts['active'] += len(chunk)
+
+    # after active ones, because saving active record removes pending one
+    for chunk in iterate_chunks(iterate_json_files(os.path.join(devices_dir, 'pending'))):
+        target.save_pending_ec_records({record.get('tokenAlias'): record for record in chunk})
+        counts['pending'] += len(chunk)
+
+    for chunk in iterate_chunks(iterate_json_files(os.path.join(directory_prefix, 'bearers', service_id))):
+        target.save_bearer_records(chunk)
+        counts['bearers'] += len(chunk)
+
+    return counts
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Migrates records from RecordStoreFiles layout')
+    parser.add_argument('--service-id', required=True, help='NDSS_SERVICE_ID')
+    parser.add_argument('--from-dir', required=True, help='RECORDSTORE_DIRPREFIX of file record store')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--to-sqlite', help='sqlite database file')
+    target_group.add_argument('--to-redis', help='redis URL')
+    args = parser.parse_args()
+
+    if args.to_redis:
+        from record_store_redis import RecordStoreRedis
+        target = RecordStoreRedis(args.service_id, args.to_redis)
+    else:
+        from record_store_sqlite import RecordStoreSqlite
+        target = RecordStoreSqlite(args.service_id, args.to_sqlite)
+    if not target.ensure_infra():
+        print('Failed to setup target record store', file=sys.stderr)
+        return 1
+
+    counts = migrate_from_files(args.service_id, args.from_dir, target)
+    print(f"Migrated {counts['active']} active, {counts['pending']} pending records "
+          f"and {counts['bearers']} bearers to {target.name()} storage")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
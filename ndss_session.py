@@ -0,0 +1,92 @@
+"""
+Pooled keep-alive HTTP session for NDSS client.
+
+NDSS client, which sends every request with a new session, opens new TCP and TLS connection for every call.
+The session keeps connections to NDSS_SERVER open between calls and shares them between threads
+(request handlers, link queue workers, bearer refresher), so most calls skip the handshakes.
+
+The session is given to the client only through its own hooks: `session` argument of its constructor
+or `session` (`_session`) attribute holding requests.Session. Without such hook the stock client is used.
+"""
+
+import inspect
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from typing import *
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(requests.Session):
+
+    def __init__(self, pool_size: int = 10, pool_block: bool = True):
+        """
+        :param pool_size: maximum number of open connections to each host
+        :param pool_block: wait for free connection, instead of opening extra one, if all are busy
+        """
+        super().__init__()
+        # NDSS uses basic auth, and cookies shared by threads would be a race
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 1), pool_block=pool_block)
+        self.mount('https://', self._adapter)
+        self.mount('http://', self._adapter)
+        self._stats_lock = Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def request(self, method: str, url: str, *args, **kwargs) -> 'requests.Response':
+        try:
+            return super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            with self._stats_lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.requests += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns number of requests, failed requests, opened connections and idle connections
+        """
+        connections = 0
+        idle = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            idle += pool.pool.qsize() if pool.pool is not None else 0
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'connections': connections,
+            'idle': idle
+        }
+
+
+def create_client_with_session(
+        client_class: Callable[..., object],
+        params: Dict,
+        session: PooledSession
+) -> Tuple[object, bool]:
+    """
+    Creates NDSS client, which sends requests through the session, if the client supports it
+
+    :return: client and False, if the client has no session hook and sends requests on its own
+    """
+    try:
+        accepts_session = 'session' in inspect.signature(client_class).parameters
+    except (TypeError, ValueError):
+        accepts_session = False
+    if accepts_session:
+        return client_class(params, session=session), True
+
+    client = client_class(params)
+    for name in ['session', '_session']:
+        if isinstance(getattr(client, name, None), requests.Session):
+            setattr(client, name, session)
+            return client, True
+    return client, False
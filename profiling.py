@@ -0,0 +1,251 @@
+"""
+Opt-in profiling of request handlers, switchable at runtime.
+
+A part of requests is traced: handler marks its stages with spans, and a sampler thread periodically
+records stacks of threads handling traced requests. Traces of slow requests are kept in a ring buffer.
+
+Profiling state (enabled, sample rate, slow threshold) is kept in a file in shared directory,
+so a change made through one gunicorn worker is picked up by others within a second.
+Slow traces of every worker are written to the same directory.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from threading import Thread, Lock, Event, get_ident
+from typing import *
+
+
+class Trace(object):
+
+    __slots__ = ('name', 'request_id', 'thread_id', 'started', 'spans', 'stacks')
+
+    def __init__(self, name: str, request_id: str):
+        self.name = name
+        self.request_id = request_id
+        self.thread_id = get_ident()
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.stacks: Counter = Counter()
+
+
+class _Span(object):
+
+    __slots__ = ('_trace', '_name', '_started')
+
+    def __init__(self, trace: Trace, name: str):
+        self._trace = trace
+        self._name = name
+        self._started = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        finished = time.perf_counter()
+        self._trace.spans.append((self._name, self._started - self._trace.started, finished - self._started))
+        return False
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+
+class Profiler(object):
+
+    _directory = ''
+    _sample_interval = 0.005
+    _stack_depth = 40
+
+    def __init__(
+            self,
+            enabled: bool = False,
+            sample_rate: float = 0.01,
+            slow_threshold: float = 1.0,
+            sample_interval: float = 0.005,
+            slow_traces: int = 50,
+            directory: str = ''
+    ):
+        """
+        :param enabled: initial state, if there is no state file
+        :param sample_rate: part of requests to trace, from 0 to 1
+        :param slow_threshold: seconds, traces of longer requests are kept
+        :param sample_interval: seconds between stack samples of traced requests
+        :param slow_traces: number of slow traces kept by each process
+        :param directory: directory for state and slow traces shared by processes, '' to keep them in this process
+        """
+        self._state = {'enabled': enabled, 'sampleRate': sample_rate, 'slowThreshold': slow_threshold}
+        self._sample_interval = sample_interval
+        self._directory = directory
+        self._slow = deque(maxlen=max(slow_traces, 1))
+        self._active: Dict[int, Trace] = {}
+        self._lock = Lock()
+        self._has_active = Event()
+        self._sampler: Optional[Thread] = None
+        self._state_checked = 0.0
+        self._state_mtime = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._refresh_state()
+
+    def _state_filename(self) -> str:
+        return os.path.join(self._directory, 'state.json')
+
+    def _traces_filename(self) -> str:
+        return os.path.join(self._directory, f'traces-{os.getpid()}.json')
+
+    def _refresh_state(self) -> None:
+        if not self._directory:
+            return
+        now = time.monotonic()
+        if now - self._state_checked < 1:
+            return
+        self._state_checked = now
+        try:
+            mtime = os.stat(self._state_filename()).st_mtime
+            if mtime == self._state_mtime:
+                return
+            with open(self._state_filename(), 'r') as f:
+                self._state.update(json.load(f))
+            self._state_mtime = mtime
+        except (OSError, ValueError):
+            pass
+
+    def get_state(self) -> Dict:
+        self._refresh_state()
+        return dict(self._state)
+
+    def set_state(self, **state) -> Dict:
+        """
+        Changes state in all processes
+
+        :param state: enabled, sampleRate and/or slowThreshold
+        """
+        self._state.update({k: v for k, v in state.items() if k in self._state and v is not None})
+        if self._directory:
+            filename = self._state_filename()
+            with open(f'{filename}.tmp', 'w') as f:
+                json.dump(self._state, f)
+            os.replace(f'{filename}.tmp', filename)
+        return dict(self._state)
+
+    def start_trace(self, name: str, request_id: str = '') -> bool:
+        """
+        Starts tracing of current request, if profiling is enabled and request is sampled
+
+        :return: True if request is traced
+        """
+        self._refresh_state()
+        if not self._state['enabled'] or random.random() >= self._state['sampleRate']:
+            return False
+        trace = Trace(name, request_id)
+        _current_trace.set(trace)
+        with self._lock:
+            self._active[trace.thread_id] = trace
+            if self._sampler is None:
+                self._sampler = Thread(target=self._sample, name='profiler', daemon=True)
+                self._sampler.start()
+        self._has_active.set()
+        return True
+
+    def finish_trace(self, status: int = 0) -> None:
+        """
+        Finishes tracing of current request, keeps the trace if the request was slow
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        _current_trace.set(None)
+        duration = time.perf_counter() - trace.started
+        with self._lock:
+            self._active.pop(trace.thread_id, None)
+            if not self._active:
+                self._has_active.clear()
+        if duration < self._state['slowThreshold']:
+            return
+
+        self._slow.append({
+            'timestamp': int(time.time()),
+            'name': trace.name,
+            'requestId': trace.request_id,
+            'status': status,
+            'duration': round(duration * 1000, 1),
+            'spans': [
+                {'name': name, 'start': round(start * 1000, 1), 'duration': round(span_duration * 1000, 1)}
+                for name, start, span_duration in trace.spans
+            ],
+            'stacks': [[stack, count] for stack, count in trace.stacks.most_common(20)]
+        })
+        if self._directory:
+            try:
+                with open(f'{self._traces_filename()}.tmp', 'w') as f:
+                    json.dump(list(self._slow), f)
+                os.replace(f'{self._traces_filename()}.tmp', self._traces_filename())
+            except OSError:
+                pass
+
+    @staticmethod
+    def span(name: str):
+        """
+        Returns context manager, which measures a stage of traced request, or does nothing
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return _NO_SPAN
+        return _Span(trace, name)
+
+    def _sample(self) -> None:
+        while True:
+            self._has_active.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                active = list(self._active.values())
+            for trace in active:
+                frame = frames.get(trace.thread_id)
+                if frame is not None:
+                    trace.stacks[self._format_stack(frame)] += 1
+            del frames
+            time.sleep(self._sample_interval)
+
+    def _format_stack(self, frame) -> str:
+        """
+        Returns stack in collapsed format: root;...;leaf
+        """
+        names = []
+        while frame is not None and len(names) < self._stack_depth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def recent_traces(self) -> List[Dict]:
+        """
+        Returns slow traces of all processes, the newest first
+        """
+        traces = list(self._slow)
+        if self._directory:
+            traces = []
+            for filename in os.listdir(self._directory):
+                if not (filename.startswith('traces-') and filename.endswith('.json')):
+                    continue
+                try:
+                    with open(os.path.join(self._directory, filename), 'r') as f:
+                        traces.extend(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return sorted(traces, key=lambda x: x.get('timestamp', 0), reverse=True)
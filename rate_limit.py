@@ -0,0 +1,190 @@
+"""
+Token buckets for rate limiting by key, e.g. by client or by device.
+
+Bucket of each key allows `burst` requests at once and `rate` requests per second on average.
+It is kept as a single timestamp (theoretical arrival time of the next request, GCRA),
+so checking is O(1) and doesn't keep history of requests like sliding window log does.
+
+RateLimiter lives in process memory, SqliteRateLimiter keeps buckets in local sqlite file,
+so the limits are shared by all gunicorn workers on the host.
+"""
+
+import math
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock, local
+from typing import *
+
+
+class RateLimiter(object):
+
+    _rate = 0.0
+    _burst = 0
+    _maxsize = 0
+
+    def __init__(self, rate: float, burst: int, maxsize: int = 100000):
+        """
+        :param rate: requests per second for each key, 0 disables limiting
+        :param burst: requests, which may be made at once after idle time
+        :param maxsize: maximum number of keys, buckets of least recently used keys are forgotten first
+        """
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._maxsize = max(maxsize, 1)
+        self._buckets: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._rate > 0
+
+    def _take(self, tat: float, now: float) -> Tuple[float, float]:
+        """
+        Takes token from bucket
+
+        :param tat: theoretical arrival time of the bucket, 0 for new bucket
+        :return: new theoretical arrival time and seconds to wait, 0 if the request is allowed
+        """
+        interval = 1 / self._rate
+        tat = max(tat, now)
+        wait = tat + interval - self._burst * interval - now
+        if wait > 0:
+            return tat, wait
+        return tat + interval, 0.0
+
+    def acquire(self, key: str) -> float:
+        """
+        Takes token from bucket of the key
+
+        :return: 0 if request is allowed, otherwise seconds until it will be allowed
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tat, wait = self._take(self._buckets.get(key, 0.0), now)
+            self._buckets[key] = tat
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self._maxsize:
+                self._buckets.popitem(last=False)
+        self._count(wait)
+        return wait
+
+    def _count(self, wait: float) -> None:
+        if wait > 0:
+            self.limited += 1
+        else:
+            self.allowed += 1
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of this process
+        """
+        return {
+            'size': len(self),
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
+
+
+class SqliteRateLimiter(RateLimiter):
+
+    _filename = ''
+
+    def __init__(self, rate: float, burst: int, maxsize: int, filename: str, table: str = 'buckets'):
+        """
+        :param filename: sqlite database file
+        :param table: table of buckets, limiters with different limits may share the file
+        """
+        super().__init__(rate, burst, maxsize)
+        self._filename = filename
+        self._table = table
+        self._local = local()
+        self._writes = 0
+        with self._connection() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, tat REAL NOT NULL)')
+            db.execute(f'CREATE INDEX IF NOT EXISTS {table}_tat ON {table} (tat)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connection may be used only in thread, which has created it
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._filename, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def acquire(self, key: str) -> float:
+        if not self.enabled:
+            return 0.0
+        # wall clock time, because buckets are shared between processes
+        now = time.time()
+        db = self._connection()
+        # the bucket is read and written by one process at a time
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(f'SELECT tat FROM {self._table} WHERE key = ?', (key,)).fetchone()
+            tat, wait = self._take(row[0] if row else 0.0, now)
+            if not wait:
+                db.execute(f'INSERT OR REPLACE INTO {self._table} (key, tat) VALUES (?, ?)', (key, tat))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._count(wait)
+        # buckets, which are full again, are the same as missing ones
+        self._writes += 1
+        if self._writes % 256 == 0:
+            db.execute(f'DELETE FROM {self._table} WHERE tat <= ?', (now,))
+            if len(self) > self._maxsize:
+                db.execute(
+                    f'DELETE FROM {self._table} WHERE key IN (SELECT key FROM {self._table} ORDER BY tat LIMIT ?)',
+                    (max(len(self) - self._maxsize, 0),)
+                )
+        return wait
+
+    def __len__(self) -> int:
+        return self._connection().execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+
+
+def create_rate_limiter(
+        backend: str,
+        rate: float,
+        burst: int,
+        maxsize: int,
+        filename: str = '',
+        table: str = 'buckets'
+) -> RateLimiter:
+    """
+    Creates rate limiter by backend name from config
+
+    :param backend: 'memory' or 'sqlite'
+    :param rate: requests per second for each key, 0 disables limiting
+    :param burst: requests, which may be made at once
+    :param maxsize: maximum number of keys
+    :param filename: sqlite database file, required for 'sqlite' backend
+    :param table: table of buckets in sqlite database
+    """
+    if backend == 'sqlite' and rate > 0:
+        if not filename:
+            raise ValueError('filename is required for sqlite rate limiter')
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SqliteRateLimiter(rate, burst, maxsize, filename, table)
+    return RateLimiter(rate, burst, maxsize)
+
+
+def format_retry_after(wait: float) -> str:
+    """
+    Formats seconds to wait as value of Retry-After header
+    """
+    return str(max(math.ceil(wait), 1))
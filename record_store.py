@@ -42,17 +42,30 @@ class RecordStore(object):
             access_role: str,
             user_data: str,
             bearer_value: str,
-            timestamp_expires: int
+            timestamp_expires: int,
+            timestamp_verified: int = 0,
+            rrst_version: int = 0,
+            model_name: str = '',
+            timestamp_searched: int = 0
     ) -> Dict[str, str]:
         """
         Formats bearer record from given parameters as dict
+
+        :param timestamp_verified: when bearer was checked with remote info request last time, 0 if never
+        :param rrst_version: RRST version, reported by device during last check
+        :param model_name: model name, reported by device during last check
+        :param timestamp_searched: when bearer was returned by search last time, 0 if never
         """
         content = {
             'tokenAlias': token_alias,
             'accessRole': access_role,
             'userData': user_data,
             'bearerValue': bearer_value,
-            'timestampExpires': timestamp_expires
+            'timestampExpires': timestamp_expires,
+            'timestampVerified': timestamp_verified,
+            'rrstVersion': rrst_version,
+            'modelName': model_name,
+            'timestampSearched': timestamp_searched
         }
         return content
 
@@ -72,6 +85,21 @@ class RecordStore(object):
         """
         raise NotImplementedError
 
+    def load_pending_ec_records(self) -> List[Dict]:
+        """
+        Loads all pending records from storage (linking was started, but not finished)
+        """
+        raise NotImplementedError
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        """
+        Deletes pending record from storage, active record of the same token alias is kept
+        """
+        raise NotImplementedError
+
     def save_active_ec_record(
             self,
             token_alias: str,
@@ -91,6 +119,12 @@ class RecordStore(object):
         """
         raise NotImplementedError
 
+    def load_active_token_aliases(self) -> Iterator[str]:
+        """
+        Yields token aliases of all active records, e.g. for building index of linked devices
+        """
+        raise NotImplementedError
+
     def save_bearer_record(
             self,
             content: Dict[str, str]
@@ -104,3 +138,65 @@ class RecordStore(object):
             user_data: str
     ) -> Optional[Dict]:
         raise NotImplementedError
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        """
+        Yields all bearer records of the service, e.g. for refreshing them before expiration
+        """
+        raise NotImplementedError
+
+    # Bulk operations. Default implementations call single-record methods in a loop,
+    # backends override them to use batched requests or transactions.
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        """
+        Saves records to storage as pending
+
+        :param contents: records by token alias
+        """
+        for token_alias, content in contents.items():
+            self.save_pending_ec_record(token_alias, content)
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        """
+        Saves records to storage as active
+
+        :param contents: records by token alias
+        """
+        for token_alias, content in contents.items():
+            self.save_active_ec_record(token_alias, content)
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        """
+        Loads active records from storage by token aliases
+
+        :return: records by token alias, None for missing ones
+        """
+        return {token_alias: self.load_ec_record(token_alias) for token_alias in token_aliases}
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        for content in contents:
+            self.save_bearer_record(content)
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        """
+        Loads bearer records by (token_alias, access_role, user_data) keys
+
+        :return: records by key, None for missing ones
+        """
+        return {key: self.load_bearer_record(*key) for key in keys}
@@ -0,0 +1,263 @@
+"""
+RecordStore wrapper, which adds read-through LRU cache with TTL to any backend.
+
+EC records are changed only by re-linking of device, but it may be handled by other gunicorn worker,
+so they are cached for minutes. Bearers are changed by searches in other gunicorn workers,
+so they are cached for short time. Records which were not found are cached for short time too.
+Read-through fill, which has started before save of the record in this process, isn't cached.
+"""
+
+from threading import Lock
+from typing import *
+from record_store import RecordStore
+from ttl_cache import TTLCache, MISSING
+
+
+class _Generations(object):
+    """
+    _Generations of keys, which are increased by saves. Fill of cache is dropped,
+    if generation of its key was increased after the fill has started.
+    Only generations, which may be newer than some fill in progress, are kept.
+    """
+
+    _prune_size = 1024
+
+    def __init__(self):
+        self._counter = 0
+        self._saved: Dict[Hashable, int] = {}
+        self._fills: Dict[int, int] = {}
+        self._lock = Lock()
+
+    def start_fill(self) -> int:
+        """
+        :return: generation, when the fill has started
+        """
+        with self._lock:
+            started = self._counter
+            self._fills[started] = self._fills.get(started, 0) + 1
+        return started
+
+    def finish_fill(self, started: int) -> None:
+        with self._lock:
+            self._fills[started] -= 1
+            if not self._fills[started]:
+                del self._fills[started]
+            if not self._fills:
+                self._saved.clear()
+
+    def is_stale(self, key: Hashable, started: int) -> bool:
+        with self._lock:
+            return self._saved.get(key, 0) > started
+
+    def increase(self, key: Hashable) -> None:
+        with self._lock:
+            if not self._fills:
+                return
+            self._counter += 1
+            self._saved[key] = self._counter
+            if len(self._saved) > self._prune_size:
+                oldest = min(self._fills.keys())
+                self._saved = {k: v for k, v in self._saved.items() if v > oldest}
+
+
+class CachingRecordStore(RecordStore):
+
+    _backend: RecordStore = None
+    _negative_ttl = 0.0
+
+    def __init__(
+            self,
+            backend: RecordStore,
+            maxsize: int,
+            ec_ttl: float,
+            bearer_ttl: float,
+            negative_ttl: float
+    ):
+        """
+        :param backend: record store to cache
+        :param maxsize: maximum number of records in each cache (EC records and bearers)
+        :param ec_ttl: time to live of active EC records in seconds
+        :param bearer_ttl: time to live of bearers in seconds
+        :param negative_ttl: time to live of missing records in seconds
+        """
+        super().__init__(backend.service_id)
+        self._backend = backend
+        self._negative_ttl = negative_ttl
+        self._ec_cache = TTLCache(maxsize, ec_ttl)
+        self._bearer_cache = TTLCache(maxsize, bearer_ttl)
+        self._ec_generations = _Generations()
+        self._bearer_generations = _Generations()
+
+    def name(self):
+        return f'{self._backend.name()} (cached)'
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns hit/miss/eviction counters of caches
+        """
+        return {
+            'ec': self._ec_cache.stats(),
+            'bearers': self._bearer_cache.stats()
+        }
+
+    def _cache_ttl(self, record: Optional[Dict]) -> Optional[float]:
+        return None if record else self._negative_ttl
+
+    def _invalidate_ec(self, token_alias: str) -> None:
+        self._ec_cache.invalidate(token_alias)
+        self._ec_generations.increase(token_alias)
+
+    def _invalidate_bearer(self, content: Dict[str, str]) -> None:
+        if isinstance(content, dict):
+            key = tuple(content.get(x) for x in ['tokenAlias', 'accessRole', 'userData'])
+            self._bearer_cache.invalidate(key)
+            self._bearer_generations.increase(key)
+
+    def _fill(
+            self,
+            cache: TTLCache,
+            generations: _Generations,
+            keys: List[Hashable],
+            load: Callable[[List[Hashable]], Dict[Hashable, Optional[Dict]]]
+    ) -> Dict[Hashable, Optional[Dict]]:
+        """
+        Loads records from backend and caches them, unless they were saved during the load
+        """
+        started = generations.start_fill()
+        try:
+            records = load(keys)
+            for key, record in records.items():
+                if not generations.is_stale(key, started):
+                    cache.set(key, record, self._cache_ttl(record))
+        finally:
+            generations.finish_fill(started)
+        return records
+
+    def ensure_infra(self) -> bool:
+        return self._backend.ensure_infra()
+
+    def save_pending_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        # some backends keep pending and active record in the same document
+        self._backend.save_pending_ec_record(token_alias, content)
+        self._invalidate_ec(token_alias)
+
+    def load_pending_ec_records(self) -> List[Dict]:
+        return self._backend.load_pending_ec_records()
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        self._backend.delete_pending_ec_record(token_alias)
+        self._invalidate_ec(token_alias)
+
+    def save_active_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        self._backend.save_active_ec_record(token_alias, content)
+        self._invalidate_ec(token_alias)
+
+    def load_ec_record(
+            self,
+            token_alias: str
+    ) -> Optional[Dict]:
+        record = self._ec_cache.get(token_alias)
+        if record is MISSING:
+            record = self._fill(
+                self._ec_cache, self._ec_generations, [token_alias],
+                lambda keys: {keys[0]: self._backend.load_ec_record(keys[0])}
+            )[token_alias]
+        return record
+
+    def load_active_token_aliases(self) -> Iterator[str]:
+        return self._backend.load_active_token_aliases()
+
+    def save_bearer_record(
+            self,
+            content: Dict[str, str]
+    ) -> None:
+        self._backend.save_bearer_record(content)
+        self._invalidate_bearer(content)
+
+    def load_bearer_record(
+            self,
+            token_alias: str,
+            access_role: str,
+            user_data: str
+    ) -> Optional[Dict]:
+        key = (token_alias, access_role, user_data)
+        record = self._bearer_cache.get(key)
+        if record is MISSING:
+            record = self._fill(
+                self._bearer_cache, self._bearer_generations, [key],
+                lambda keys: {keys[0]: self._backend.load_bearer_record(*keys[0])}
+            )[key]
+        return record
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        return self._backend.load_all_bearer_records()
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._backend.save_pending_ec_records(contents)
+        for token_alias in contents.keys():
+            self._invalidate_ec(token_alias)
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._backend.save_active_ec_records(contents)
+        for token_alias in contents.keys():
+            self._invalidate_ec(token_alias)
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        result = {}
+        missing = []
+        for token_alias in token_aliases:
+            record = self._ec_cache.get(token_alias)
+            if record is MISSING:
+                missing.append(token_alias)
+            else:
+                result[token_alias] = record
+        if missing:
+            result.update(self._fill(self._ec_cache, self._ec_generations, missing, self._backend.load_ec_records))
+        return result
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        contents = list(contents)
+        self._backend.save_bearer_records(contents)
+        for content in contents:
+            self._invalidate_bearer(content)
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        result = {}
+        missing = []
+        for key in keys:
+            key = tuple(key)
+            record = self._bearer_cache.get(key)
+            if record is MISSING:
+                missing.append(key)
+            else:
+                result[key] = record
+        if missing:
+            result.update(
+                self._fill(self._bearer_cache, self._bearer_generations, missing, self._backend.load_bearer_records))
+        return result
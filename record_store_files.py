@@ -84,6 +84,25 @@ class RecordStoreFiles(RecordStore):
         with open(self._get_filename_records(token_alias, 'pending'), 'w') as f:
             f.write(RecordStoreFiles._ensure_string_before_save(content))
 
+    def load_pending_ec_records(self) -> List[Dict]:
+        dirname = os.path.join(self._directory_prefix, 'devices', self.service_id, 'pending')
+        records = []
+        for filename in os.listdir(dirname):
+            if filename.endswith('.json'):
+                record = self._get_json_from_filename(os.path.join(dirname, filename))
+                if record:
+                    records.append(record)
+        return records
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        try:
+            os.remove(self._get_filename_records(token_alias, 'pending'))
+        except FileNotFoundError:
+            pass
+
     def save_active_ec_record(
             self,
             token_alias: str,
@@ -100,6 +119,12 @@ class RecordStoreFiles(RecordStore):
         filename = self._get_filename_records(token_alias, 'active')
         return self._get_json_from_filename(filename)
 
+    def load_active_token_aliases(self) -> Iterator[str]:
+        dirname = os.path.join(self._directory_prefix, 'devices', self.service_id, 'active')
+        for filename in os.listdir(dirname):
+            if filename.endswith('.json'):
+                yield filename[:-len('.json')]
+
     def load_bearer_record(
             self,
             token_alias: str,
@@ -118,3 +143,11 @@ class RecordStoreFiles(RecordStore):
             if token_alias and access_role:
                 with open(self._get_filename_bearers(token_alias, access_role, user_data), 'w') as f:
                     f.write(RecordStoreFiles._ensure_string_before_save(content))
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        dirname = os.path.join(self._directory_prefix, 'bearers', self.service_id)
+        for filename in os.listdir(dirname):
+            if filename.endswith('.json'):
+                record = self._get_json_from_filename(os.path.join(dirname, filename))
+                if record:
+                    yield record
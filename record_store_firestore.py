@@ -2,22 +2,44 @@
 Sample RecordStore: saving device records to Google Cloud Firestore
 """
 
+from threading import Lock
 from typing import *
 from record_store import RecordStore
-from google.cloud import firestore
 
 
 class RecordFirestore(RecordStore):
 
-    _firestore_db = None
-    _firestore_collection_records = None
-    _firestore_collection_bearers = None
+    _firestore_project = ''
 
     def __init__(self, service_id: str, firestore_project: str):
         super().__init__(service_id)
-        self._firestore_db = firestore.Client(firestore_project)
-        self._firestore_collection_records = self._firestore_db.collection(service_id)
-        self._firestore_collection_bearers = self._firestore_db.collection('bearers')
+        self._firestore_project = firestore_project
+        self._client = None
+        self._client_lock = Lock()
+
+    def _get_client(self):
+        """
+        Creates client on first use, so that google.cloud is imported and credentials are loaded
+        by ensure_infra in background, not while the web app is being imported
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from google.cloud import firestore
+                    self._client = firestore.Client(self._firestore_project)
+        return self._client
+
+    @property
+    def _firestore_db(self):
+        return self._get_client()
+
+    @property
+    def _firestore_collection_records(self):
+        return self._get_client().collection(self.service_id)
+
+    @property
+    def _firestore_collection_bearers(self):
+        return self._get_client().collection('bearers')
 
     @staticmethod
     def name():
@@ -54,6 +76,20 @@ class RecordFirestore(RecordStore):
         doc_ref = self._firestore_collection_records.document(token_alias)
         doc_ref.set(content_dict)
 
+    def load_pending_ec_records(self) -> List[Dict]:
+        query = self._firestore_collection_records.where('isActive', '==', False)
+        return [doc.to_dict() for doc in query.stream()]
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        # pending and active record are the same document, it is deleted only if it hasn't become active meanwhile
+        doc_ref = self._firestore_collection_records.document(token_alias)
+        doc = doc_ref.get()
+        if doc.exists and doc.to_dict().get('isActive') is False:
+            doc_ref.delete(option=self._firestore_db.write_option(last_update_time=doc.update_time))
+
     def save_active_ec_record(
             self,
             token_alias: str,
@@ -76,6 +112,12 @@ class RecordFirestore(RecordStore):
                 return data
         return None
 
+    def load_active_token_aliases(self) -> Iterator[str]:
+        # documents are keyed by token alias, so their fields are not fetched
+        query = self._firestore_collection_records.where('isActive', '==', True).select([])
+        for doc in query.stream():
+            yield doc.id
+
     @staticmethod
     def _get_bearer_key(token_alias: str, access_role: str, user_data: str) -> str:
         return f'{token_alias};{access_role};{user_data}'
@@ -102,3 +144,81 @@ class RecordFirestore(RecordStore):
         if doc.exists:
             return doc.to_dict()
         return None
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        # Note: bearers collection is shared by services,
+        # so bearers of devices, which are missing in collection of this service, are yielded too
+        for doc in self._firestore_collection_bearers.stream():
+            yield doc.to_dict()
+
+    # Firestore allows up to 500 writes in a batch
+    _batch_size = 500
+
+    def _commit_in_batches(self, writes: Iterable[Tuple[object, Dict]]) -> None:
+        batch = self._firestore_db.batch()
+        count = 0
+        for doc_ref, content_dict in writes:
+            batch.set(doc_ref, content_dict)
+            count += 1
+            if count == self._batch_size:
+                batch.commit()
+                batch = self._firestore_db.batch()
+                count = 0
+        if count:
+            batch.commit()
+
+    def _get_all(self, doc_refs: List) -> Dict[str, Dict]:
+        if not doc_refs:
+            return {}
+        return {doc.id: doc.to_dict() for doc in self._firestore_db.get_all(doc_refs) if doc.exists}
+
+    def _prepare_ec_writes(self, contents: Dict[str, Union[str, Dict]], is_active: bool):
+        for token_alias, content in contents.items():
+            content_dict = RecordFirestore._ensure_dict_before_save(content)
+            content_dict['isActive'] = is_active
+            yield self._firestore_collection_records.document(token_alias), content_dict
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._commit_in_batches(self._prepare_ec_writes(contents, False))
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._commit_in_batches(self._prepare_ec_writes(contents, True))
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        token_aliases = list(token_aliases)
+        docs = self._get_all([self._firestore_collection_records.document(x) for x in token_aliases])
+        result = {}
+        for token_alias in token_aliases:
+            data = docs.get(token_alias)
+            result[token_alias] = data if data and data.get('isActive') else None
+        return result
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        def prepare_writes():
+            for content in contents:
+                content_dict = RecordFirestore._ensure_dict_before_save(content)
+                document_key = RecordFirestore._get_bearer_key(
+                    *[content_dict.get(x) for x in ['tokenAlias', 'accessRole', 'userData']])
+                yield self._firestore_collection_bearers.document(document_key), content_dict
+        self._commit_in_batches(prepare_writes())
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        keys = list(keys)
+        docs = self._get_all(
+            [self._firestore_collection_bearers.document(RecordFirestore._get_bearer_key(*key)) for key in keys])
+        return {key: docs.get(RecordFirestore._get_bearer_key(*key)) for key in keys}
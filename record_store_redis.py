@@ -0,0 +1,234 @@
+"""
+RecordStore over Redis protocol (Redis, Valkey, KeyDB and others), shared by all hosts of the service.
+
+Keys of service <id>:
+    ec:<id>:pending:<tokenAlias>, ec:<id>:active:<tokenAlias> -- EC records as JSON
+    ec:<id>:pending, ec:<id>:active -- sets of token aliases of such records
+    bearer:<id>:<tokenAlias>;<accessRole>;<userData> -- bearer records as JSON, expiring at timestampExpires
+    bearers:<id> -- sorted set of bearer keys by timestampExpires
+
+Multi-key operations are sent in pipelines, so they take one round trip per chunk of keys.
+Client may be given explicitly, e.g. fakeredis.FakeRedis() for tests and local runs.
+"""
+
+import json
+import time
+from typing import *
+from record_store import RecordStore
+
+
+class RecordStoreRedis(RecordStore):
+
+    # commands in one pipeline
+    _chunk_size = 500
+
+    def __init__(self, service_id: str, url: str = 'redis://localhost:6379/0', pool_size: int = 10, client=None):
+        """
+        :param url: redis://[[user]:password@]host[:port][/db] or rediss:// for TLS
+        :param pool_size: maximum number of connections, calls wait for free connection above it
+        :param client: redis.Redis compatible client, url and pool_size are not used then
+        """
+        super().__init__(service_id)
+        if client is None:
+            import redis
+            pool = redis.BlockingConnectionPool.from_url(url, max_connections=max(pool_size, 1), timeout=30)
+            client = redis.Redis(connection_pool=pool)
+        self._client = client
+
+    @staticmethod
+    def name():
+        return 'redis'
+
+    def ensure_infra(self) -> bool:
+        """
+        Checks connection to Redis
+        """
+        if not isinstance(self.service_id, str) or not self.service_id:
+            return False
+        try:
+            return bool(self._client.ping())
+        except Exception:  # connection errors differ between clients
+            return False
+
+    def _ec_key(self, state: str, token_alias: str) -> str:
+        return f'ec:{self.service_id}:{state}:{token_alias}'
+
+    def _ec_set_key(self, state: str) -> str:
+        return f'ec:{self.service_id}:{state}'
+
+    def _bearer_key(self, token_alias: str, access_role: str, user_data: str) -> str:
+        return f'bearer:{self.service_id}:{token_alias};{access_role};{user_data or ""}'
+
+    def _bearers_index_key(self) -> str:
+        return f'bearers:{self.service_id}'
+
+    @staticmethod
+    def _ensure_string_before_save(content) -> str:
+        if isinstance(content, dict):
+            return json.dumps(content, separators=(',', ':'))
+        return str(content)
+
+    @staticmethod
+    def _load_json(value: Optional[bytes]) -> Optional[Dict]:
+        return json.loads(value) if value is not None else None
+
+    def _chunks(self, items: List) -> Iterator[List]:
+        for i in range(0, len(items), self._chunk_size):
+            yield items[i:i + self._chunk_size]
+
+    def _add_pending(self, pipe, token_alias: str, content: Union[str, Dict]) -> None:
+        pipe.set(self._ec_key('pending', token_alias), RecordStoreRedis._ensure_string_before_save(content))
+        pipe.sadd(self._ec_set_key('pending'), token_alias)
+
+    def _add_active(self, pipe, token_alias: str, content: Union[str, Dict]) -> None:
+        pipe.set(self._ec_key('active', token_alias), RecordStoreRedis._ensure_string_before_save(content))
+        pipe.sadd(self._ec_set_key('active'), token_alias)
+        pipe.delete(self._ec_key('pending', token_alias))
+        pipe.srem(self._ec_set_key('pending'), token_alias)
+
+    def _add_bearer(self, pipe, content: Dict[str, str], now: int) -> None:
+        token_alias, access_role, user_data = [content.get(x) for x in ['tokenAlias', 'accessRole', 'userData']]
+        if not token_alias or not access_role:
+            return
+        key = self._bearer_key(token_alias, access_role, user_data)
+        timestamp_expires = int(content.get('timestampExpires') or 0)
+        pipe.set(key, RecordStoreRedis._ensure_string_before_save(content))
+        if timestamp_expires:
+            # bearer, which is already expired, is removed at once
+            pipe.expireat(key, max(timestamp_expires, now))
+        # bearer without expiration is never removed from index by load_all_bearer_records
+        pipe.zadd(self._bearers_index_key(), {key: timestamp_expires or float('inf')})
+
+    def save_pending_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        pipe = self._client.pipeline(transaction=True)
+        self._add_pending(pipe, token_alias, content)
+        pipe.execute()
+
+    def load_pending_ec_records(self) -> List[Dict]:
+        token_aliases = [x.decode() for x in self._client.smembers(self._ec_set_key('pending'))]
+        records = self.load_ec_records_by_state('pending', token_aliases)
+        return [record for record in records.values() if record]
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.delete(self._ec_key('pending', token_alias))
+        pipe.srem(self._ec_set_key('pending'), token_alias)
+        pipe.execute()
+
+    def save_active_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        pipe = self._client.pipeline(transaction=True)
+        self._add_active(pipe, token_alias, content)
+        pipe.execute()
+
+    def load_ec_record(
+            self,
+            token_alias: str
+    ) -> Optional[Dict]:
+        return RecordStoreRedis._load_json(self._client.get(self._ec_key('active', token_alias)))
+
+    def load_active_token_aliases(self) -> Iterator[str]:
+        for token_alias in self._client.sscan_iter(self._ec_set_key('active'), count=self._chunk_size):
+            yield token_alias.decode()
+
+    def save_bearer_record(
+            self,
+            content: Dict[str, str]
+    ) -> None:
+        if isinstance(content, dict):
+            pipe = self._client.pipeline(transaction=True)
+            self._add_bearer(pipe, content, int(time.time()))
+            pipe.execute()
+
+    def load_bearer_record(
+            self,
+            token_alias: str,
+            access_role: str,
+            user_data: str
+    ) -> Optional[Dict]:
+        return RecordStoreRedis._load_json(self._client.get(self._bearer_key(token_alias, access_role, user_data)))
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        # expired bearers have been removed by Redis itself, their keys are removed from index here
+        index_key = self._bearers_index_key()
+        self._client.zremrangebyscore(index_key, '-inf', int(time.time()) - 1)
+        start = 0
+        while True:
+            keys = self._client.zrange(index_key, start, start + self._chunk_size - 1)
+            if not keys:
+                return
+            for value in self._client.mget(keys):
+                if value is not None:
+                    yield json.loads(value)
+            start += len(keys)
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        for chunk in self._chunks(list(contents.items())):
+            pipe = self._client.pipeline(transaction=False)
+            for token_alias, content in chunk:
+                self._add_pending(pipe, token_alias, content)
+            pipe.execute()
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        for chunk in self._chunks(list(contents.items())):
+            pipe = self._client.pipeline(transaction=False)
+            for token_alias, content in chunk:
+                self._add_active(pipe, token_alias, content)
+            pipe.execute()
+
+    def load_ec_records_by_state(
+            self,
+            state: str,
+            token_aliases: List[str]
+    ) -> Dict[str, Optional[Dict]]:
+        result = {}
+        for chunk in self._chunks(token_aliases):
+            values = self._client.mget([self._ec_key(state, token_alias) for token_alias in chunk])
+            for token_alias, value in zip(chunk, values):
+                result[token_alias] = RecordStoreRedis._load_json(value)
+        return result
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        return self.load_ec_records_by_state('active', list(token_aliases))
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        now = int(time.time())
+        for chunk in self._chunks([x for x in contents if isinstance(x, dict)]):
+            pipe = self._client.pipeline(transaction=False)
+            for content in chunk:
+                self._add_bearer(pipe, content, now)
+            pipe.execute()
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        keys = [tuple(key) for key in keys]
+        result = {}
+        for chunk in self._chunks(keys):
+            values = self._client.mget([self._bearer_key(*key) for key in chunk])
+            for key, value in zip(chunk, values):
+                result[key] = RecordStoreRedis._load_json(value)
+        return result
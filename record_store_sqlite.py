@@ -0,0 +1,277 @@
+"""
+RecordStore: saving device records to local sqlite database in WAL mode.
+
+Unlike RecordStoreFiles, it keeps hundreds of thousands of records in one file,
+looks them up by index and writes every record atomically.
+Database file may be shared by gunicorn workers on the same host.
+"""
+
+import json
+import os
+import sqlite3
+from threading import local
+from typing import *
+from record_store import RecordStore
+
+
+class RecordStoreSqlite(RecordStore):
+
+    _filename = ''
+
+    def __init__(self, service_id: str, filename: str):
+        super().__init__(service_id)
+        self._filename = filename
+        self._local = local()
+
+    @staticmethod
+    def name():
+        return 'sqlite'
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connection may be used only in thread, which has created it
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._filename, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def ensure_infra(self) -> bool:
+        """
+        Creates database file and tables, if necessary
+        """
+        if not isinstance(self.service_id, str) or not self.service_id:
+            return False
+
+        try:
+            directory = os.path.dirname(self._filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = self._connection()
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS ec_records ('
+                'service_id TEXT NOT NULL, token_alias TEXT NOT NULL, state TEXT NOT NULL, content TEXT NOT NULL, '
+                'PRIMARY KEY (service_id, state, token_alias))'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS bearers ('
+                'service_id TEXT NOT NULL, token_alias TEXT NOT NULL, access_role TEXT NOT NULL, '
+                'user_data TEXT NOT NULL, timestamp_expires INTEGER, content TEXT NOT NULL, '
+                'PRIMARY KEY (service_id, token_alias, access_role, user_data))'
+            )
+        except (sqlite3.Error, OSError):
+            return False
+        return True
+
+    @staticmethod
+    def _ensure_string_before_save(content) -> str:
+        if isinstance(content, dict):
+            return json.dumps(content, separators=(',', ':'))
+        return str(content)
+
+    @staticmethod
+    def _chunks(items: List, size: int = 500) -> Iterator[List]:
+        # sqlite limits number of variables in a query
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def save_pending_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        self._connection().execute(
+            'INSERT OR REPLACE INTO ec_records (service_id, token_alias, state, content) VALUES (?, ?, ?, ?)',
+            (self.service_id, token_alias, 'pending', RecordStoreSqlite._ensure_string_before_save(content))
+        )
+
+    def load_pending_ec_records(self) -> List[Dict]:
+        rows = self._connection().execute(
+            'SELECT content FROM ec_records WHERE service_id = ? AND state = ?',
+            (self.service_id, 'pending')
+        )
+        return [json.loads(content) for content, in rows]
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        self._connection().execute(
+            'DELETE FROM ec_records WHERE service_id = ? AND state = ? AND token_alias = ?',
+            (self.service_id, 'pending', token_alias)
+        )
+
+    def save_active_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        db = self._connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'INSERT OR REPLACE INTO ec_records (service_id, token_alias, state, content) VALUES (?, ?, ?, ?)',
+                (self.service_id, token_alias, 'active', RecordStoreSqlite._ensure_string_before_save(content))
+            )
+            db.execute(
+                'DELETE FROM ec_records WHERE service_id = ? AND token_alias = ? AND state = ?',
+                (self.service_id, token_alias, 'pending')
+            )
+
+    def load_ec_record(
+            self,
+            token_alias: str
+    ) -> Optional[Dict]:
+        row = self._connection().execute(
+            'SELECT content FROM ec_records WHERE service_id = ? AND state = ? AND token_alias = ?',
+            (self.service_id, 'active', token_alias)
+        ).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def load_active_token_aliases(self) -> Iterator[str]:
+        rows = self._connection().execute(
+            'SELECT token_alias FROM ec_records WHERE service_id = ? AND state = ?',
+            (self.service_id, 'active')
+        )
+        for token_alias, in rows:
+            yield token_alias
+
+    def save_bearer_record(
+            self,
+            content: Dict[str, str]
+    ) -> None:
+        if isinstance(content, dict):
+            token_alias, access_role, user_data = [content.get(x) for x in ['tokenAlias', 'accessRole', 'userData']]
+            if token_alias and access_role:
+                self._connection().execute(
+                    'INSERT OR REPLACE INTO bearers '
+                    '(service_id, token_alias, access_role, user_data, timestamp_expires, content) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (
+                        self.service_id, token_alias, access_role, user_data or '',
+                        content.get('timestampExpires'), RecordStoreSqlite._ensure_string_before_save(content)
+                    )
+                )
+
+    def load_bearer_record(
+            self,
+            token_alias: str,
+            access_role: str,
+            user_data: str
+    ) -> Optional[Dict]:
+        row = self._connection().execute(
+            'SELECT content FROM bearers '
+            'WHERE service_id = ? AND token_alias = ? AND access_role = ? AND user_data = ?',
+            (self.service_id, token_alias, access_role, user_data or '')
+        ).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        rows = self._connection().execute(
+            'SELECT content FROM bearers WHERE service_id = ? ORDER BY timestamp_expires',
+            (self.service_id,)
+        )
+        for content, in rows:
+            yield json.loads(content)
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        db = self._connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR REPLACE INTO ec_records (service_id, token_alias, state, content) VALUES (?, ?, ?, ?)',
+                [
+                    (self.service_id, token_alias, 'pending', RecordStoreSqlite._ensure_string_before_save(content))
+                    for token_alias, content in contents.items()
+                ]
+            )
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        db = self._connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR REPLACE INTO ec_records (service_id, token_alias, state, content) VALUES (?, ?, ?, ?)',
+                [
+                    (self.service_id, token_alias, 'active', RecordStoreSqlite._ensure_string_before_save(content))
+                    for token_alias, content in contents.items()
+                ]
+            )
+            db.executemany(
+                'DELETE FROM ec_records WHERE service_id = ? AND token_alias = ? AND state = ?',
+                [(self.service_id, token_alias, 'pending') for token_alias in contents.keys()]
+            )
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        token_aliases = list(token_aliases)
+        result: Dict[str, Optional[Dict]] = {token_alias: None for token_alias in token_aliases}
+        db = self._connection()
+        for chunk in RecordStoreSqlite._chunks(token_aliases):
+            rows = db.execute(
+                'SELECT token_alias, content FROM ec_records WHERE service_id = ? AND state = ? '
+                f'AND token_alias IN ({",".join("?" * len(chunk))})',
+                [self.service_id, 'active'] + chunk
+            )
+            for token_alias, content in rows:
+                result[token_alias] = json.loads(content)
+        return result
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        rows = []
+        for content in contents:
+            if isinstance(content, dict):
+                token_alias, access_role, user_data = \
+                    [content.get(x) for x in ['tokenAlias', 'accessRole', 'userData']]
+                if token_alias and access_role:
+                    rows.append((
+                        self.service_id, token_alias, access_role, user_data or '',
+                        content.get('timestampExpires'), RecordStoreSqlite._ensure_string_before_save(content)
+                    ))
+        db = self._connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR REPLACE INTO bearers '
+                '(service_id, token_alias, access_role, user_data, timestamp_expires, content) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        keys = list(keys)
+        result: Dict[Tuple[str, str, str], Optional[Dict]] = {key: None for key in keys}
+        by_token_alias: Dict[str, List[Tuple[str, str, str]]] = {}
+        for key in keys:
+            by_token_alias.setdefault(key[0], []).append(key)
+        db = self._connection()
+        for chunk in RecordStoreSqlite._chunks(list(by_token_alias.keys())):
+            rows = db.execute(
+                'SELECT token_alias, access_role, user_data, content FROM bearers WHERE service_id = ? '
+                f'AND token_alias IN ({",".join("?" * len(chunk))})',
+                [self.service_id] + chunk
+            )
+            for token_alias, access_role, user_data, content in rows:
+                for key in by_token_alias[token_alias]:
+                    if key[1] == access_role and (key[2] or '') == user_data:
+                        result[key] = json.loads(content)
+        return result
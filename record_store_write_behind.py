@@ -0,0 +1,518 @@
+"""
+RecordStore wrapper, which saves records to backend in background.
+
+Every save is appended to a local journal and fsync'ed, so it survives crash of the process,
+and then it is written to backend by a flusher thread in batches with bulk methods.
+Repeated saves of the same record are coalesced, only the latest one is written.
+Records, which are not written yet, are returned by loads of this process (read-your-writes).
+
+Each process appends to its own journal, which is a sequence of segment files, and holds locks on them.
+A new segment is started, when the current one is flushed or has grown to segment_size lines,
+and segments are deleted as soon as all their records are written, so the journal is never rewritten.
+Segments left by processes, which have died before flushing, are replayed by ensure_infra of the next process
+in order of saves, by time and sequence number stored in each line.
+Note, read-your-writes holds within one process only: other gunicorn workers see saved record only
+after it is flushed, i.e. within flush interval, or later while backend fails. E.g. a bearer created
+by search in one worker may be created again by concurrent search of the same device in other worker,
+so with several workers write-behind trades coalescing of searches for latency of saves.
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Thread, Lock, Condition
+from typing import *
+
+from record_store import RecordStore
+
+
+PENDING = 'pending'
+ACTIVE = 'active'
+BEARER = 'bearer'
+
+JournalKey = Tuple[str, ...]
+
+
+class WriteBehindRecordStore(RecordStore):
+
+    _backend: RecordStore = None
+    _directory = ''
+    _flush_interval = 0.0
+    _batch_size = 0
+    _maxsize = 0
+    _segment_size = 0
+    _fsync = True
+    _max_retry_delay = 5.0
+    _log: Callable[[str], None] = None
+
+    def __init__(
+            self,
+            backend: RecordStore,
+            directory: str,
+            flush_interval: float = 0.05,
+            batch_size: int = 500,
+            maxsize: int = 10000,
+            fsync: bool = True,
+            segment_size: int = 10000,
+            log: Callable[[str], None] = print
+    ):
+        """
+        :param backend: record store to write to
+        :param directory: directory for journals shared by processes of this service
+        :param flush_interval: seconds between flushes, also the first delay before retry after failed flush
+        :param batch_size: maximum number of records written by one flush
+        :param maxsize: maximum number of records waiting for flush, saves wait for flush above it
+        :param fsync: fsync journal on every save, otherwise records of the last seconds may be lost on power failure
+        :param segment_size: lines in journal segment, after which the next segment is started
+        :param log: logging function
+        """
+        super().__init__(backend.service_id)
+        self._backend = backend
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._batch_size = max(batch_size, 1)
+        self._maxsize = max(maxsize, 1)
+        self._segment_size = max(segment_size, 1)
+        self._fsync = fsync
+        self._log = log
+        # records waiting for flush in order of their last save, by ('pending'|'active', token_alias)
+        # or ('bearer', token_alias, access_role, user_data), with sequence number of the save and journal segment
+        self._entries: 'OrderedDict[JournalKey, Tuple[int, str, int]]' = OrderedDict()
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._flushed = Condition(self._lock)
+        self._sync_lock = Lock()
+        # flushes are serialized, otherwise older batch might be written over newer one
+        self._flush_lock = Lock()
+        self._seq = 0
+        self._synced_seq = 0
+        self._closed = False
+        self.saved = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failures = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._journal_prefix = os.path.join(directory, f'journal-{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        # filename and descriptor of segments by index, number of waiting records in each of them
+        self._segments: Dict[int, Tuple[str, int]] = {}
+        self._segment_waiting: Dict[int, int] = {}
+        self._segment = 0
+        self._segment_lines = 0
+        self._open_segment(0)
+        self._flusher = Thread(target=self._flush_loop, name='recordstore-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def name(self):
+        return f'{self._backend.name()} (write-behind)'
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns number of saves, coalesced saves, records written to backend, failed flushes and waiting records
+        """
+        return {
+            'saved': self.saved,
+            'coalesced': self.coalesced,
+            'written': self.written,
+            'failures': self.failures,
+            'waiting': len(self._entries)
+        }
+
+    @staticmethod
+    def _open_journal(filename: str) -> int:
+        fd = os.open(filename, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+
+    @staticmethod
+    def _get_bearer_key(content: Dict[str, str]) -> JournalKey:
+        return BEARER, content.get('tokenAlias'), content.get('accessRole'), content.get('userData')
+
+    def _open_segment(self, index: int) -> None:
+        filename = f'{self._journal_prefix}-{index:06d}.log'
+        self._segments[index] = (filename, self._open_journal(filename))
+        self._segment_waiting[index] = 0
+        self._segment = index
+        self._segment_lines = 0
+
+    @staticmethod
+    def _format_line(key: JournalKey, serialized: str, seq: int, timestamp: float) -> bytes:
+        """
+        Returns journal line, serialized is JSON of record
+        """
+        prefix = json.dumps({'key': list(key), 'time': timestamp, 'seq': seq})[:-1]
+        return f'{prefix}, "content": {serialized}}}\n'.encode()
+
+    def _put(self, items: List[Tuple[JournalKey, Union[str, Dict]]]) -> None:
+        """
+        Appends records to journal and puts them to the queue of flusher
+        """
+        if not items:
+            return
+        # contents are kept in serialized form, so that callers may change their dicts
+        serialized = [(key, json.dumps(content)) for key, content in items]
+        with self._lock:
+            while len(self._entries) >= self._maxsize and not self._closed:
+                self._flushed.wait(self._flush_interval)
+            now = time.time()
+            lines = [
+                self._format_line(key, content, self._seq + i, now) for i, (key, content) in enumerate(serialized, 1)
+            ]
+            os.write(self._segments[self._segment][1], b''.join(lines))
+            for key, content in serialized:
+                self._seq += 1
+                if self._drop_entry(key):
+                    self.coalesced += 1
+                self._entries[key] = (self._seq, content, self._segment)
+                self._segment_waiting[self._segment] += 1
+            self._segment_lines += len(items)
+            if self._segment_lines >= self._segment_size:
+                self._start_segment()
+            self.saved += len(items)
+            seq = self._seq
+            self._changed.notify()
+        if self._fsync:
+            # group commit: one fsync covers saves of all threads, which have written before it
+            with self._sync_lock:
+                if self._synced_seq < seq:
+                    with self._lock:
+                        synced_seq = self._seq
+                        fd = self._segments[self._segment][1]
+                    os.fsync(fd)
+                    self._synced_seq = synced_seq
+
+    def _start_segment(self) -> None:
+        """
+        Starts the next segment of journal, must be called with lock held
+        """
+        try:
+            if self._fsync and self._segment_waiting[self._segment]:
+                # saves, which haven't been synced yet, may be in the previous segment
+                os.fsync(self._segments[self._segment][1])
+            self._open_segment(self._segment + 1)
+        except OSError as e:  # saves are appended to the current segment meanwhile
+            self._log(f'Failed to start journal segment in {self._directory}: {e!r}')
+
+    def _drop_entry(self, key: JournalKey) -> bool:
+        """
+        Removes record from waiting ones, must be called with lock held
+
+        :return: False if record was not waiting
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._segment_waiting[entry[2]] -= 1
+        return True
+
+    def _get_waiting(self, key: JournalKey) -> object:
+        """
+        Returns record waiting for flush, None if record is not waiting
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        content = json.loads(entry[1])
+        return json.loads(content) if isinstance(content, str) else content
+
+    def _take_batch(self) -> Tuple[Dict[str, Dict], Dict[str, Dict], List[Dict], Dict[JournalKey, int]]:
+        """
+        Returns pending and active EC records and bearers to write, and sequence numbers of their saves.
+        Pending records are written before active ones, so the batch ends before pending record,
+        which was saved after active record of the same token alias
+        """
+        pending, active, bearers, taken = {}, {}, [], {}
+        with self._lock:
+            for key, (seq, serialized, _) in self._entries.items():
+                if len(taken) >= self._batch_size or (key[0] == PENDING and key[1] in active):
+                    break
+                content = json.loads(serialized)
+                if key[0] == PENDING:
+                    pending[key[1]] = content
+                elif key[0] == ACTIVE:
+                    active[key[1]] = content
+                else:
+                    bearers.append(content)
+                taken[key] = seq
+        return pending, active, bearers, taken
+
+    def flush(self) -> bool:
+        """
+        Writes all waiting records to backend
+
+        :return: False if backend has failed, records are kept for the next flush
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        while True:
+            pending, active, bearers, taken = self._take_batch()
+            if not taken:
+                return True
+            try:
+                if pending:
+                    self._backend.save_pending_ec_records(pending)
+                if active:
+                    self._backend.save_active_ec_records(active)
+                if bearers:
+                    self._backend.save_bearer_records(bearers)
+            except Exception as e:  # the records are kept in journal, whatever has happened
+                self.failures += 1
+                self._log(f'Failed to write {len(taken)} records to {self._backend.name()}: {e!r}')
+                return False
+            # segments are changed under both locks, so that fsync of saves is not called on closed file
+            with self._sync_lock, self._lock:
+                for key, seq in taken.items():
+                    # records, which were saved again during writing, are kept for the next flush
+                    if self._entries.get(key, (None,))[0] == seq:
+                        self._drop_entry(key)
+                self.written += len(taken)
+                self._rotate_segments()
+                self._flushed.notify_all()
+
+    def _rotate_segments(self) -> None:
+        """
+        Starts the next segment, if the current one is flushed, deletes flushed segments.
+        Must be called with both locks held
+        """
+        if self._segment_lines and not self._segment_waiting[self._segment]:
+            self._start_segment()
+        for index in [x for x, waiting in self._segment_waiting.items() if not waiting and x != self._segment]:
+            filename, fd = self._segments[index]
+            # the lock is held until the file is deleted, so it is not replayed by other process
+            os.remove(filename)
+            os.close(fd)
+            del self._segments[index]
+            del self._segment_waiting[index]
+
+    def _flush_loop(self) -> None:
+        # flushes are retried with growing delay, while backend or journal directory fails
+        delay = self._flush_interval
+        while True:
+            with self._lock:
+                while not self._entries and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+            try:
+                is_flushed = self.flush()
+            except Exception as e:  # e.g. full disk, the thread must survive it, records are kept
+                self.failures += 1
+                self._log(f'Failed to flush records to {self._backend.name()}: {e!r}')
+                is_flushed = False
+            if is_flushed:
+                delay = self._flush_interval
+                # lets more saves come to the next batch
+                with self._lock:
+                    if len(self._entries) < self._batch_size and not self._closed:
+                        self._changed.wait(self._flush_interval)
+            else:
+                with self._lock:
+                    if not self._closed:
+                        self._changed.wait(delay)
+                delay = min(delay * 2, self._max_retry_delay)
+
+    def close(self) -> None:
+        """
+        Stops flusher and writes waiting records, those left after failure are replayed by the next process
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+            self._flushed.notify_all()
+        self._flusher.join()
+        if self.flush():
+            with self._sync_lock, self._lock:
+                for filename, _ in self._segments.values():
+                    os.remove(filename)
+
+    def _replay_journals(self) -> None:
+        """
+        Takes records from journals of dead processes in order of their saves
+        """
+        with self._lock:
+            own_filenames = {filename for filename, _ in self._segments.values()}
+        locked, items = [], []
+        try:
+            for filename in os.listdir(self._directory):
+                filename = os.path.join(self._directory, filename)
+                if not filename.endswith('.log') or filename in own_filenames:
+                    continue
+                try:
+                    fd = self._open_journal(filename)
+                except OSError:
+                    continue  # journal of running process
+                locked.append((filename, fd))
+                if os.fstat(fd).st_nlink == 0:
+                    continue  # flushed segment, deleted by its process after listing
+                with open(filename, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            # lines of older versions have no time and sequence number
+                            order = (entry.get('time', 0), entry.get('seq', 0))
+                            items.append((order, tuple(entry['key']), entry['content']))
+                        except (ValueError, KeyError, TypeError):
+                            continue  # line, which was partially written during crash
+            if items:
+                self._log(f'Replaying {len(items)} records from {len(locked)} journal files')
+                items.sort(key=lambda x: x[0])
+                self._put([(key, content) for _, key, content in items])
+            for filename, fd in locked:
+                if os.fstat(fd).st_nlink:
+                    os.remove(filename)
+        finally:
+            for _, fd in locked:
+                os.close(fd)
+
+    def ensure_infra(self) -> bool:
+        if not self._backend.ensure_infra():
+            return False
+        try:
+            self._replay_journals()
+        except OSError as e:
+            self._log(f'Failed to replay journals in {self._directory}: {e!r}')
+            return False
+        return True
+
+    def save_pending_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        self._put([((PENDING, token_alias), content)])
+
+    def load_pending_ec_records(self) -> List[Dict]:
+        # waiting records are taken before backend is read, so that records flushed meanwhile are not missed
+        with self._lock:
+            entries = [(key, serialized) for key, (_, serialized, _) in self._entries.items() if key[0] != BEARER]
+        records = OrderedDict((x.get('tokenAlias'), x) for x in self._backend.load_pending_ec_records())
+        for key, serialized in entries:
+            if key[0] == PENDING:
+                content = json.loads(serialized)
+                records[key[1]] = json.loads(content) if isinstance(content, str) else content
+            else:
+                records.pop(key[1], None)
+        return list(records.values())
+
+    def delete_pending_ec_record(
+            self,
+            token_alias: str
+    ) -> None:
+        # no flush writes the record meanwhile, its save may stay in journal and be replayed after crash,
+        # then the record is deleted again
+        with self._flush_lock:
+            with self._lock:
+                self._drop_entry((PENDING, token_alias))
+            self._backend.delete_pending_ec_record(token_alias)
+
+    def save_active_ec_record(
+            self,
+            token_alias: str,
+            content: Union[str, Dict]
+    ) -> None:
+        self._put([((ACTIVE, token_alias), content)])
+
+    def load_ec_record(
+            self,
+            token_alias: str
+    ) -> Optional[Dict]:
+        record = self._get_waiting((ACTIVE, token_alias))
+        if record is None:
+            record = self._backend.load_ec_record(token_alias)
+        return record
+
+    def load_active_token_aliases(self) -> Iterator[str]:
+        with self._lock:
+            waiting = {key[1] for key in self._entries.keys() if key[0] == ACTIVE}
+        for token_alias in self._backend.load_active_token_aliases():
+            waiting.discard(token_alias)
+            yield token_alias
+        yield from waiting
+
+    def save_bearer_record(
+            self,
+            content: Dict[str, str]
+    ) -> None:
+        if isinstance(content, dict):
+            self._put([(self._get_bearer_key(content), content)])
+
+    def load_bearer_record(
+            self,
+            token_alias: str,
+            access_role: str,
+            user_data: str
+    ) -> Optional[Dict]:
+        record = self._get_waiting((BEARER, token_alias, access_role, user_data))
+        if record is None:
+            record = self._backend.load_bearer_record(token_alias, access_role, user_data)
+        return record
+
+    def load_all_bearer_records(self) -> Iterator[Dict]:
+        with self._lock:
+            waiting = {key: serialized for key, (_, serialized, _) in self._entries.items() if key[0] == BEARER}
+        for record in self._backend.load_all_bearer_records():
+            serialized = waiting.pop(self._get_bearer_key(record), None)
+            yield json.loads(serialized) if serialized is not None else record
+        for serialized in waiting.values():
+            yield json.loads(serialized)
+
+    def save_pending_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._put([((PENDING, token_alias), content) for token_alias, content in contents.items()])
+
+    def save_active_ec_records(
+            self,
+            contents: Dict[str, Union[str, Dict]]
+    ) -> None:
+        self._put([((ACTIVE, token_alias), content) for token_alias, content in contents.items()])
+
+    def load_ec_records(
+            self,
+            token_aliases: Iterable[str]
+    ) -> Dict[str, Optional[Dict]]:
+        result = {}
+        missing = []
+        for token_alias in token_aliases:
+            record = self._get_waiting((ACTIVE, token_alias))
+            if record is None:
+                missing.append(token_alias)
+            else:
+                result[token_alias] = record
+        if missing:
+            result.update(self._backend.load_ec_records(missing))
+        return result
+
+    def save_bearer_records(
+            self,
+            contents: Iterable[Dict[str, str]]
+    ) -> None:
+        self._put([(self._get_bearer_key(x), x) for x in contents if isinstance(x, dict)])
+
+    def load_bearer_records(
+            self,
+            keys: Iterable[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], Optional[Dict]]:
+        result = {}
+        missing = []
+        for key in keys:
+            key = tuple(key)
+            record = self._get_waiting((BEARER,) + key)
+            if record is None:
+                missing.append(key)
+            else:
+                result[key] = record
+        if missing:
+            result.update(self._backend.load_bearer_records(missing))
+        return result
@@ -0,0 +1,114 @@
+"""
+Request coalescing: concurrent calls with the same key wait for one computation and share its result.
+
+Within a process callers wait for the leader's result. Processes (e.g. gunicorn workers) are serialized
+by file locks, so the leader of another process starts after the first one has finished and normally
+finds its result in record store.
+"""
+
+import fcntl
+import hashlib
+import os
+import time
+from threading import Event, Lock
+from typing import *
+
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.exception: Optional[BaseException] = None
+
+
+class SingleFlight(object):
+
+    _lock_directory = ''
+    _lock_stripes = 0
+    _lock_timeout = 0.0
+
+    def __init__(self, lock_directory: str = '', lock_stripes: int = 1024, lock_timeout: float = 60):
+        """
+        :param lock_directory: directory for lock files shared by processes, '' to coalesce within process only
+        :param lock_stripes: number of lock files, keys are distributed among them by hash
+        :param lock_timeout: seconds to wait for lock of other process, computation is started anyway after that
+        """
+        self._lock_directory = lock_directory
+        self._lock_stripes = max(lock_stripes, 1)
+        self._lock_timeout = lock_timeout
+        self._calls: Dict[Hashable, _Call] = {}
+        self._calls_lock = Lock()
+        if lock_directory:
+            os.makedirs(lock_directory, exist_ok=True)
+
+    def do(self, key: Hashable, f: Callable, *args, **kwargs):
+        """
+        Calls f(*args, **kwargs), if there is no call with the same key in progress,
+        otherwise waits for that call and returns its result or raises its exception
+        """
+        with self._calls_lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            with self._process_lock(key):
+                call.result = f(*args, **kwargs)
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._calls_lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _process_lock(self, key: Hashable) -> '_FileLock':
+        if not self._lock_directory:
+            return _FileLock(None, 0)
+        stripe = int(hashlib.sha1(repr(key).encode()).hexdigest(), 16) % self._lock_stripes
+        return _FileLock(os.path.join(self._lock_directory, f'{stripe}.lock'), self._lock_timeout)
+
+
+class _FileLock(object):
+
+    def __init__(self, filename: Optional[str], timeout: float):
+        self._filename = filename
+        self._timeout = timeout
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        if not self._filename:
+            return self
+        fd = os.open(self._filename, os.O_CREAT | os.O_RDWR, 0o600)
+        deadline = time.monotonic() + self._timeout
+        delay = 0.005
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return self
+            except OSError:
+                if time.monotonic() >= deadline:
+                    # the other process seems to be stuck, not waiting for it anymore
+                    os.close(fd)
+                    return self
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        return False
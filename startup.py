@@ -0,0 +1,113 @@
+"""
+Background initialization of the web app.
+
+Import of the app only creates objects, slow steps (checking record store, replaying journals,
+loading NDSS client, resuming jobs) run in startup thread. Requests wait for required steps
+for a short time and get 503 after it, /ready tells load balancer when the worker may get traffic.
+A failed step is logged and retried, instead of exiting the worker. Optional steps run
+in their own threads, so one failing step doesn't delay the others.
+"""
+
+import time
+from threading import Thread, Lock, Event
+from typing import *
+
+
+class Lazy(object):
+    """
+    Proxy, which creates object on first use, e.g. client of remote service
+    """
+
+    def __init__(self, factory: Callable[[], object]):
+        """
+        :param factory: creates the object, called once
+        """
+        self._factory = factory
+        self._target = None
+        self._lock = Lock()
+
+    def get(self) -> object:
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+
+class Startup(object):
+
+    _retry_interval = 0.0
+    _log: Callable[[str], None] = None
+
+    def __init__(self, retry_interval: float = 5, log: Callable[[str], None] = print):
+        """
+        :param retry_interval: seconds before retry of failed step
+        :param log: logging function for failures of steps
+        """
+        self._retry_interval = retry_interval
+        self._log = log
+        self._steps: List[Tuple[str, Callable[[], object], bool]] = []
+        self._ready = Event()
+        self._seconds: Dict[str, float] = {}
+        self._errors: Dict[str, str] = {}
+
+    def add(self, name: str, f: Callable[[], object], required: bool = True) -> None:
+        """
+        Adds step, required steps run one by one in order of adding.
+
+        :param name: name of step in state
+        :param f: runs the step, raises exception on failure
+        :param required: requests wait for required steps, others run after all required ones,
+                         each in its own thread
+        """
+        self._steps.append((name, f, required))
+
+    def start(self) -> None:
+        Thread(target=self._run, name='startup', daemon=True).start()
+
+    def _run(self) -> None:
+        for name, f, required in self._steps:
+            if required:
+                self._run_step(name, f)
+        self._ready.set()
+        for name, f, required in self._steps:
+            if not required:
+                Thread(target=self._run_step, args=(name, f), name=f'startup-{name}', daemon=True).start()
+
+    def _run_step(self, name: str, f: Callable[[], object]) -> None:
+        """
+        Runs step until it succeeds
+        """
+        while True:
+            started = time.perf_counter()
+            try:
+                f()
+                self._seconds[name] = round(time.perf_counter() - started, 4)
+                break
+            except Exception as e:  # startup thread must not die, the step is retried
+                self._seconds[name] = round(time.perf_counter() - started, 4)
+                self._errors[name] = repr(e)
+                self._log(f'Startup step {name} has failed, retrying in {self._retry_interval}s: {e!r}')
+                time.sleep(self._retry_interval)
+        self._errors.pop(name, None)
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits until required steps are done
+
+        :return: False on timeout
+        """
+        return self._ready.wait(timeout)
+
+    def state(self) -> Dict:
+        """
+        Returns readiness, durations of finished steps in seconds and errors of failing steps
+        """
+        return {'ready': self.is_ready, 'seconds': dict(self._seconds), 'errors': dict(self._errors)}
@@ -0,0 +1,116 @@
+"""
+Structured logging: records are written as JSON lines by a background thread,
+so request threads never block on stdout or log file.
+
+Request ID is kept in a context variable and added to every record made while handling the request,
+including records of link queue jobs submitted by the request.
+"""
+
+import atexit
+import json
+import logging
+import random
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+from typing import *
+
+
+request_id_var: ContextVar[str] = ContextVar('request_id', default='')
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName
+        }
+        request_id = getattr(record, 'request_id', '')
+        if request_id:
+            entry['requestId'] = request_id
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds request ID of the calling thread or task to record
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only part of records below INFO level
+    """
+
+    def __init__(self, rate: float):
+        """
+        :param rate: part of debug records to pass, from 0 to 1
+        """
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.INFO or random.random() < self._rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Drops records instead of blocking, when the writer thread is behind
+    """
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(
+        name: str,
+        level: str = 'INFO',
+        filename: str = '',
+        debug_sample_rate: float = 1.0,
+        queue_size: int = 10000
+) -> Tuple[logging.Logger, DroppingQueueHandler]:
+    """
+    Creates logger, which writes JSON lines from background thread
+
+    :param name: name of logger
+    :param level: minimal level, e.g. 'DEBUG' or 'INFO'
+    :param filename: log file, '' for stdout
+    :param debug_sample_rate: part of debug records to write, from 0 to 1
+    :param queue_size: maximum number of records waiting for writer, newer records are dropped
+    :return: logger and its queue handler
+    """
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+
+    handler = DroppingQueueHandler(Queue(maxsize=max(queue_size, 1)))
+    if debug_sample_rate < 1:
+        handler.addFilter(SamplingFilter(debug_sample_rate))
+    handler.addFilter(ContextFilter())
+
+    logger = logging.getLogger(name)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+    logger.handlers = [handler]
+
+    listener = QueueListener(handler.queue, target)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger, handler
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# modules of the service are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock(object):
+    """
+    Replacement of time module in tested modules, time goes on only by advance()
+    """
+
+    def __init__(self, now: float = 1000000.0):
+        self.now = now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
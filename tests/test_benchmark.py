@@ -0,0 +1,48 @@
+import json
+
+from benchmark import percentile, run_requests, make_service_tags, load_trace
+
+
+class Target(object):
+    """
+    Answers requests by path: error code for paths with 'fail', exception for paths with 'down'
+    """
+
+    def send(self, method: str, path: str):
+        if 'down' in path:
+            raise ConnectionError(path)
+        if 'fail' in path:
+            return 200, {'code': '0x100'}
+        return 200, {}
+
+
+def test_percentile():
+    assert percentile([], 50) == 0.0
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([1, 2, 3, 4], 100) == 4
+
+
+def test_requests_are_summarized_with_errors():
+    requests = [('GET', '/search'), ('GET', '/search?fail'), ('GET', '/search?fail'), ('GET', '/down')]
+    summary = run_requests(Target(), requests, concurrency=2)
+    assert summary['requests'] == 4
+    assert summary['errors'] == {'0x100': 2, 'ConnectionError': 1}
+    assert summary['p50'] <= summary['p99']
+
+
+def test_service_tags_are_known_to_fake_ndss():
+    tags = make_service_tags(1000)
+    assert len(set(tags)) == 1000
+    assert all(len(x) == 15 and not x.endswith('000') for x in tags)
+
+
+def test_trace_skips_malformed_lines(tmp_path):
+    filename = tmp_path / 'trace.jsonl'
+    filename.write_text('\n'.join([
+        json.dumps({'method': 'get', 'path': '/search?license=1'}),
+        'not json',
+        json.dumps({'path': 'no-slash'}),
+        json.dumps(['/list']),
+        json.dumps({'path': '/ready'})
+    ]))
+    assert load_trace(str(filename)) == [('GET', '/search?license=1'), ('GET', '/ready')]
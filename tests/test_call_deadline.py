@@ -0,0 +1,60 @@
+from threading import Event
+
+import pytest
+
+from call_deadline import DeadlineProxy
+
+
+class Unavailable(Exception):
+    pass
+
+
+class Client(object):
+
+    def __init__(self):
+        self.release = Event()
+
+    def fast(self, value):
+        return value
+
+    def stuck(self):
+        self.release.wait(5)
+        return 'late'
+
+
+def make_proxy(client, pool_size=2, timeouts=None):
+    return DeadlineProxy(client, ['fast', 'stuck'], pool_size, 0.05, timeouts, make_error=Unavailable)
+
+
+def test_call_returns_its_result():
+    assert make_proxy(Client()).fast(1) == 1
+
+
+def test_stuck_call_fails_after_deadline():
+    client = Client()
+    proxy = make_proxy(client)
+    with pytest.raises(Unavailable, match='timed out'):
+        proxy.stuck()
+    assert proxy.timed_out == 1
+    client.release.set()
+
+
+def test_stuck_calls_keep_their_slots():
+    client = Client()
+    proxy = make_proxy(client, pool_size=1)
+    with pytest.raises(Unavailable, match='timed out'):
+        proxy.stuck()
+    with pytest.raises(Unavailable, match='in progress'):
+        proxy.fast(1)
+    assert proxy.rejected == 1
+
+    client.release.set()
+    proxy._executor.submit(lambda: None).result()  # the stuck call has returned
+    assert proxy.fast(2) == 2
+
+
+def test_deadline_of_method_overrides_default():
+    client = Client()
+    client.release.set()
+    proxy = make_proxy(client, timeouts={'stuck': 1, 'fast': -1})
+    assert proxy.stuck() == 'late'
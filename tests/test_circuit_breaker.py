@@ -0,0 +1,153 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, ConcurrencyLimiter, GuardedProxy, CLOSED, OPEN, HALF_OPEN
+from conftest import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker, 'time', clock)
+    return clock
+
+
+def fail(breaker: CircuitBreaker, times: int) -> None:
+    for _ in range(times):
+        assert breaker.acquire()
+        breaker.record(False)
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, open_seconds=10)
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+    fail(breaker, 1)
+    assert breaker.state == OPEN
+    assert not breaker.acquire()
+    assert breaker.stats() == {'state': OPEN, 'opened': 1, 'rejected': 1}
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3)
+    fail(breaker, 2)
+    assert breaker.acquire()
+    breaker.record(True)
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+
+
+def test_neutral_result_changes_nothing(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    fail(breaker, 1)
+    assert breaker.acquire()
+    breaker.record(None)
+    fail(breaker, 1)
+    assert breaker.state == OPEN
+
+
+def test_half_open_probes_double_and_close(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10, half_open_successes=3)
+    fail(breaker, 1)
+    clock.advance(10)
+    assert breaker.state == HALF_OPEN
+
+    # one probe at once
+    assert breaker.acquire()
+    assert not breaker.acquire()
+    breaker.record(True)
+    # then two
+    assert breaker.acquire()
+    assert breaker.acquire()
+    assert not breaker.acquire()
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    assert all(breaker.acquire() for _ in range(10))
+
+
+def test_failed_probe_opens_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10)
+    fail(breaker, 1)
+    clock.advance(10)
+    assert breaker.acquire()
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.opened == 2
+    clock.advance(5)
+    assert not breaker.acquire()
+    clock.advance(5)
+    assert breaker.acquire()
+
+
+class Unavailable(Exception):
+    pass
+
+
+class Failure(Exception):
+    pass
+
+
+class Answer(Exception):
+    pass
+
+
+class Service(object):
+
+    def __init__(self):
+        self.error = None
+
+    def call(self):
+        if self.error is not None:
+            raise self.error
+        return 'ok'
+
+
+def make_proxy(service: Service, breaker: CircuitBreaker) -> GuardedProxy:
+    return GuardedProxy(service, ['call'], breaker, None, (Failure,), (Answer,), Unavailable)
+
+
+def test_proxy_opens_on_failures_only(clock):
+    service = Service()
+    breaker = CircuitBreaker(failure_threshold=2, open_seconds=10)
+    proxy = make_proxy(service, breaker)
+
+    # errors of devices are answers of working service
+    service.error = Answer()
+    for _ in range(5):
+        with pytest.raises(Answer):
+            proxy.call()
+    assert breaker.state == CLOSED
+
+    service.error = Failure()
+    for _ in range(2):
+        with pytest.raises(Failure):
+            proxy.call()
+    with pytest.raises(Unavailable):
+        proxy.call()
+
+    service.error = None
+    clock.advance(10)
+    assert proxy.call() == 'ok'
+
+
+def test_limiter_rejects_calls_above_limit(clock):
+    limiter = ConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=10, wait=0)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release('op', 0.1, True)
+    assert limiter.acquire()
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_limiter_shrinks_on_failures_and_grows_back(clock):
+    limiter = ConcurrencyLimiter(initial_limit=20, min_limit=2, max_limit=40, backoff=0.5)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release('op', None, False)
+    assert limiter.limit == 2
+    for _ in range(200):
+        limiter.acquire()
+        limiter.release('op', 0.1, True)
+    assert limiter.limit > 20
@@ -0,0 +1,55 @@
+import base64
+
+import pytest
+
+pytest.importorskip('ndcloudclient')
+
+from fake_ndss import FakeNDSS, create_fake_ndss_from_config
+from ndcloudclient.ndss import NDSSException, KeeneticDeviceException
+
+
+def test_license_is_resolved_to_stable_token_alias():
+    ndss = FakeNDSS()
+    token_alias, system_name, hw_id = ndss.resolve_license('100000000000001')
+    assert token_alias == FakeNDSS.get_token_alias('100000000000001')
+    assert system_name == f'{token_alias}.keenetic.io'
+    assert hw_id == 'KN-1000'
+    assert ndss.resolve_license('100000000000000') == (None, None, None)
+
+
+def test_trusted_bearer_is_valid_until_expiration():
+    ndss = FakeNDSS()
+    bearer_value, _ = ndss.trust_token('alias', 'private', 'public', 3600, 'role', 'user')
+    assert ndss.get_info('alias', bearer_value)['bearer_is_valid'] == 'true'
+    expired_value, _ = ndss.trust_token('alias', 'private', 'public', -1, 'role', 'user')
+    assert ndss.get_info('alias', expired_value)['bearer_is_valid'] == 'false'
+
+
+def test_callback_auth():
+    ndss = FakeNDSS(callback_login='login', callback_password='password')
+    assert ndss.check_callback_auth('Basic ' + base64.b64encode(b'login:password').decode())
+    assert not ndss.check_callback_auth('Basic ' + base64.b64encode(b'login:wrong').decode())
+    assert not ndss.check_callback_auth(None)
+
+
+def test_failures_are_injected():
+    ndss = FakeNDSS(ndss_error_rate=1.0)
+    with pytest.raises(NDSSException):
+        ndss.resolve_license('100000000000001')
+    ndss = FakeNDSS(device_error_rates={'0x0400': 1.0})
+    with pytest.raises(KeeneticDeviceException) as e:
+        ndss.get_info('alias', 'bearer')
+    assert e.value.code == '0x0400'
+    ndss.resolve_license('100000000000001')  # not a device call
+
+
+def test_fake_is_created_from_config():
+    ndss = create_fake_ndss_from_config({
+        'NDSS_CALLBACK_BASIC_LOGIN': 'login',
+        'FAKE_NDSS_LATENCY': '0.5',
+        'FAKE_NDSS_LATENCY_GET_INFO': 'malformed',
+        'FAKE_NDSS_ERROR_RATE_0x0300': 0.1
+    })
+    assert ndss._latency == 0.5
+    assert ndss._latencies == {'get_info': 0.0}
+    assert ndss._device_error_rates == {'0x0300': 0.1}
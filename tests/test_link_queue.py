@@ -0,0 +1,189 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+import pytest
+
+from link_queue import LinkQueue
+from record_store import RecordStore
+from record_store_sqlite import RecordStoreSqlite
+
+
+class Temporary(Exception):
+    pass
+
+
+class Handler(object):
+    """
+    Records calls, fails them with given exceptions first
+    """
+
+    def __init__(self, errors=()):
+        self.calls = []
+        self._errors = list(errors)
+        self._lock = Lock()
+
+    def __call__(self, service_id: str, device_ec_public: str, token_alias: str) -> None:
+        with self._lock:
+            self.calls.append(token_alias)
+            if self._errors:
+                raise self._errors.pop(0)
+
+
+@pytest.fixture
+def rs(tmp_path):
+    rs = RecordStoreSqlite('service', str(tmp_path / 'records.sqlite'))
+    assert rs.ensure_infra()
+    return rs
+
+
+def make_queue(rs: RecordStore, handler: Handler, retries: int = 0, size: int = 10, **kwargs) -> LinkQueue:
+    return LinkQueue(rs, handler, workers=2, size=size, retries=retries, backoff=0,
+                     retry_on=(Temporary,), log=lambda message: None, **kwargs)
+
+
+def wait_until(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def wait_idle(queue: LinkQueue) -> None:
+    wait_until(lambda: not queue.qsize() and not queue.busy())
+
+
+def save_pending(rs: RecordStore, token_alias: str, **fields) -> None:
+    record = RecordStore.prepare_ec_record(token_alias, '', '', f'device-{token_alias}')
+    rs.save_pending_ec_record(token_alias, dict(record, **fields))
+
+
+def test_submitted_job_is_persisted_and_handled(rs):
+    handler = Handler()
+    queue = make_queue(rs, handler)
+    assert queue.submit('service', 'device-a', 'a')
+    assert [x['tokenAlias'] for x in rs.load_pending_ec_records()] == ['a']
+    wait_until(lambda: handler.calls == ['a'])
+
+
+def test_pending_records_are_resumed(rs, tmp_path):
+    save_pending(rs, 'a')
+    save_pending(rs, 'b')
+    save_pending(rs, 'failed', timestampFailed=1)
+    handler = Handler()
+    queue = make_queue(rs, handler, size=1)
+    assert queue.resume_pending(str(tmp_path / 'resume.lock'))
+    wait_until(lambda: sorted(handler.calls) == ['a', 'b'])
+    wait_idle(queue)
+    assert 'failed' not in handler.calls
+
+
+def test_only_one_queue_resumes(rs, tmp_path):
+    lock_filename = str(tmp_path / 'resume.lock')
+    save_pending(rs, 'a')
+    first, second = Handler(), Handler()
+    first_queue = make_queue(rs, first)
+    assert first_queue.resume_pending(lock_filename)
+    assert not make_queue(rs, second).resume_pending(lock_filename)
+    # the lock is kept, so resuming may be retried by the same queue, its own jobs are not resumed twice
+    assert first_queue.resume_pending(lock_filename)
+    wait_until(lambda: first.calls == ['a'])
+    wait_idle(first_queue)
+    assert first.calls == ['a']
+    assert second.calls == []
+
+
+def test_job_is_retried_and_marked_failed(rs, tmp_path):
+    handler = Handler([Temporary(), Temporary(), Temporary()])
+    queue = make_queue(rs, handler, retries=2)
+    assert queue.submit('service', 'device-a', 'a')
+    wait_until(lambda: len(handler.calls) == 3)
+    wait_idle(queue)
+    pending = rs.load_pending_ec_records()
+    assert pending[0]['timestampFailed']
+
+    # failed job is not resumed after restart
+    other = Handler()
+    assert make_queue(rs, other).resume_pending(str(tmp_path / 'resume.lock'))
+    time.sleep(0.05)
+    assert other.calls == []
+
+
+def test_declined_job_is_not_retried(rs):
+    handler = Handler([ValueError('declined')])
+    queue = make_queue(rs, handler, retries=5)
+    assert queue.submit('service', 'device-a', 'a')
+    wait_until(lambda: rs.load_pending_ec_records()[0].get('timestampFailed'))
+    assert handler.calls == ['a']
+
+
+def test_full_queue_rejects_jobs(rs):
+    queue = LinkQueue(rs, Handler(), workers=1, size=1, retries=0, backoff=0, retry_on=(), log=lambda message: None)
+    # the only worker is blocked by the first job, so the second one waits in queue
+    unblocked = Event()
+    queue._handler = lambda **kwargs: unblocked.wait()
+    assert queue.submit('service', 'device-a', 'a')
+    wait_until(lambda: queue.busy() == 1)
+    assert queue.submit('service', 'device-b', 'b')
+    assert not queue.submit('service', 'device-c', 'c')
+    unblocked.set()
+    wait_idle(queue)
+
+
+def test_slow_save_does_not_block_other_submits(rs):
+    queue = make_queue(rs, Handler(), size=2)
+    save = rs.save_pending_ec_record
+    unblocked = Event()
+
+    def slow_save(token_alias, content):
+        if token_alias == 'slow':
+            unblocked.wait(5)
+        save(token_alias, content)
+
+    rs.save_pending_ec_record = slow_save
+    results = []
+    thread = Thread(target=lambda: results.append(queue.submit('service', 'device-slow', 'slow')))
+    thread.start()
+    wait_until(lambda: queue._reserved == 1)
+    assert queue.submit('service', 'device-a', 'a')
+    unblocked.set()
+    thread.join()
+    assert results == [True]
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+def test_only_jobs_of_dead_processes_are_resumed(rs, tmp_path):
+    now = int(time.time())
+    host = socket.gethostname()
+    save_pending(rs, 'unclaimed')
+    save_pending(rs, 'dead', claimOwner=f'{host}:{dead_pid()}', timestampClaimed=now)
+    save_pending(rs, 'live', claimOwner=f'{host}:{os.getppid()}', timestampClaimed=now)
+    save_pending(rs, 'other-host', claimOwner='other-host:1', timestampClaimed=now)
+    save_pending(rs, 'expired', claimOwner='other-host:1', timestampClaimed=now - 120)
+    handler = Handler()
+    queue = make_queue(rs, handler, claim_ttl=60)
+    assert queue.resume_pending(str(tmp_path / 'resume.lock'))
+    wait_until(lambda: sorted(handler.calls) == ['dead', 'expired', 'unclaimed'])
+    wait_idle(queue)
+
+    # resumed records are claimed by the queue
+    owners = {x['tokenAlias']: x['claimOwner'] for x in rs.load_pending_ec_records()}
+    assert owners['dead'] == owners['expired'] == owners['unclaimed'] == f'{host}:{os.getpid()}'
+    assert sorted(handler.calls) == ['dead', 'expired', 'unclaimed']
+
+
+def test_old_failed_records_are_deleted(rs, tmp_path):
+    now = int(time.time())
+    save_pending(rs, 'old', timestampFailed=now - 120)
+    save_pending(rs, 'recent', timestampFailed=now)
+    queue = make_queue(rs, Handler(), failed_ttl=60)
+    assert queue.resume_pending(str(tmp_path / 'resume.lock'))
+    assert [x['tokenAlias'] for x in rs.load_pending_ec_records()] == ['recent']
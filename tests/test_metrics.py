@@ -0,0 +1,56 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from metrics import Registry
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+def write_snapshot(directory, pid: int, counter: float, gauge: float, mtime: float = 0) -> str:
+    path = os.path.join(directory, f'{pid}.json')
+    with open(path, 'w') as f:
+        json.dump({'pid': pid, 'started': 1.0, 'metrics': {
+            'jobs_total': {'type': 'counter', 'help': 'Jobs', 'samples': [[[], counter]]},
+            'queue_depth': {'type': 'gauge', 'help': 'Depth', 'samples': [[[], gauge]]},
+        }}, f)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_counters_of_exited_process_are_archived_and_gauges_dropped(tmp_path):
+    registry = Registry(str(tmp_path))
+    registry.counter('jobs_total', 'Jobs').inc(2)
+    path = write_snapshot(str(tmp_path), dead_pid(), counter=5, gauge=7)
+
+    for _ in range(2):  # archived counters are counted once
+        text = registry.render()
+        assert 'jobs_total 7' in text
+        assert 'queue_depth' not in text
+    assert not os.path.exists(path)
+
+
+def test_snapshot_of_live_process_is_kept_when_stale(tmp_path):
+    registry = Registry(str(tmp_path))
+    # parent process is alive, but hasn't written its snapshot for long
+    path = write_snapshot(str(tmp_path), os.getppid(), counter=5, gauge=7, mtime=time.time() - 3600)
+
+    text = registry.render()
+    assert 'jobs_total 5' in text
+    assert 'queue_depth' not in text
+    assert os.path.exists(path)
+
+
+def test_previous_snapshot_with_same_pid_is_archived(tmp_path):
+    write_snapshot(str(tmp_path), os.getpid(), counter=5, gauge=7)
+    registry = Registry(str(tmp_path))
+    registry.counter('jobs_total', 'Jobs').inc(1)
+
+    assert 'jobs_total 6' in registry.render()
@@ -0,0 +1,48 @@
+import pytest
+import requests
+
+from ndss_session import PooledSession, create_client_with_session
+
+
+class ClientWithArgument(object):
+
+    def __init__(self, params, session=None):
+        self.params = params
+        self.session = session
+
+
+class ClientWithAttribute(object):
+
+    def __init__(self, params):
+        self._session = requests.Session()
+
+
+class StockClient(object):
+
+    def __init__(self, params):
+        self.params = params
+
+
+def test_session_is_given_to_constructor():
+    session = PooledSession()
+    client, is_pooled = create_client_with_session(ClientWithArgument, {'SERVER': 'x'}, session)
+    assert is_pooled and client.session is session and client.params == {'SERVER': 'x'}
+
+
+def test_session_replaces_session_attribute():
+    session = PooledSession()
+    client, is_pooled = create_client_with_session(ClientWithAttribute, {}, session)
+    assert is_pooled and client._session is session
+
+
+def test_client_without_hook_is_stock():
+    client, is_pooled = create_client_with_session(StockClient, {}, PooledSession())
+    assert not is_pooled and isinstance(client, StockClient)
+
+
+def test_failed_requests_are_counted():
+    session = PooledSession(pool_size=2)
+    with pytest.raises(requests.ConnectionError):
+        session.get('http://127.0.0.1:9/', timeout=1)
+    assert session.stats()['requests'] == 1
+    assert session.stats()['failures'] == 1
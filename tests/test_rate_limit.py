@@ -0,0 +1,89 @@
+import pytest
+
+import rate_limit
+from conftest import FakeClock
+from rate_limit import RateLimiter, SqliteRateLimiter, create_rate_limiter, format_retry_after
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_limiter(request, tmp_path):
+    def make(rate, burst, maxsize=1000):
+        return create_rate_limiter(request.param, rate, burst, maxsize, str(tmp_path / 'buckets.sqlite'))
+    return make
+
+
+def test_burst_is_allowed_then_limited(clock, make_limiter):
+    limiter = make_limiter(rate=1, burst=3)
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('a') == pytest.approx(1.0)
+    assert limiter.stats()['allowed'] == 3
+    assert limiter.stats()['limited'] == 1
+
+
+def test_tokens_come_back_at_rate(clock, make_limiter):
+    limiter = make_limiter(rate=2, burst=1)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == pytest.approx(0.5)
+    clock.advance(0.25)
+    assert limiter.acquire('a') == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert limiter.acquire('a') == 0
+
+
+def test_limited_requests_do_not_consume_tokens(clock, make_limiter):
+    limiter = make_limiter(rate=1, burst=1)
+    assert limiter.acquire('a') == 0
+    for _ in range(10):
+        assert limiter.acquire('a') > 0
+    clock.advance(1)
+    assert limiter.acquire('a') == 0
+
+
+def test_keys_have_separate_buckets(clock, make_limiter):
+    limiter = make_limiter(rate=1, burst=1)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    assert limiter.acquire('b') == 0
+
+
+def test_idle_bucket_is_full_again(clock, make_limiter):
+    limiter = make_limiter(rate=1, burst=2)
+    assert [limiter.acquire('a') for _ in range(2)] == [0, 0]
+    clock.advance(100)
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+def test_zero_rate_disables_limiting(clock, make_limiter):
+    limiter = make_limiter(rate=0, burst=1)
+    assert not limiter.enabled
+    assert all(limiter.acquire('a') == 0 for _ in range(100))
+
+
+def test_least_recently_used_keys_are_forgotten(clock):
+    limiter = RateLimiter(rate=1, burst=1, maxsize=2)
+    for key in ['a', 'b', 'c']:
+        limiter.acquire(key)
+    assert len(limiter) == 2
+    # bucket of 'a' is forgotten, so it is full again
+    assert limiter.acquire('a') == 0
+
+
+def test_sqlite_buckets_are_shared_by_limiters(clock, tmp_path):
+    filename = str(tmp_path / 'buckets.sqlite')
+    first = SqliteRateLimiter(1, 2, 1000, filename)
+    second = SqliteRateLimiter(1, 2, 1000, filename)
+    assert first.acquire('a') == 0
+    assert second.acquire('a') == 0
+    assert first.acquire('a') > 0
+
+
+def test_format_retry_after_rounds_up():
+    assert format_retry_after(0.1) == '1'
+    assert format_retry_after(1.2) == '2'
@@ -0,0 +1,129 @@
+import time
+
+import fakeredis
+import pytest
+
+import record_store_redis
+from conftest import FakeClock
+from record_store import RecordStore
+from record_store_caching import CachingRecordStore
+from record_store_files import RecordStoreFiles
+from record_store_redis import RecordStoreRedis
+from record_store_sqlite import RecordStoreSqlite
+from record_store_write_behind import WriteBehindRecordStore
+
+
+SERVICE_ID = 'service'
+
+
+def create_files(tmp_path) -> RecordStore:
+    return RecordStoreFiles(SERVICE_ID, str(tmp_path / 'records'))
+
+
+def create_sqlite(tmp_path) -> RecordStore:
+    return RecordStoreSqlite(SERVICE_ID, str(tmp_path / 'records.sqlite'))
+
+
+def create_redis(tmp_path) -> RecordStore:
+    return RecordStoreRedis(SERVICE_ID, client=fakeredis.FakeRedis())
+
+
+def create_cached_sqlite(tmp_path) -> RecordStore:
+    return CachingRecordStore(create_sqlite(tmp_path), maxsize=100, ec_ttl=300, bearer_ttl=30, negative_ttl=5)
+
+
+def create_write_behind_sqlite(tmp_path) -> RecordStore:
+    return WriteBehindRecordStore(create_sqlite(tmp_path), str(tmp_path / 'journals'), fsync=False)
+
+
+@pytest.fixture(params=[create_files, create_sqlite, create_redis, create_cached_sqlite, create_write_behind_sqlite])
+def rs(request, tmp_path):
+    rs = request.param(tmp_path)
+    assert rs.ensure_infra()
+    yield rs
+    if isinstance(rs, WriteBehindRecordStore):
+        rs.close()
+
+
+def ec_record(token_alias: str) -> dict:
+    return RecordStore.prepare_ec_record(token_alias, f'private-{token_alias}', f'public-{token_alias}', 'device')
+
+
+def bearer_record(token_alias: str, bearer_value: str = 'bearer', expires_in: int = 3600) -> dict:
+    return RecordStore.prepare_bearer_record(
+        token_alias, 'role', 'user', bearer_value, int(time.time()) + expires_in)
+
+
+def test_pending_record_is_not_active(rs):
+    rs.save_pending_ec_record('a', ec_record('a'))
+    assert rs.load_ec_record('a') is None
+    assert [x['tokenAlias'] for x in rs.load_pending_ec_records()] == ['a']
+    assert list(rs.load_active_token_aliases()) == []
+
+
+def test_activation_replaces_pending_record(rs):
+    record = ec_record('a')
+    rs.save_pending_ec_record('a', ec_record('a'))
+    rs.save_active_ec_record('a', record)
+    assert rs.load_ec_record('a') == record
+    assert rs.load_pending_ec_records() == []
+    assert list(rs.load_active_token_aliases()) == ['a']
+
+
+def test_pending_record_is_deleted(rs):
+    rs.save_pending_ec_record('a', ec_record('a'))
+    rs.save_pending_ec_record('b', ec_record('b'))
+    rs.delete_pending_ec_record('a')
+    rs.delete_pending_ec_record('missing')
+    assert [x['tokenAlias'] for x in rs.load_pending_ec_records()] == ['b']
+
+
+def test_missing_records(rs):
+    assert rs.load_ec_record('missing') is None
+    assert rs.load_bearer_record('missing', 'role', 'user') is None
+    assert rs.load_ec_records(['missing']) == {'missing': None}
+    assert rs.load_bearer_records([('missing', 'role', 'user')]) == {('missing', 'role', 'user'): None}
+
+
+def test_bearer_is_replaced(rs):
+    rs.save_bearer_record(bearer_record('a', 'first'))
+    rs.save_bearer_record(bearer_record('a', 'second'))
+    assert rs.load_bearer_record('a', 'role', 'user')['bearerValue'] == 'second'
+    assert rs.load_bearer_record('a', 'other', 'user') is None
+    assert [x['bearerValue'] for x in rs.load_all_bearer_records()] == ['second']
+
+
+def test_bulk_operations(rs):
+    token_aliases = [f'device{i}' for i in range(5)]
+    rs.save_pending_ec_records({x: ec_record(x) for x in token_aliases})
+    assert sorted(x['tokenAlias'] for x in rs.load_pending_ec_records()) == token_aliases
+
+    rs.save_active_ec_records({x: ec_record(x) for x in token_aliases[:3]})
+    loaded = rs.load_ec_records(token_aliases)
+    assert [loaded[x] is not None for x in token_aliases] == [True, True, True, False, False]
+    assert sorted(rs.load_active_token_aliases()) == token_aliases[:3]
+
+    rs.save_bearer_records([bearer_record(x, f'bearer-{x}') for x in token_aliases])
+    keys = [(x, 'role', 'user') for x in token_aliases]
+    assert {k: v['bearerValue'] for k, v in rs.load_bearer_records(keys).items()} == \
+        {(x, 'role', 'user'): f'bearer-{x}' for x in token_aliases}
+
+
+def test_redis_bearer_expires_at_its_timestamp(tmp_path):
+    client = fakeredis.FakeRedis()
+    rs = RecordStoreRedis(SERVICE_ID, client=client)
+    rs.save_bearer_record(bearer_record('a', expires_in=100))
+    ttl = client.ttl(rs._bearer_key('a', 'role', 'user'))
+    assert 0 < ttl <= 100
+
+
+def test_redis_bearer_without_expiration_stays_in_index(tmp_path, monkeypatch):
+    clock = FakeClock(time.time())
+    monkeypatch.setattr(record_store_redis, 'time', clock)
+    client = fakeredis.FakeRedis()
+    rs = RecordStoreRedis(SERVICE_ID, client=client)
+    rs.save_bearer_record(dict(bearer_record('a'), timestampExpires=0))
+    assert client.ttl(rs._bearer_key('a', 'role', 'user')) == -1
+
+    clock.advance(3600)
+    assert [x['tokenAlias'] for x in rs.load_all_bearer_records()] == ['a']
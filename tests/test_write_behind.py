@@ -0,0 +1,154 @@
+import json
+import os
+import time
+
+from record_store import RecordStore
+from record_store_sqlite import RecordStoreSqlite
+from record_store_write_behind import WriteBehindRecordStore, PENDING, ACTIVE, BEARER
+
+
+class FailingStore(RecordStoreSqlite):
+    """
+    Backend, which fails all writes while is_failing is set
+    """
+
+    is_failing = True
+
+    def _check(self):
+        if self.is_failing:
+            raise OSError('backend is down')
+
+    def save_pending_ec_records(self, contents):
+        self._check()
+        super().save_pending_ec_records(contents)
+
+    def save_active_ec_records(self, contents):
+        self._check()
+        super().save_active_ec_records(contents)
+
+    def save_bearer_records(self, contents):
+        self._check()
+        super().save_bearer_records(contents)
+
+
+def write_journal(directory: str, items, tail: bytes = b'', name: str = 'journal-1-dead-000000.log',
+                  timestamp: float = 0) -> str:
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, name)
+    with open(filename, 'wb') as f:
+        for seq, (key, content) in enumerate(items, 1):
+            f.write(WriteBehindRecordStore._format_line(key, json.dumps(content), seq, timestamp or time.time()))
+        f.write(tail)
+    return filename
+
+
+def journal_files(directory: str):
+    return sorted(x for x in os.listdir(directory) if x.endswith('.log'))
+
+
+def test_journal_of_dead_process_is_replayed(tmp_path):
+    directory = str(tmp_path / 'journals')
+    ec_record = RecordStore.prepare_ec_record('a', 'private', 'public', 'device')
+    bearer = RecordStore.prepare_bearer_record('a', 'role', 'user', 'bearer', int(time.time()) + 3600)
+    filename = write_journal(directory, [
+        ((PENDING, 'b'), RecordStore.prepare_ec_record('b', '', '', 'device')),
+        ((ACTIVE, 'a'), ec_record),
+        ((BEARER, 'a', 'role', 'user'), bearer)
+    ], tail=b'{"key": ["active", "c"], "cont')  # line, which was cut by crash
+
+    backend = RecordStoreSqlite('service', str(tmp_path / 'records.sqlite'))
+    rs = WriteBehindRecordStore(backend, directory, fsync=False, log=lambda message: None)
+    assert rs.ensure_infra()
+    assert not os.path.exists(filename)
+    # replayed records are returned before they are written
+    assert rs.load_ec_record('a') == ec_record
+    rs.close()
+
+    assert backend.load_ec_record('a') == ec_record
+    assert backend.load_ec_record('c') is None
+    assert [x['tokenAlias'] for x in backend.load_pending_ec_records()] == ['b']
+    assert backend.load_bearer_record('a', 'role', 'user') == bearer
+
+
+def test_journal_of_running_process_is_not_replayed(tmp_path):
+    directory = str(tmp_path / 'journals')
+    backend = FailingStore('service', str(tmp_path / 'records.sqlite'))
+    backend.ensure_infra()
+    running = WriteBehindRecordStore(backend, directory, flush_interval=0.01, fsync=False, log=lambda message: None)
+    running.save_active_ec_record('a', RecordStore.prepare_ec_record('a', 'private', 'public', 'device'))
+
+    other = WriteBehindRecordStore(backend, directory, fsync=False, log=lambda message: None)
+    assert other.ensure_infra()
+    assert other.load_ec_record('a') is None
+    assert running.load_ec_record('a') is not None
+
+    backend.is_failing = False
+    running.close()
+    other.close()
+    assert backend.load_ec_record('a') is not None
+
+
+def test_records_are_kept_while_backend_fails(tmp_path):
+    directory = str(tmp_path / 'journals')
+    backend = FailingStore('service', str(tmp_path / 'records.sqlite'))
+    backend.ensure_infra()
+    rs = WriteBehindRecordStore(backend, directory, flush_interval=0.01, fsync=False, log=lambda message: None)
+    rs.save_active_ec_record('a', RecordStore.prepare_ec_record('a', 'private', 'public', 'device'))
+    time.sleep(0.1)
+    assert rs.stats()['failures'] > 0
+    assert rs.stats()['waiting'] == 1
+    assert backend.load_ec_record('a') is None
+
+    backend.is_failing = False
+    deadline = time.monotonic() + 10
+    while backend.load_ec_record('a') is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert backend.load_ec_record('a') is not None
+    rs.close()
+
+
+def test_repeated_saves_are_coalesced(tmp_path):
+    backend = FailingStore('service', str(tmp_path / 'records.sqlite'))
+    backend.ensure_infra()
+    rs = WriteBehindRecordStore(backend, str(tmp_path / 'journals'), fsync=False, log=lambda message: None)
+    for bearer_value in ['first', 'second', 'third']:
+        rs.save_bearer_record(RecordStore.prepare_bearer_record('a', 'role', 'user', bearer_value, 0))
+    assert rs.stats()['coalesced'] == 2
+    backend.is_failing = False
+    rs.close()
+    assert backend.load_bearer_record('a', 'role', 'user')['bearerValue'] == 'third'
+
+
+def test_journals_are_replayed_in_order_of_saves(tmp_path):
+    directory = str(tmp_path / 'journals')
+    # the journal, which is listed first, has later saves
+    write_journal(directory, [((BEARER, 'a', 'role', 'user'), RecordStore.prepare_bearer_record(
+        'a', 'role', 'user', 'second', 0))], name='journal-1-a-000000.log', timestamp=2000)
+    write_journal(directory, [((BEARER, 'a', 'role', 'user'), RecordStore.prepare_bearer_record(
+        'a', 'role', 'user', 'first', 0))], name='journal-2-b-000000.log', timestamp=1000)
+
+    backend = RecordStoreSqlite('service', str(tmp_path / 'records.sqlite'))
+    rs = WriteBehindRecordStore(backend, directory, fsync=False, log=lambda message: None)
+    assert rs.ensure_infra()
+    rs.close()
+    assert backend.load_bearer_record('a', 'role', 'user')['bearerValue'] == 'second'
+
+
+def test_flushed_segments_are_deleted(tmp_path):
+    directory = str(tmp_path / 'journals')
+    backend = FailingStore('service', str(tmp_path / 'records.sqlite'))
+    backend.ensure_infra()
+    rs = WriteBehindRecordStore(backend, directory, flush_interval=0.01, fsync=False, segment_size=2,
+                                log=lambda message: None)
+    for token_alias in ['a', 'b', 'c', 'd', 'e']:
+        rs.save_active_ec_record(token_alias, RecordStore.prepare_ec_record(token_alias, 'private', 'public', 'x'))
+        rs.flush()  # fails, full segment is kept, the next one is started
+    assert len(journal_files(directory)) == 3
+
+    backend.is_failing = False
+    assert rs.flush()
+    # only the new empty segment is left
+    assert len(journal_files(directory)) == 1
+    assert os.path.getsize(os.path.join(directory, journal_files(directory)[0])) == 0
+    rs.close()
+    assert journal_files(directory) == []
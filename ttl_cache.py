@@ -0,0 +1,191 @@
+"""
+Size-bounded LRU caches with TTL.
+
+TTLCache lives in process memory, SqliteTTLCache keeps entries in local sqlite file,
+so the entries are shared by all gunicorn workers on the host.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock, local
+from typing import *
+
+
+MISSING = object()
+
+
+class TTLCache(object):
+
+    _maxsize = 0
+    _ttl = 0.0
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: maximum number of entries, least recently used are evicted first
+        :param ttl: default time to live of entry in seconds
+        """
+        self._maxsize = max(maxsize, 1)
+        self._ttl = ttl
+        self._entries: 'OrderedDict[Hashable, Tuple[float, object]]' = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, stale: float = 0) -> object:
+        """
+        Returns cached value or MISSING. Note, None is a valid cached value (negative caching)
+
+        :param stale: seconds after expiration, while the value is still returned
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires + stale > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                # expired entries are kept until eviction, they may be asked with stale later
+            self.misses += 1
+        return MISSING
+
+    def set(self, key: Hashable, value: object, ttl: Optional[float] = None) -> None:
+        """
+        Puts value to cache
+
+        :param ttl: time to live in seconds, overrides default ttl of the cache
+        """
+        expires = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of this process
+        """
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class SqliteTTLCache(TTLCache):
+    """
+    Values must be JSON-serializable, keys are converted to strings.
+    Tuples are returned as lists.
+    Time of use is written by hits only when it is older than 1/10 of ttl, so most hits don't write.
+    """
+
+    _filename = ''
+    _stale = 0.0
+    _touch_interval = 0.0
+
+    def __init__(self, maxsize: int, ttl: float, filename: str, stale: float = 0):
+        """
+        :param stale: seconds after expiration, while entries are kept for get with stale
+        """
+        super().__init__(maxsize, ttl)
+        self._filename = filename
+        self._stale = stale
+        self._touch_interval = max(ttl / 10, 1.0)
+        self._local = local()
+        self._writes = 0
+        with self._connection() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connection may be used only in thread, which has created it
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._filename, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def get(self, key: Hashable, stale: float = 0) -> object:
+        # wall clock time, because entries are shared between processes
+        now = time.time()
+        db = self._connection()
+        row = db.execute('SELECT value, expires, used FROM cache WHERE key = ?', (str(key),)).fetchone()
+        if row and row[1] + stale > now:
+            if now - row[2] > self._touch_interval:
+                db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, str(key)))
+            self.hits += 1
+            return json.loads(row[0])
+        self.misses += 1
+        return MISSING
+
+    def set(self, key: Hashable, value: object, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires = now + (self._ttl if ttl is None else ttl)
+        db = self._connection()
+        db.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)',
+            (str(key), json.dumps(value), expires, now)
+        )
+        # counting rows is not free, so the size is checked only for some of writes
+        self._writes += 1
+        if self._writes % 32 == 0 and len(self) > self._maxsize:
+            # expired entries are kept for stale window
+            db.execute('DELETE FROM cache WHERE expires <= ?', (now - self._stale,))
+            cursor = db.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used LIMIT ?)',
+                (max(len(self) - self._maxsize, 0),)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (str(key),))
+
+    def clear(self) -> None:
+        self._connection().execute('DELETE FROM cache')
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+def create_cache(backend: str, maxsize: int, ttl: float, filename: str = '', stale: float = 0) -> TTLCache:
+    """
+    Creates cache by backend name from config
+
+    :param backend: 'memory' or 'sqlite'
+    :param maxsize: maximum number of entries
+    :param ttl: default time to live of entry in seconds
+    :param filename: sqlite database file, required for 'sqlite' backend
+    :param stale: the longest stale window of get, expired entries are kept for it
+    """
+    if backend == 'sqlite':
+        if not filename:
+            raise ValueError('filename is required for sqlite cache')
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SqliteTTLCache(maxsize, ttl, filename, stale)
+    return TTLCache(maxsize, ttl)